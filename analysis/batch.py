@@ -0,0 +1,234 @@
+import os
+import sys
+import time
+import pandas as pd
+import nipype.pipeline.engine as pe
+from bids_index import BIDSIndex
+from pipeline import init_pipeline_wf, get_plugin_args
+from utils import set_intermediate_format, STAGES
+from profiling import run_workflow
+from sharedfs import SharedFSPlugin, LocalWorkers
+
+
+def main(sourcedata,
+         derivatives,
+         tmp_dir,
+         subjects=None,
+         sessions=None,
+         bids_filters=None,
+         stages=('combine',),
+         n_procs=4,
+         intermediate_format=None,
+         crop=False,
+         n4_fast=False,
+         subject_stages=None,
+         job_dir=None,
+         local_workers=0,
+         memory_gb=None):
+    # subject_stages ((subject, session) -> stages, e.g., from the
+    # planner in provenance.py) replaces subjects/sessions and stages.
+    # With job_dir, the nodes run on shared-filesystem workers (see
+    # sharedfs.py), n_procs per worker; local_workers starts that many on
+    # this machine for the duration of the run. memory_gb is the memory
+    # the nodes running at the same time (on this machine or a worker) may
+    # use together
+
+    if intermediate_format is not None:
+        set_intermediate_format(intermediate_format)
+
+    if subject_stages is not None:
+        subject_sessions = list(subject_stages)
+        stages = subject_stages
+    else:
+        subject_sessions = get_subject_sessions(sourcedata,
+                                                subjects=subjects,
+                                                sessions=sessions,
+                                                bids_filters=bids_filters)
+
+    if len(subject_sessions) == 0:
+        raise Exception('Found no subjects to process in {}'.format(sourcedata))
+
+    wf = init_batch_wf(sourcedata,
+                       derivatives,
+                       subject_sessions,
+                       stages=stages,
+                       crop=crop,
+                       n4_fast=n4_fast,
+                       num_threads=min(n_procs, 8),
+                       memory_gb=memory_gb)
+    wf.base_dir = tmp_dir
+
+    timer = SubjectTimer(os.path.join(wf.base_dir, wf.name))
+
+    if job_dir is not None or local_workers:
+        plugin = SharedFSPlugin
+        plugin_args = {'job_dir': job_dir,
+                       'status_callback': timer}
+    else:
+        plugin = 'MultiProc'
+        plugin_args = dict(get_plugin_args(n_procs, memory_gb),
+                           status_callback=timer)
+
+    try:
+        with LocalWorkers(local_workers, job_dir=job_dir, n_procs=n_procs, mem_gb=memory_gb):
+            run_workflow(wf,
+                         plugin=plugin,
+                         plugin_args=plugin_args,
+                         profile_dir=os.path.join(derivatives, 'profiles'))
+    except RuntimeError as e:
+        # Crashed nodes only take down their own subject, the summary
+        # below tells which ones
+        print(e)
+
+    print(timer.summary())
+
+    return timer
+
+
+def get_subject_sessions(sourcedata,
+                         subjects=None,
+                         sessions=None,
+                         bids_filters=None):
+
+    index = BIDSIndex(sourcedata)
+    index.update()
+
+    if bids_filters is None:
+        bids_filters = {}
+
+    if subjects is None:
+        subjects = index.get_entities('subject',
+                                      suffix='MPRAGE',
+                                      **bids_filters)
+
+    subject_sessions = []
+
+    for subject in subjects:
+        subject_sessions_ = index.get_entities('session',
+                                               subject=subject,
+                                               suffix='MPRAGE',
+                                               **bids_filters)
+
+        if sessions is not None:
+            subject_sessions_ = [s for s in subject_sessions_ if s in sessions]
+
+        if len(subject_sessions_) == 0:
+            subject_sessions.append((subject, None))
+        else:
+            subject_sessions += [(subject, session) for session in subject_sessions_]
+
+    return subject_sessions
+
+
+def init_batch_wf(sourcedata,
+                  derivatives,
+                  subject_sessions,
+                  stages=('combine',),
+                  name='mp2rage_batch',
+                  crop=False,
+                  n4_fast=False,
+                  num_threads=8,
+                  memory_gb=None):
+    # stages are the same for every subject/session or a dictionary
+    # (subject, session) -> stages
+
+    if not isinstance(stages, dict):
+        stages = {subject_session: stages for subject_session in subject_sessions}
+
+    for stage in set(sum(map(list, stages.values()), [])):
+        if stage not in STAGES:
+            raise Exception('Unknown stage {}'.format(stage))
+
+    wf = pe.Workflow(name=name)
+
+    for subject, session in subject_sessions:
+        subject_wf = init_subject_wf(sourcedata,
+                                     derivatives,
+                                     subject,
+                                     session,
+                                     stages=stages[(subject, session)],
+                                     crop=crop,
+                                     n4_fast=n4_fast,
+                                     num_threads=num_threads,
+                                     memory_gb=memory_gb)
+
+        if subject_wf is not None:
+            wf.add_nodes([subject_wf])
+
+    return wf
+
+
+def init_subject_wf(sourcedata,
+                    derivatives,
+                    subject,
+                    session=None,
+                    stages=('combine',),
+                    crop=False,
+                    n4_fast=False,
+                    num_threads=8,
+                    memory_gb=None):
+
+    return init_pipeline_wf(sourcedata,
+                            derivatives,
+                            subject,
+                            session,
+                            stages=stages,
+                            name=_get_subject_key(subject, session),
+                            crop=crop,
+                            n4_fast=n4_fast,
+                            num_threads=num_threads,
+                            memory_gb=memory_gb)
+
+
+def _get_subject_key(subject, session=None):
+    if session:
+        return 'sub_{}_ses_{}'.format(subject, session)
+    return 'sub_{}'.format(subject)
+
+
+class SubjectTimer(object):
+
+    def __init__(self, base_dir):
+        self.base_dir = base_dir
+        self.subjects = {}
+
+    def __call__(self, node, status):
+        # Every node (including the subnodes of MapNodes) lives in
+        # <base_dir>/<subject workflow>/<stage workflow>/...
+        node_dir = os.path.relpath(node.output_dir(), self.base_dir)
+        key = node_dir.split(os.sep)[0]
+        now = time.time()
+
+        if key not in self.subjects:
+            self.subjects[key] = {'start': now,
+                                  'end': now,
+                                  'n_nodes': 0,
+                                  'failed': []}
+
+        record = self.subjects[key]
+
+        if status == 'start':
+            record['start'] = min(record['start'], now)
+        elif status == 'end':
+            record['end'] = max(record['end'], now)
+            record['n_nodes'] += 1
+        elif status == 'exception':
+            record['end'] = max(record['end'], now)
+            record['failed'].append(node_dir)
+
+    def summary(self):
+        summary = []
+        for key, record in sorted(self.subjects.items()):
+            summary.append({'subject': key,
+                            'wall_time_s': record['end'] - record['start'],
+                            'n_nodes': record['n_nodes'],
+                            'status': 'failed' if record['failed'] else 'ok',
+                            'failed_nodes': ', '.join(record['failed'])})
+
+        return pd.DataFrame(summary, columns=['subject', 'wall_time_s', 'n_nodes',
+                                              'status', 'failed_nodes'])
+
+
+if __name__ == '__main__':
+    import cli
+    cli.main(['batch'] + sys.argv[1:])
@@ -0,0 +1,762 @@
+import argparse
+import os
+import functools
+import sys
+import glob
+import time
+import resource
+import tempfile
+import shutil
+import traceback
+import multiprocessing
+import numpy as np
+import nibabel as nb
+import pandas as pd
+
+
+def measure(function, *args, **kwargs):
+    # Run in a fresh (forked) process, so the peak RSS belongs to this call only
+    context = multiprocessing.get_context('fork')
+    queue = context.Queue()
+
+    def _target():
+        try:
+            t0 = time.time()
+            result = function(*args, **kwargs)
+            wall_time = time.time() - t0
+            peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+            queue.put((wall_time, peak_rss, result))
+        except BaseException:
+            queue.put((None, None, traceback.format_exc()))
+
+    process = context.Process(target=_target)
+    process.start()
+    wall_time, peak_rss, result = queue.get()
+    process.join()
+
+    if wall_time is None:
+        raise Exception('{} failed:\n{}'.format(function.__name__, result))
+
+    return {'wall_time_s': wall_time,
+            'peak_rss_mb': peak_rss}, result
+
+
+def get_shape(resolution, fov=(240., 240., 180.)):
+    return tuple(int(np.round(f / resolution)) for f in fov)
+
+
+def make_masking_data(path, resolution, ext='.nii'):
+    shape = get_shape(resolution)
+    affine = np.diag([resolution, resolution, resolution, 1.])
+    affine[:3, 3] = -np.array(shape) * resolution / 2.
+
+    grid = np.ogrid[tuple(slice(0, s) for s in shape)]
+    radius = np.sqrt(sum(((g - s / 2.) / (s / 2.)) ** 2 for g, s in zip(grid, shape)))
+
+    rng = np.random.RandomState(0)
+    t1w = (radius < .9) * 1000. + rng.normal(0, 50, shape).astype(np.float32)
+    inv2 = (radius < .9) * 2000. * (1 - radius / 2.) + np.abs(rng.normal(0, 100, shape)).astype(np.float32)
+
+    images = {'t1w': t1w.astype(np.float32),
+              'inv2': inv2.astype(np.float32),
+              't1w_mask': (radius < .7).astype(np.float32),
+              'dura_mask': ((radius > .68) & (radius < .72) & (grid[2] > shape[2] / 2)).astype(np.float32),
+              'manual_inside': ((radius > .69) & (radius < .71) & (grid[0] < shape[0] / 4)).astype(np.float32),
+              'manual_outside': ((radius < .3) & (grid[1] < shape[1] / 4)).astype(np.float32)}
+
+    fns = {}
+    for key, data in images.items():
+        fns[key] = os.path.join(path, '{}{}'.format(key, ext))
+        nb.Nifti1Image(data, affine).to_filename(fns[key])
+
+    return fns
+
+
+def _mask_t1w_math_img(t1w, inv2, t1w_mask,
+                       manual_inside=None, manual_outside=None,
+                       dura_mask=None):
+    # The original nilearn.image.math_img implementation of mask_t1w, kept as
+    # a reference
+    from nilearn import image
+    import os
+    import numpy as np
+    from nipype.utils.filemanip import split_filename
+    from scipy import ndimage
+
+    _, t1w_fn, ext= split_filename(t1w)
+
+    if manual_inside:
+        t1w_mask = image.math_img('(t1w_mask + manual_inside) > 0',
+                                  t1w_mask=t1w_mask,
+                                  manual_inside=manual_inside)
+
+    if manual_outside:
+        t1w = image.math_img('t1w * (np.ones_like(t1w) - manual_outside)',
+                             t1w=t1w,
+                             manual_outside=manual_outside)
+
+        t1w_mask = image.math_img('(t1w_mask - manual_outside) > 0',
+                                  t1w_mask=t1w_mask,
+                                  manual_outside=manual_outside)
+
+    new_t1w = image.math_img('t1w * t1w_mask * np.mean(inv2[t1w_mask == 1]/np.max(inv2))'
+                             '+ t1w * inv2/np.max(inv2) * (1-t1w_mask)',
+                              t1w=t1w,
+                              t1w_mask=t1w_mask,
+                              inv2=inv2)
+
+    if dura_mask:
+        dilated_dura_mask = ndimage.binary_dilation(np.asanyarray(image.load_img(dura_mask).dataobj),
+                                                    iterations=2)
+        dilated_dura_mask = image.new_img_like(dura_mask, dilated_dura_mask)
+
+        dilated_dura_mask = image.math_img('(dilated_dura_mask - (t1w_mask - dura_mask)) > 0',
+                                           t1w_mask=t1w_mask,
+                                           dura_mask=dura_mask,
+                                           dilated_dura_mask=dilated_dura_mask)
+
+        if manual_inside:
+            dilated_dura_mask = image.math_img('dilated_dura_mask - manual_inside > 0',
+                                               dilated_dura_mask=dilated_dura_mask,
+                                               manual_inside=manual_inside)
+
+        new_t1w = image.math_img('t1w * (np.ones_like(dura_mask) - dura_mask)',
+                                  t1w=new_t1w,
+                                  dura_mask=dilated_dura_mask)
+
+        t1w_mask = image.math_img('(t1w_mask - dilated_dura_mask) > 0',
+                                  t1w_mask=t1w_mask,
+                                  dilated_dura_mask=dilated_dura_mask)
+
+    new_t1w_fn = os.path.abspath('{}_masked{}'.format(t1w_fn, ext))
+    new_t1w.to_filename(new_t1w_fn)
+
+    new_mask_fn= os.path.abspath('{}_brainmask{}'.format(t1w_fn, ext))
+    t1w_mask.to_filename(new_mask_fn)
+
+    return new_t1w_fn, new_mask_fn
+
+
+def _run_in_dir(path, function, **kwargs):
+    os.makedirs(path)
+    os.chdir(path)
+    return function(**kwargs)
+
+
+def benchmark_mask_t1w(resolutions=(.7, .6, .5), ext='.nii'):
+    from mask_mp2rage import mask_t1w
+
+    results = []
+
+    for resolution in resolutions:
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            _, inputs = measure(make_masking_data, tmp_dir, resolution, ext=ext)
+
+            outputs = {}
+            for method, function in [('math_img', _mask_t1w_math_img),
+                                     ('numpy', mask_t1w)]:
+                row, outputs[method] = measure(_run_in_dir,
+                                               os.path.join(tmp_dir, method),
+                                               function,
+                                               **inputs)
+                row.update({'benchmark': 'mask_t1w',
+                            'method': method,
+                            'resolution': resolution,
+                            'shape': get_shape(resolution)})
+                results.append(row)
+
+            for ix, output in enumerate(['masked_t1w', 'brain_mask']):
+                reference = nb.load(outputs['math_img'][ix]).get_fdata()
+                new = nb.load(outputs['numpy'][ix]).get_fdata()
+                if not np.allclose(reference, new, rtol=1e-4, atol=1e-3):
+                    print('WARNING: {} differs from math_img-implementation at {} mm '
+                          '(max abs. diff {})'.format(output, resolution,
+                                                      np.abs(reference - new).max()))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    return pd.DataFrame(results)
+
+
+def make_transform(path, rotation=2., translation=(1.3, -.7, .4)):
+    angle = np.deg2rad(rotation)
+    matrix = np.array([[np.cos(angle), -np.sin(angle), 0],
+                       [np.sin(angle), np.cos(angle), 0],
+                       [0, 0, 1]])
+
+    fn = os.path.join(path, 'transform.txt')
+    with open(fn, 'w') as f:
+        f.write('#Insight Transform File V1.0\n'
+                '#Transform 0\n'
+                'Transform: MatrixOffsetTransformBase_double_3_3\n'
+                'Parameters: {} {}\n'
+                'FixedParameters: 0 0 0\n'.format(' '.join(str(v) for v in matrix.ravel()),
+                                                   ' '.join(str(v) for v in translation)))
+    return fn
+
+
+def _ants_apply_transforms(in_files, transform, reference_image):
+    import subprocess
+    from nipype.utils.filemanip import split_filename
+
+    out_files = []
+    for in_file in in_files:
+        _, fn, ext = split_filename(in_file)
+        out_files.append(os.path.abspath('{}_ants{}'.format(fn, ext)))
+        subprocess.check_call(['antsApplyTransforms', '-d', '3',
+                               '-i', in_file, '-r', reference_image,
+                               '-o', out_files[-1],
+                               '-n', 'LanczosWindowedSinc',
+                               '-t', transform])
+    return out_files
+
+
+def benchmark_resampling(resolutions=(.7, .6, .5), ext='.nii'):
+    from resampling import resample_images
+
+    # (On all cores, like antsApplyTransforms)
+    methods = [('resample_images', functools.partial(resample_images, num_threads=os.cpu_count()))]
+
+    if shutil.which('antsApplyTransforms'):
+        methods.insert(0, ('antsApplyTransforms', _ants_apply_transforms))
+    else:
+        print('antsApplyTransforms not found, only benchmarking resample_images')
+
+    results = []
+
+    for resolution in resolutions:
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            _, images = measure(make_masking_data, tmp_dir, resolution, ext=ext)
+            in_files = [images['t1w'], images['inv2'], images['t1w']]
+            transform = make_transform(tmp_dir)
+
+            outputs = {}
+            for method, function in methods:
+                row, outputs[method] = measure(_run_in_dir,
+                                               os.path.join(tmp_dir, method),
+                                               function,
+                                               in_files=in_files,
+                                               transform=transform,
+                                               reference_image=images['t1w'])
+                row.update({'benchmark': 'resampling',
+                            'method': method,
+                            'resolution': resolution,
+                            'shape': get_shape(resolution),
+                            'n_channels': len(in_files)})
+                results.append(row)
+
+            if 'antsApplyTransforms' in outputs:
+                for reference, new in zip(outputs['antsApplyTransforms'], outputs['resample_images']):
+                    reference = nb.load(reference).get_fdata()
+                    new = nb.load(new).get_fdata()
+                    max_diff = np.abs(reference - new).max() / np.abs(reference).max()
+                    results[-1]['max_rel_diff'] = max(results[-1].get('max_rel_diff', 0), max_diff)
+                    if max_diff > 1e-3:
+                        print('WARNING: resample_images differs from antsApplyTransforms '
+                              'at {} mm (max rel. diff {})'.format(resolution, max_diff))
+
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    results = pd.DataFrame(results)
+
+    if 'antsApplyTransforms' in results.method.values:
+        ants_time = results[results.method == 'antsApplyTransforms'].set_index('resolution').wall_time_s
+        results['speedup'] = results.resolution.map(ants_time) / results.wall_time_s
+
+    return results
+
+
+def _read_images(in_files, n_reads=2):
+    # Most intermediates are read by a couple of downstream nodes
+    total = 0.
+    for _ in range(n_reads):
+        for fn in in_files:
+            total += nb.load(fn).get_fdata(dtype=np.float32).sum()
+    return total
+
+
+def _sink_images(in_files, path, method='write_gzip'):
+    from utils import image_to_bytes, write_gzip
+
+    os.makedirs(path)
+    for fn in in_files:
+        out_file = os.path.join(path, '{}.nii.gz'.format(os.path.basename(fn).split('.')[0]))
+        img = nb.load(fn)
+
+        if method == 'write_gzip':
+            write_gzip(image_to_bytes(img), out_file, num_threads=os.cpu_count())
+        else:
+            img.to_filename(out_file)
+
+
+def get_disk_usage(path):
+    # Disk footprint (MB) per file type of a directory, e.g., the working
+    # directory of one subject
+    usage = {}
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            if filename.endswith('.nii.gz'):
+                ext = '.nii.gz'
+            else:
+                ext = os.path.splitext(filename)[1]
+            usage[ext] = usage.get(ext, 0) + os.path.getsize(os.path.join(dirpath, filename)) / 1024. ** 2
+
+    return pd.Series(usage, name='disk_mb').sort_values(ascending=False)
+
+
+def benchmark_storage(resolutions=(.7, .6, .5)):
+    # I/O time and disk footprint of the intermediates of one (synthetic)
+    # subject, for both intermediate formats, and the cost of compressing
+    # them at the sink
+    from utils import intermediate_formats
+
+    results = []
+
+    for resolution in resolutions:
+        for output_type, ext in sorted(intermediate_formats.items()):
+            tmp_dir = tempfile.mkdtemp()
+            try:
+                row, images = measure(make_masking_data, tmp_dir, resolution, ext=ext)
+                in_files = sorted(images.values())
+                disk_mb = sum(os.path.getsize(fn) for fn in in_files) / 1024. ** 2
+
+                steps = [('write', row),
+                         ('read', measure(_read_images, in_files)[0])]
+
+                for method in ['write_gzip', 'nibabel']:
+                    steps.append(('sink_{}'.format(method),
+                                  measure(_sink_images, in_files,
+                                          os.path.join(tmp_dir, method), method=method)[0]))
+
+                for step, row in steps:
+                    row.update({'benchmark': 'storage',
+                                'intermediate_format': output_type,
+                                'step': step,
+                                'resolution': resolution,
+                                'shape': get_shape(resolution),
+                                'n_images': len(in_files),
+                                'disk_mb': disk_mb})
+                    results.append(row)
+            finally:
+                shutil.rmtree(tmp_dir)
+
+    return pd.DataFrame(results)
+
+
+def _measure_stage(results, stage, function, *args, **kwargs):
+    # Like measure, but a failing stage (e.g., a missing dependency) is
+    # reported instead of ending the suite
+    try:
+        row, result = measure(function, *args, **kwargs)
+    except Exception as e:
+        print(e)
+        row, result = {'wall_time_s': np.nan, 'peak_rss_mb': np.nan, 'error': str(e).splitlines()[-1]}, None
+
+    row['benchmark'] = stage
+    results.append(row)
+
+    return row, result
+
+
+def _run_workflow(wf, base_dir):
+    wf.base_dir = base_dir
+    wf.run()
+
+
+def benchmark_stages(resolutions=(1.5, 1.), ext=None):
+    # Every stage on a synthetic BIDS MP2RAGE/MEMP2RAGE dataset (see phantom.py)
+    from phantom import make_phantom_dataset, make_phantom_derivatives
+    from utils import get_mp2rage_pars, fit_mp2rage, mp2rage_maps
+    from combine_scans import init_transform_to_first_image_wf
+    from update_fs_brainmask import main as update_fs_brainmask
+
+    results = []
+
+    for resolution in resolutions:
+        shape = get_shape(resolution)
+        tmp_dir = tempfile.mkdtemp()
+
+        # Keep the caches (BIDS index, lookup tables, results) out of the way
+        old_environ = dict(os.environ)
+        os.environ['MP2RAGE_CACHE_DIR'] = os.path.join(tmp_dir, 'cache')
+        os.environ['MP2RAGE_RESULT_CACHE_GB'] = '0'
+
+        try:
+            sourcedata = os.path.join(tmp_dir, 'sourcedata')
+            derivatives = os.path.join(tmp_dir, 'derivatives')
+            n_results = len(results)
+
+            _measure_stage(results, 'make_phantom', make_phantom_dataset, sourcedata,
+                           subject='01', session='1', shape=shape, resolution=resolution)
+
+            pars = {}
+            for acquisition in ['mp2rage', 'memp2rage']:
+                # The first call builds the BIDS index, the second one uses it
+                for index in ['cold', 'warm']:
+                    row, pars[acquisition] = _measure_stage(results, 'get_mp2rage_pars',
+                                                            get_mp2rage_pars, sourcedata,
+                                                            '01', '1', acquisition)
+                    row.update({'acquisition': acquisition, 'index': index})
+
+            for acquisition in ['mp2rage', 'memp2rage']:
+                if pars[acquisition] is None:
+                    continue
+
+                maps = mp2rage_maps['MEMP2RAGE' if 'echo_times' in pars[acquisition] else 'MP2RAGE']
+                row, _ = _measure_stage(results, 'fit_mp2rage', _run_in_dir,
+                                        os.path.join(tmp_dir, 'fit_{}'.format(acquisition)),
+                                        fit_mp2rage, mp2rage_parameters=pars[acquisition],
+                                        return_images=maps, n_procs=os.cpu_count())
+                row.update({'acquisition': acquisition, 'n_maps': len(maps)})
+
+            # Averaging: the magnitude images of both acquisitions as the
+            # channels, with a small rigid transform between them
+            if pars['mp2rage'] is not None and pars['memp2rage'] is not None:
+                wf = init_transform_to_first_image_wf()
+                wf.inputs.inputnode.t1w = [pars['memp2rage']['inv1'], pars['mp2rage']['inv1']]
+                wf.inputs.inputnode.inv2 = [pars['memp2rage']['inv2'][0], pars['mp2rage']['inv2']]
+                wf.inputs.inputnode.t1map = [pars['memp2rage']['inv1ph'], pars['mp2rage']['inv1ph']]
+                wf.inputs.inputnode.transforms = [make_transform(tmp_dir)]
+                _measure_stage(results, 'averaging', _run_workflow, wf,
+                               os.path.join(tmp_dir, 'averaging'))
+
+            _measure_stage(results, 'make_phantom_derivatives', make_phantom_derivatives, derivatives,
+                           subject='01', session='1', shape=shape, resolution=resolution)
+            _measure_stage(results, 'update_fs_brainmask', update_fs_brainmask,
+                           sourcedata, derivatives, None, subject='01', session='1')
+
+            for row in results[n_results:]:
+                row.update({'resolution': resolution,
+                            'shape': shape})
+        finally:
+            os.environ.clear()
+            os.environ.update(old_environ)
+            shutil.rmtree(tmp_dir)
+
+    return pd.DataFrame(results)
+
+
+def _fit_cropped(mp2rage_parameters, return_images, padding=10., n_procs=None):
+    from utils import crop_mp2rage, fit_mp2rage
+
+    mp2rage_parameters, bbox = crop_mp2rage(mp2rage_parameters, padding=padding)
+    return fit_mp2rage(mp2rage_parameters, return_images=return_images, n_procs=n_procs), bbox
+
+
+def benchmark_crop(resolutions=(1.5, 1.), head_fraction=.7):
+    # Fitting all voxels of the FOV versus only those within the (padded)
+    # bounding box of the head, on a phantom with empty margins. The cropped
+    # maps are put back on the full grid (as the sinks do) and compared
+    from phantom import make_phantom_dataset
+    from utils import get_mp2rage_pars, fit_mp2rage, mp2rage_maps, uncrop_image
+
+    results = []
+
+    for resolution in resolutions:
+        shape = get_shape(resolution)
+        tmp_dir = tempfile.mkdtemp()
+
+        old_environ = dict(os.environ)
+        os.environ['MP2RAGE_CACHE_DIR'] = os.path.join(tmp_dir, 'cache')
+
+        try:
+            sourcedata = os.path.join(tmp_dir, 'sourcedata')
+            make_phantom_dataset(sourcedata, subject='01', session='1', shape=shape,
+                                 resolution=resolution, head_fraction=head_fraction)
+
+            for acquisition in ['mp2rage', 'memp2rage']:
+                pars = get_mp2rage_pars(sourcedata, '01', '1', acquisition)
+                maps = mp2rage_maps['MEMP2RAGE' if 'echo_times' in pars else 'MP2RAGE']
+
+                outputs = {}
+                for method, function in [('full', fit_mp2rage), ('crop', _fit_cropped)]:
+                    row, outputs[method] = _measure_stage(results, 'crop', _run_in_dir,
+                                                          os.path.join(tmp_dir, '{}_{}'.format(acquisition, method)),
+                                                          function, mp2rage_parameters=pars,
+                                                          return_images=maps, n_procs=os.cpu_count())
+                    row.update({'method': method,
+                                'acquisition': acquisition,
+                                'resolution': resolution,
+                                'shape': shape})
+
+                if outputs['full'] is None or outputs['crop'] is None:
+                    continue
+
+                cropped_fns, bbox = outputs['crop']
+                box = tuple(slice(start, stop) for start, stop in bbox)
+                row.update({'bbox_fraction': np.prod([stop - start for start, stop in bbox]) / float(np.prod(shape))})
+
+                for key, full_fn, cropped_fn in zip(maps, outputs['full'], cropped_fns):
+                    full = nb.load(full_fn)
+                    uncropped = uncrop_image(nb.load(cropped_fn), full).get_fdata()
+                    full = full.get_fdata()
+
+                    outside = np.ones(shape, dtype=bool)
+                    outside[box] = False
+
+                    row['max_diff_in_box_{}'.format(key)] = np.nanmax(np.abs(full[box] - uncropped[box]))
+
+                    if not np.array_equal(full[box], uncropped[box], equal_nan=True):
+                        print('WARNING: cropped {} differs within the box ({}, {} mm)'.format(key, acquisition,
+                                                                                             resolution))
+                    if uncropped[outside].any():
+                        print('WARNING: uncropped {} is not empty outside the box'.format(key))
+        finally:
+            os.environ.clear()
+            os.environ.update(old_environ)
+            shutil.rmtree(tmp_dir)
+
+    return pd.DataFrame(results)
+
+
+def benchmark_slabs(resolutions=(1.5,), slab_sizes=(None, 16, 4), n_procs=2):
+    # Fitting the whole volume as one slab (slab_size None) versus in
+    # smaller slabs by a pool of processes. The fit is voxelwise, so the
+    # maps have to be identical
+    from phantom import make_phantom_dataset
+    from utils import get_mp2rage_pars, fit_mp2rage, mp2rage_maps
+
+    results = []
+
+    for resolution in resolutions:
+        shape = get_shape(resolution)
+        tmp_dir = tempfile.mkdtemp()
+
+        old_environ = dict(os.environ)
+        os.environ['MP2RAGE_CACHE_DIR'] = os.path.join(tmp_dir, 'cache')
+
+        try:
+            sourcedata = os.path.join(tmp_dir, 'sourcedata')
+            make_phantom_dataset(sourcedata, subject='01', session='1', shape=shape,
+                                 resolution=resolution)
+
+            for acquisition in ['mp2rage', 'memp2rage']:
+                pars = get_mp2rage_pars(sourcedata, '01', '1', acquisition)
+                maps = mp2rage_maps['MEMP2RAGE' if 'echo_times' in pars else 'MP2RAGE']
+
+                outputs = {}
+                for slab_size in slab_sizes:
+                    row, outputs[slab_size] = _measure_stage(results, 'slabs', _run_in_dir,
+                                                             os.path.join(tmp_dir, '{}_{}'.format(acquisition,
+                                                                                                  slab_size)),
+                                                             fit_mp2rage, mp2rage_parameters=pars,
+                                                             return_images=maps,
+                                                             n_procs=1 if slab_size is None else n_procs,
+                                                             slab_size=slab_size or shape[2])
+                    row.update({'slab_size': slab_size or shape[2],
+                                'acquisition': acquisition,
+                                'resolution': resolution,
+                                'shape': shape})
+
+                    if slab_size is None or outputs[slab_size] is None or outputs.get(None) is None:
+                        continue
+
+                    for key, whole_fn, slab_fn in zip(maps, outputs[None], outputs[slab_size]):
+                        whole = nb.load(whole_fn).get_fdata()
+                        slabs = nb.load(slab_fn).get_fdata()
+
+                        row['max_diff_{}'.format(key)] = np.nanmax(np.abs(whole - slabs))
+
+                        if not np.array_equal(whole, slabs, equal_nan=True):
+                            print('WARNING: {} fitted in slabs of {} differs from the whole volume '
+                                  '({}, {} mm)'.format(key, slab_size, acquisition, resolution))
+        finally:
+            os.environ.clear()
+            os.environ.update(old_environ)
+            shutil.rmtree(tmp_dir)
+
+    return pd.DataFrame(results)
+
+
+def _n4_full(in_file, num_threads=1):
+    from nipype.interfaces import ants
+
+    n4 = ants.N4BiasFieldCorrection(input_image=in_file,
+                                    output_image='inv2_corrected.nii',
+                                    copy_header=True,
+                                    num_threads=num_threads)
+    return n4.run().outputs.output_image
+
+
+def _n4_fast(in_file, shrink_factor=4, num_threads=1):
+    from mask_mp2rage import init_fast_n4_wf
+
+    wf = init_fast_n4_wf(shrink_factor=shrink_factor, num_threads=num_threads)
+    wf.inputs.inputnode.input_image = in_file
+    wf.base_dir = os.getcwd()
+    wf.run()
+
+    return glob.glob(os.path.join(os.getcwd(), 'n4', 'apply_bias', 'inv2_corrected.nii*'))[0]
+
+
+def benchmark_n4(resolutions=(1., .7), shrink_factors=(2, 4)):
+    # The N4 node of the masking workflow versus the fast mode (bias field
+    # estimated on a downsampled, masked copy), on a phantom INV2 with a
+    # smooth, known bias field
+    from phantom import get_phantom, get_b1, simulate_mp2rage, protocols
+    from utils import get_head_mask
+
+    results = []
+
+    for resolution in resolutions:
+        shape = get_shape(resolution)
+        tmp_dir = tempfile.mkdtemp()
+
+        old_environ = dict(os.environ)
+        os.environ['MP2RAGE_CACHE_DIR'] = os.path.join(tmp_dir, 'cache')
+        os.environ['MP2RAGE_RESULT_CACHE_GB'] = '0'
+
+        try:
+            labels = get_phantom(shape, head_fraction=.8)
+            images = simulate_mp2rage(labels, protocols['mp2rage'], get_b1(shape), np.random.RandomState(0))
+            grid = np.ogrid[tuple(slice(0, s) for s in shape)]
+            bias = np.exp(.4 * sum((g - s / 2.) / s * w for g, s, w in zip(grid, shape, (1., -.5, .7))))
+
+            affine = np.diag([resolution, resolution, resolution, 1.])
+            inv2 = os.path.join(tmp_dir, 'inv2.nii')
+            nb.Nifti1Image((images[(2, 1)][0] * bias).astype(np.float32), affine).to_filename(inv2)
+            mask = get_head_mask(images[(2, 1)][0])
+
+            outputs = {}
+            for method, function, kwargs in [('full', _n4_full, {})] + \
+                                            [('fast_{}'.format(f), _n4_fast, {'shrink_factor': f})
+                                             for f in shrink_factors]:
+                row, outputs[method] = _measure_stage(results, 'n4', _run_in_dir,
+                                                      os.path.join(tmp_dir, method), function,
+                                                      in_file=inv2, **kwargs)
+                row.update({'method': method,
+                            'resolution': resolution,
+                            'shape': shape})
+
+                if outputs[method] is None or outputs.get('full') is None:
+                    continue
+
+                # Difference with the current node, relative to its mean
+                # within the head
+                reference = nb.load(outputs['full']).get_fdata()[mask]
+                corrected = nb.load(outputs[method]).get_fdata()[mask]
+                diff = np.abs(corrected - reference) / reference.mean()
+                row.update({'mean_rel_diff': diff.mean(),
+                            'max_rel_diff': diff.max(),
+                            'correlation': np.corrcoef(corrected, reference)[0, 1]})
+        finally:
+            os.environ.clear()
+            os.environ.update(old_environ)
+            shutil.rmtree(tmp_dir)
+
+    return pd.DataFrame(results)
+
+
+# Command lines whose start-up time is tracked: the CLI should only import
+# the heavy libraries for the command that runs
+startup_commands = {'help': ['mp2rage-preproc', '--help'],
+                    'stage_help': ['mp2rage-preproc', 'combine', '--help'],
+                    'daemon_status': ['mp2rage-preproc', 'daemon', '--queue-dir', '{tmp_dir}', 'status'],
+                    'import_stages': ['-c', 'import batch']}
+
+
+def get_revision():
+    import subprocess
+
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def benchmark_startup(resolutions=None, n_repeats=5, history_fn=None):
+    # Wall time of a fresh interpreter running each of startup_commands (the
+    # median of n_repeats). Every run is appended, with the git revision, to
+    # history_fn (default: <cache>/benchmarks/startup.csv), so start-up time
+    # can be compared between releases
+    import subprocess
+    from utils import get_cache_dir
+
+    src_dir = os.path.dirname(os.path.abspath(__file__))
+    tmp_dir = tempfile.mkdtemp()
+
+    if history_fn is None:
+        history_fn = os.path.join(get_cache_dir('benchmarks'), 'startup.csv')
+
+    results = []
+
+    try:
+        for name, command in startup_commands.items():
+            command = [sys.executable] + [arg.format(tmp_dir=tmp_dir) for arg in command]
+
+            wall_times = []
+            for _ in range(n_repeats):
+                t0 = time.time()
+                subprocess.run(command, cwd=src_dir, check=True,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                wall_times.append(time.time() - t0)
+
+            results.append({'command': name,
+                            'wall_time_s': np.median(wall_times),
+                            'min_wall_time_s': np.min(wall_times)})
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    results = pd.DataFrame(results)
+    results['revision'] = get_revision()
+    results['date'] = time.strftime('%Y-%m-%d %H:%M:%S')
+
+    if os.path.exists(history_fn):
+        history = pd.read_csv(history_fn)
+        previous = history[history.revision != results.revision[0]]
+
+        if len(previous) > 0:
+            previous = previous[previous.date == previous.date.max()].set_index('command')
+            results['previous_revision'] = previous.revision.iloc[0]
+            results['previous_wall_time_s'] = results.command.map(previous.wall_time_s)
+
+        history = pd.concat([history, results[history.columns]], ignore_index=True)
+    else:
+        history = results
+
+    history.to_csv(history_fn, index=False)
+
+    return results
+
+
+benchmarks = {'mask_t1w': benchmark_mask_t1w,
+              'resampling': benchmark_resampling,
+              'storage': benchmark_storage,
+              'stages': benchmark_stages,
+              'crop': benchmark_crop,
+              'slabs': benchmark_slabs,
+              'n4': benchmark_n4,
+              'startup': benchmark_startup}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("benchmarks",
+                        nargs='*',
+                        default=sorted(benchmarks.keys()),
+                        help="benchmarks to run (default: all)")
+    parser.add_argument('--resolutions',
+                        nargs='+',
+                        type=float,
+                        default=None,
+                        help="isotropic resolutions (mm) of the synthetic data "
+                             "(default: that of each benchmark)")
+    parser.add_argument('--workflow-dir',
+                        default=None,
+                        help="also report the disk footprint of this working directory "
+                             "(e.g., /workflow_folders/mp2rage_batch/sub_01)")
+
+    args = parser.parse_args()
+
+    kwargs = {'resolutions': args.resolutions} if args.resolutions else {}
+
+    for benchmark in args.benchmarks:
+        print(benchmarks[benchmark](**kwargs))
+
+    if args.workflow_dir:
+        print(get_disk_usage(args.workflow_dir))
@@ -0,0 +1,199 @@
+import os
+import re
+import json
+
+mp2rage_reg = re.compile('.*/sub-(?P<subject>.+)_ses-(?P<session>.+)_acq-(?P<acquisition>.+)_inv-(?P<inv>[0-9]+)(_echo-(?P<echo>[0-9]+))?(_part-(?P<part>.+))?_MPRAGE.(?P<extension>nii|nii\.gz|json)')
+
+bids_entities = {'sub': 'subject',
+                 'ses': 'session',
+                 'acq': 'acquisition',
+                 'inv': 'inv',
+                 'echo': 'echo',
+                 'part': 'part',
+                 'run': 'run'}
+
+columns = ['path', 'dirname', 'mtime', 'size',
+           'subject', 'session', 'acquisition', 'inv', 'echo', 'part', 'run',
+           'suffix', 'extension', 'metadata']
+
+extensions = ('.nii', '.nii.gz', '.json')
+
+# The index of every sourcedata folder used in this process (and thread:
+# connections cannot be shared with forked processes or other threads)
+_indices = {}
+
+
+class BIDSIndex(object):
+
+    def __init__(self, sourcedata, db_path=None):
+        from utils import get_cache_dir, connect_sqlite
+
+        self.sourcedata = os.path.abspath(sourcedata)
+
+        if db_path is None:
+            db_path = os.path.join(get_cache_dir('bids_index'),
+                                   '{}.sqlite'.format(self.sourcedata.strip(os.sep).replace(os.sep, '_')))
+
+        self.db_path = db_path
+        self.connection = connect_sqlite(db_path)
+        self.connection.create_function('REGEXP', 2, _regexp)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS files ('
+                                'path TEXT PRIMARY KEY, dirname TEXT, mtime REAL, size INTEGER, '
+                                'subject TEXT, session TEXT, acquisition TEXT, inv TEXT, echo TEXT, '
+                                'part TEXT, run TEXT, suffix TEXT, extension TEXT, metadata TEXT)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS files_entities '
+                                'ON files (subject, session, suffix)')
+        self.connection.commit()
+
+    def update(self, subject=None):
+        if subject is None:
+            root = self.sourcedata
+        else:
+            root = os.path.join(self.sourcedata, 'sub-{}'.format(subject))
+
+        known = {path: (mtime, size) for path, mtime, size in
+                 self.connection.execute('SELECT path, mtime, size FROM files '
+                                         "WHERE path = ? OR path LIKE ? ESCAPE '\\'",
+                                         (root, _escape_like(root + os.sep) + '%', ))}
+
+        found = set()
+        n_updated = 0
+
+        for dirpath, dirnames, filenames in os.walk(root):
+            # Skip hidden folders and nested derivatives, just like pybids
+            dirnames[:] = [d for d in dirnames if not d.startswith('.') and d != 'derivatives']
+
+            for filename in filenames:
+                if not filename.startswith('sub-') or not filename.endswith(extensions):
+                    continue
+
+                path = os.path.join(dirpath, filename)
+                stat = os.stat(path)
+                found.add(path)
+
+                if known.get(path) == (stat.st_mtime, stat.st_size):
+                    continue
+
+                row = parse_file(path)
+                row['mtime'] = stat.st_mtime
+                row['size'] = stat.st_size
+
+                self.connection.execute('INSERT OR REPLACE INTO files ({}) VALUES ({})'.format(', '.join(columns),
+                                                                                              ', '.join('?' * len(columns))),
+                                        [row[key] for key in columns])
+                n_updated += 1
+
+        removed = set(known) - found
+        self.connection.executemany('DELETE FROM files WHERE path = ?',
+                                    [(path,) for path in removed])
+        self.connection.commit()
+
+        if n_updated or removed:
+            print('Updated {} and removed {} files in BIDS index {}'.format(n_updated,
+                                                                             len(removed),
+                                                                             self.db_path))
+
+    def get(self, **entities):
+        query, values = _get_query(entities)
+        # Sorted by path, like pybids, so that lists of echoes are in order
+        cursor = self.connection.execute('SELECT {} FROM files{} ORDER BY path'.format(', '.join(columns), query),
+                                         values)
+
+        result = []
+        for row in cursor:
+            row = dict(zip(columns, row))
+            row['metadata'] = json.loads(row['metadata']) if row['metadata'] else {}
+            result.append(row)
+
+        return result
+
+    def get_entities(self, target, **entities):
+        if target not in columns:
+            raise Exception('Unknown entity {}'.format(target))
+
+        query, values = _get_query(entities)
+        cursor = self.connection.execute('SELECT DISTINCT {target} FROM files{query} '
+                                         'ORDER BY {target}'.format(target=target,
+                                                                    query=query),
+                                         values)
+
+        return [row[0] for row in cursor if row[0] is not None]
+
+
+def get_bids_index(sourcedata):
+    # One BIDSIndex (and database connection) per sourcedata folder, process
+    # and thread, instead of one per call
+    import threading
+
+    key = (os.path.abspath(sourcedata), os.getpid(), threading.get_ident())
+    if key not in _indices:
+        _indices[key] = BIDSIndex(sourcedata)
+
+    return _indices[key]
+
+
+def parse_file(path):
+    row = {key: None for key in columns}
+    row['path'] = path
+    row['dirname'] = os.path.dirname(path)
+
+    match = mp2rage_reg.match(path)
+
+    if match:
+        row.update(match.groupdict())
+        row['suffix'] = 'MPRAGE'
+    else:
+        filename = os.path.basename(path)
+        stem, row['extension'] = filename.split('.', 1)
+        parts = stem.split('_')
+        row['suffix'] = parts[-1]
+
+        for part in parts[:-1]:
+            if '-' in part:
+                key, value = part.split('-', 1)
+                if key in bids_entities:
+                    row[bids_entities[key]] = value
+
+    if row['extension'] == 'json':
+        with open(path) as f:
+            row['metadata'] = f.read()
+
+    return row
+
+
+def _get_query(entities):
+    conditions = []
+    values = []
+
+    for key, value in entities.items():
+        if key not in columns:
+            raise Exception('Unknown entity {}'.format(key))
+
+        if value is None:
+            continue
+
+        if key in ('path', 'dirname'):
+            conditions.append('{} = ?'.format(key))
+            values.append(value)
+        elif type(value) is list:
+            conditions.append('{} IN ({})'.format(key, ', '.join('?' * len(value))))
+            values += [str(v) for v in value]
+        else:
+            # Like pybids, entities are matched as regular expressions
+            conditions.append('{} REGEXP ?'.format(key))
+            values.append(str(value))
+
+    if len(conditions) == 0:
+        return '', values
+
+    return ' WHERE ' + ' AND '.join(conditions), values
+
+
+def _regexp(pattern, value):
+    if value is None:
+        return False
+    return re.match('(?:{})$'.format(pattern), value) is not None
+
+
+def _escape_like(s):
+    return s.replace('%', '\\%').replace('_', '\\_')
@@ -0,0 +1,403 @@
+import argparse
+import os
+import sys
+import json
+from utils import STAGES, intermediate_formats
+
+# The stage modules import nipype, pandas, pybids, pymp2rage etc. at the top,
+# so they are only imported once their command runs; `--help`, `submit` and
+# `status` do not pay for them
+
+
+def get_default_paths():
+    # Where the docker-compose setup mounts the data, unless set otherwise
+    return {'sourcedata': os.environ.get('MP2RAGE_SOURCEDATA', '/sourcedata'),
+            'derivatives': os.environ.get('MP2RAGE_DERIVATIVES', '/derivatives'),
+            'tmp_dir': os.environ.get('MP2RAGE_TMP_DIR', '/workflow_folders')}
+
+
+def run_combine(args):
+    from combine_scans import main
+    main(args.sourcedata,
+         args.derivatives,
+         tmp_dir=args.tmp_dir,
+         subject=args.subject,
+         session=args.session,
+         crop=args.crop,
+         num_threads=args.num_threads)
+
+
+def run_mask(args):
+    from mask_mp2rage import main
+    main(args.sourcedata,
+         args.derivatives,
+         tmp_dir=args.tmp_dir,
+         subject=args.subject,
+         num_threads=args.num_threads,
+         session=args.session,
+         crop=args.crop,
+         n4_fast=args.n4_fast)
+
+
+def run_qmri(args):
+    from make_qmri_maps import main
+    main(args.sourcedata,
+         args.derivatives,
+         tmp_dir=args.tmp_dir,
+         subject=args.subject,
+         session=args.session,
+         acquisition=args.acquisition,
+         num_threads=args.num_threads)
+
+
+def run_fs_brainmask(args):
+    from update_fs_brainmask import main
+    main(args.sourcedata,
+         args.derivatives,
+         tmp_dir=args.tmp_dir,
+         subject=args.subject,
+         session=args.session)
+
+
+def run_pipeline(args):
+    from pipeline import main
+    main(args.sourcedata,
+         args.derivatives,
+         tmp_dir=args.tmp_dir,
+         subject=args.subject,
+         session=args.session,
+         stages=args.stages,
+         n_procs=args.n_procs,
+         crop=args.crop,
+         n4_fast=args.n4_fast,
+         memory_gb=args.mem_gb)
+
+
+def run_batch(args):
+    from batch import main
+    main(args.sourcedata,
+         args.derivatives,
+         tmp_dir=args.tmp_dir,
+         subjects=args.subjects,
+         sessions=args.sessions,
+         bids_filters=json.loads(args.bids_filter) if args.bids_filter else None,
+         stages=args.stages,
+         n_procs=args.n_procs,
+         intermediate_format=args.intermediate_format,
+         crop=args.crop,
+         n4_fast=args.n4_fast,
+         job_dir=args.job_dir,
+         local_workers=args.local_workers,
+         memory_gb=args.mem_gb)
+
+
+def run_plan(args):
+    from batch import get_subject_sessions, main
+    from provenance import plan, get_stale_stages, format_plan
+
+    subject_sessions = get_subject_sessions(args.sourcedata,
+                                            subjects=args.subjects,
+                                            sessions=args.sessions)
+    entries = plan(args.sourcedata,
+                   args.derivatives,
+                   subject_sessions,
+                   stages=args.stages,
+                   crop=args.crop,
+                   n4_fast=args.n4_fast)
+    print(format_plan(entries))
+
+    subject_stages = get_stale_stages(entries)
+
+    if args.run and subject_stages:
+        main(args.sourcedata,
+             args.derivatives,
+             tmp_dir=args.tmp_dir,
+             n_procs=args.n_procs,
+             crop=args.crop,
+             n4_fast=args.n4_fast,
+             subject_stages=subject_stages,
+             memory_gb=args.mem_gb)
+
+
+def run_worker(args):
+    from sharedfs import SharedFSWorker
+    SharedFSWorker(args.job_dir,
+                   n_procs=args.n_procs,
+                   mem_gb=args.mem_gb,
+                   worker_id=args.worker_id,
+                   heartbeat_timeout=args.heartbeat_timeout,
+                   idle_timeout=args.idle_timeout).serve()
+
+
+def run_daemon(args):
+    import daemon
+
+    if args.daemon_command == 'serve':
+        daemon.PreprocessingDaemon(args.sourcedata,
+                                   args.derivatives,
+                                   tmp_dir=args.tmp_dir,
+                                   queue_dir=args.queue_dir,
+                                   n_workers=args.n_workers).serve()
+    elif args.daemon_command == 'submit':
+        job_fn = daemon.submit(args.stage,
+                               args.subject,
+                               session=args.session,
+                               queue_dir=args.queue_dir,
+                               crop=args.crop,
+                               n4_fast=args.n4_fast,
+                               n_procs=args.n_procs)
+        print(job_fn)
+
+        if args.wait:
+            job = daemon.wait(job_fn)
+            print('{}: waited {:.2f}s, ran {:.1f}s (exit code {})'.format(job['id'],
+                                                                         job['latency_s'],
+                                                                         job['duration_s'],
+                                                                         job['exitcode']))
+            sys.exit(0 if job['exitcode'] == 0 else 1)
+    else:
+        print(json.dumps(daemon.get_status(args.queue_dir), indent=2))
+
+
+def _add_subject_arguments(parser):
+    parser.add_argument("subject",
+                        type=str,
+                        help="subject to process")
+    parser.add_argument('session',
+                        nargs='?',
+                        default=None,
+                        help="session to process (default: all sessions)")
+
+
+def _add_crop_argument(parser):
+    parser.add_argument('--crop',
+                        action='store_true',
+                        help="process only the (padded) bounding box of the head; "
+                             "derivatives keep the full grid")
+
+
+def _add_n4_fast_argument(parser):
+    parser.add_argument('--n4-fast',
+                        action='store_true',
+                        help="estimate the bias field of INV2 at a 4x lower resolution")
+
+
+def _add_num_threads_argument(parser):
+    parser.add_argument('--num-threads',
+                        type=int,
+                        default=8,
+                        help="number of threads the nodes (N4, registration, the fits, ...) "
+                             "may use")
+
+
+def _add_mem_gb_argument(parser, help="memory (GB) the nodes running at the same time may use "
+                                           "together (default: 90%% of this machine)"):
+    parser.add_argument('--mem-gb',
+                        type=float,
+                        default=None,
+                        help=help)
+
+
+def get_parser():
+    paths = get_default_paths()
+
+    parser = argparse.ArgumentParser(prog='mp2rage-preproc')
+    parser.add_argument('--sourcedata',
+                        default=paths['sourcedata'],
+                        help="BIDS folder (default: $MP2RAGE_SOURCEDATA or /sourcedata)")
+    parser.add_argument('--derivatives',
+                        default=paths['derivatives'],
+                        help="derivatives folder (default: $MP2RAGE_DERIVATIVES or /derivatives)")
+    parser.add_argument('--tmp-dir',
+                        default=paths['tmp_dir'],
+                        help="folder for the nipype working directories "
+                             "(default: $MP2RAGE_TMP_DIR or /workflow_folders)")
+    subparsers = parser.add_subparsers(dest='command', metavar='command')
+    subparsers.required = True
+
+    combine = subparsers.add_parser('combine',
+                                    help="fit and combine the MP2RAGE and MEMP2RAGE of a subject")
+    _add_subject_arguments(combine)
+    _add_crop_argument(combine)
+    _add_num_threads_argument(combine)
+    combine.set_defaults(function=run_combine)
+
+    mask = subparsers.add_parser('mask',
+                                 help="make a brain mask and the fmriprep inputs of a subject")
+    _add_subject_arguments(mask)
+    _add_crop_argument(mask)
+    _add_n4_fast_argument(mask)
+    _add_num_threads_argument(mask)
+    mask.set_defaults(function=run_mask)
+
+    qmri = subparsers.add_parser('qmri',
+                                 help="make T1-, T2*- and S0-maps of a subject")
+    _add_subject_arguments(qmri)
+    qmri.add_argument('--acquisition',
+                      default='memp2rage',
+                      help="acquisition to process")
+    _add_num_threads_argument(qmri)
+    qmri.set_defaults(function=run_qmri)
+
+    fs_brainmask = subparsers.add_parser('fs-brainmask',
+                                         help="apply the manual mask edits to Freesurfer's brainmask")
+    _add_subject_arguments(fs_brainmask)
+    fs_brainmask.set_defaults(function=run_fs_brainmask)
+
+    pipeline = subparsers.add_parser('pipeline',
+                                     help="run several stages of a subject as one graph")
+    _add_subject_arguments(pipeline)
+    pipeline.add_argument('--stages',
+                          nargs='+',
+                          default=['combine', 'qmri', 'mask'],
+                          choices=STAGES,
+                          help="stages to run; masking and qMRI get their inputs "
+                               "straight from combining")
+    pipeline.add_argument('--n-procs',
+                          type=int,
+                          default=4,
+                          help="number of processes to run in parallel")
+    _add_crop_argument(pipeline)
+    _add_n4_fast_argument(pipeline)
+    _add_mem_gb_argument(pipeline)
+    pipeline.set_defaults(function=run_pipeline)
+
+    batch = subparsers.add_parser('batch',
+                                  help="run stages for many subjects in one workflow")
+    batch.add_argument('--subjects',
+                       nargs='+',
+                       default=None,
+                       help="subjects to process (default: all subjects with MPRAGE-data)")
+    batch.add_argument('--sessions',
+                       nargs='+',
+                       default=None,
+                       help="sessions to process (default: all sessions)")
+    batch.add_argument('--bids-filter',
+                       default=None,
+                       help="JSON-dictionary of BIDS entities to select subjects/sessions, "
+                            "e.g. '{\"acquisition\": \"memp2rage\"}'")
+    batch.add_argument('--stages',
+                       nargs='+',
+                       default=['combine'],
+                       choices=STAGES,
+                       help="stages to run for every subject")
+    batch.add_argument('--n-procs',
+                       type=int,
+                       default=4,
+                       help="number of processes to run in parallel")
+    batch.add_argument('--intermediate-format',
+                       default=None,
+                       choices=sorted(intermediate_formats),
+                       help="format of the files in the working directories "
+                            "(default: NIFTI, i.e., uncompressed); derivatives "
+                            "are always compressed")
+    batch.add_argument('--job-dir',
+                       default=None,
+                       help="run the nodes on workers (`mp2rage-preproc worker`) that share this "
+                            "job folder and --tmp-dir, --n-procs each (default: "
+                            "$MP2RAGE_JOB_DIR or /cache/jobs, with --local-workers)")
+    batch.add_argument('--local-workers',
+                       type=int,
+                       default=0,
+                       help="start this many workers on this machine for the run")
+    _add_crop_argument(batch)
+    _add_n4_fast_argument(batch)
+    _add_mem_gb_argument(batch)
+    batch.set_defaults(function=run_batch)
+
+    worker = subparsers.add_parser('worker',
+                                   help="run nodes from a shared job folder (see batch --job-dir)")
+    worker.add_argument('--job-dir',
+                        default=None,
+                        help="job folder (default: $MP2RAGE_JOB_DIR or /cache/jobs)")
+    worker.add_argument('--n-procs',
+                        type=int,
+                        default=1,
+                        help="number of processes (by the n_procs of the nodes) to run at once")
+    _add_mem_gb_argument(worker, help="memory (GB) of the nodes (by their mem_gb) to run at once "
+                                      "(default: 90%% of this machine)")
+    worker.add_argument('--worker-id',
+                        default=None,
+                        help="name in the job records (default: <host>_<pid>)")
+    worker.add_argument('--heartbeat-timeout',
+                        type=float,
+                        default=60.,
+                        help="requeue running jobs without a heartbeat for this many seconds")
+    worker.add_argument('--idle-timeout',
+                        type=float,
+                        default=0.,
+                        help="stop after this many seconds without jobs (default: never)")
+    worker.set_defaults(function=run_worker)
+
+    plan = subparsers.add_parser('plan',
+                                 help="list the stages (and nodes) whose derivatives are out of "
+                                      "date with the sourcedata, manual masks and parameters")
+    plan.add_argument('--subjects',
+                      nargs='+',
+                      default=None,
+                      help="subjects to check (default: all subjects with MPRAGE-data)")
+    plan.add_argument('--sessions',
+                      nargs='+',
+                      default=None,
+                      help="sessions to check (default: all sessions)")
+    plan.add_argument('--stages',
+                      nargs='+',
+                      default=['combine', 'qmri', 'mask'],
+                      choices=STAGES,
+                      help="stages to check")
+    plan.add_argument('--run',
+                      action='store_true',
+                      help="rerun the stages that are out of date (in one batch workflow)")
+    plan.add_argument('--n-procs',
+                      type=int,
+                      default=4,
+                      help="number of processes to run in parallel")
+    _add_crop_argument(plan)
+    _add_n4_fast_argument(plan)
+    _add_mem_gb_argument(plan)
+    plan.set_defaults(function=run_plan)
+
+    daemon = subparsers.add_parser('daemon',
+                                   help="run or use the warm preprocessing daemon")
+    daemon.add_argument('--queue-dir',
+                        default=None,
+                        help="queue folder (default: $MP2RAGE_QUEUE_DIR or /cache/queue)")
+    daemon.set_defaults(function=run_daemon)
+    daemon_commands = daemon.add_subparsers(dest='daemon_command', metavar='daemon_command')
+    daemon_commands.required = True
+
+    serve = daemon_commands.add_parser('serve',
+                                       help="run the daemon")
+    serve.add_argument('--n-workers',
+                       type=int,
+                       default=2,
+                       help="number of jobs to run at the same time")
+
+    submit = daemon_commands.add_parser('submit',
+                                        help="queue a stage for a subject")
+    submit.add_argument('stage',
+                        choices=STAGES)
+    _add_subject_arguments(submit)
+    _add_crop_argument(submit)
+    _add_n4_fast_argument(submit)
+    submit.add_argument('--n-procs',
+                        type=int,
+                        default=1,
+                        help="number of processes for this job")
+    submit.add_argument('--wait',
+                        action='store_true',
+                        help="wait for the job to finish")
+
+    daemon_commands.add_parser('status',
+                               help="print queue depth and latencies")
+
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    args.function(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,49 +1,52 @@
-import argparse
-from fmriprep.interfaces import DerivativesDataSink
-from bids import BIDSLayout
-import re
-import pandas as pd
 import os
-import glob
-import json
-import numpy as np
-import pymp2rage
+import sys
 import nipype.pipeline.engine as pe
 import nipype.interfaces.utility as niu
-from nipype.interfaces import fsl
-from nipype.interfaces import ants
-from nipype.interfaces.c3 import C3dAffineTool
-from nipype.interfaces.image import Reorient
-from utils import _pickone, get_mp2rage_pars, fit_mp2rage, get_inv
+from utils import (_pickone, _pickfirst, get_mp2rage_pars, get_mp2rage_fit, get_inv,
+                   average_images, transpose_lists, sink_derivatives,
+                   crop_mp2rage)
+from resampling import resample_images
+from registration import register_rigid, pyramid
+from result_cache import cache_interface
+from profiling import run_workflow
+from resources import set_subject_resources
+from bids_index import BIDSIndex
+from provenance import init_provenance_node
 
 def main(sourcedata,
          derivatives,
          tmp_dir,
          subject,
-         session=None):
+         session=None,
+         crop=False,
+         num_threads=8):
 
     if session is None:
         session = '.*'
 
+    BIDSIndex(sourcedata).update(subject=subject)
+
     wf_name = 'combine_mp2rages_{}'.format(subject)
 
     wf = init_combine_mp2rage_wf(name=wf_name,
                                  sourcedata=sourcedata,
-                                 derivatives=derivatives)
-    wf.base_dir = '/workflow_folders'
-
-
+                                 derivatives=derivatives,
+                                 crop=crop)
+    wf.base_dir = tmp_dir
 
     wf.inputs.inputnode.subject = subject
     wf.inputs.inputnode.session = session
     wf.inputs.inputnode.acquisition = ['memp2rage', 'mp2rage']
 
-    wf.run()
+    set_subject_resources(wf, sourcedata, subject, session, num_threads=num_threads)
+
+    run_workflow(wf, profile_dir=os.path.join(derivatives, 'profiles'))
 
 def init_combine_mp2rage_wf(sourcedata,
                             derivatives,
                             name='combine_mp2rages',
-                            n_mp2rages=2):
+                            n_mp2rages=2,
+                            crop=False):
 
     wf = pe.Workflow(name=name)
 
@@ -73,13 +76,31 @@ def init_combine_mp2rage_wf(sourcedata,
                   ('session', 'session'),
                   ('acquisition', 'acquisition')])])
 
-    make_t1w = pe.MapNode(niu.Function(function=fit_mp2rage,
-                                       input_names=['mp2rage_parameters'],
+    # Optionally, all images of every acquisition are cropped to the head
+    # (in INV2) and only put back on the full grid by ds_derivatives
+    if crop:
+        crop_head = pe.MapNode(niu.Function(function=crop_mp2rage,
+                                            input_names=['mp2rage_parameters'],
+                                            output_names=['mp2rage_parameters', 'bbox']),
+                               iterfield=['mp2rage_parameters'],
+                               name='crop_head')
+        wf.connect(get_parameters, 'mp2rage_parameters', crop_head, 'mp2rage_parameters')
+        fit_parameters = crop_head
+    else:
+        fit_parameters = get_parameters
+
+    make_t1w = pe.MapNode(niu.Function(function=get_mp2rage_fit,
+                                       input_names=['mp2rage_parameters',
+                                                    'return_images',
+                                                    'fits_dir',
+                                                    'n_procs',
+                                                    'mem_gb'],
                                        output_names=['t1w_uni', 't1map']),
                           iterfield=['mp2rage_parameters'],
                           name='make_t1w')
+    make_t1w.inputs.return_images = ['t1w_uni', 't1map']
 
-    wf.connect([ (get_parameters, make_t1w, [('mp2rage_parameters', 'mp2rage_parameters')]) ])
+    wf.connect([ (fit_parameters, make_t1w, [('mp2rage_parameters', 'mp2rage_parameters')]) ])
 
     get_first_inversion = pe.MapNode(niu.Function(function=get_inv,
                                                   input_names=['mp2rage_parameters', 'inv', 'echo'], output_names='inv1'),
@@ -88,38 +109,35 @@ def init_combine_mp2rage_wf(sourcedata,
 
     get_first_inversion.inputs.inv = 1
     get_first_inversion.inputs.echo = 1
-    wf.connect(get_parameters, 'mp2rage_parameters', get_first_inversion, 'mp2rage_parameters')
+    wf.connect(fit_parameters, 'mp2rage_parameters', get_first_inversion, 'mp2rage_parameters')
+
+    # The derivatives are named after (and uncropped to) the original images
+    if crop:
+        get_source_inversion = pe.MapNode(niu.Function(function=get_inv,
+                                                       input_names=['mp2rage_parameters', 'inv', 'echo'],
+                                                       output_names='inv1'),
+                                          iterfield=['mp2rage_parameters'],
+                                          name='get_source_inversion')
+        get_source_inversion.inputs.inv = 1
+        get_source_inversion.inputs.echo = 1
+        wf.connect(get_parameters, 'mp2rage_parameters', get_source_inversion, 'mp2rage_parameters')
+    else:
+        get_source_inversion = get_first_inversion
 
     split = pe.Node(niu.Split(splits=[1, n_mp2rages-1]),
                     name='split')
     wf.connect(get_first_inversion, 'inv1', split, 'inlist')
 
-    flirt = pe.MapNode(fsl.FLIRT(dof=6),
-                       iterfield=['in_file'],
-                       name='flirt')
-
-
-
-    wf.connect(split, ('out1', _pickone), flirt, 'reference')
-    wf.connect(split, 'out2', flirt, 'in_file')
-
-    convert2itk = pe.MapNode(C3dAffineTool(), iterfield=['source_file',
-                                                         'transform_file'],
-                             name='convert2itk')
-    convert2itk.inputs.fsl2ras = True
-    convert2itk.inputs.itk_transform = True
-
-
-    wf.connect(flirt, 'out_matrix_file', convert2itk, 'transform_file')
-    wf.connect(split, ('out1', _pickone), convert2itk, 'reference_file')
-    wf.connect(split, 'out2', convert2itk, 'source_file')
-
-    transform_t1w_wf = init_transform_to_first_image_wf('transforms_t1w',
-                                                        n_images=n_mp2rages)
-
-    wf.connect(make_t1w, 't1w_uni', transform_t1w_wf, 'inputnode.in_files')
-    wf.connect(convert2itk, 'itk_transform', transform_t1w_wf, 'inputnode.transforms')
+    # Rigid registration (coarse to fine) of all other acquisitions to the
+    # first one at once, straight to ITK transforms; pairs that were
+    # registered before come from the transform cache
+    register = pe.Node(niu.Function(function=register_rigid,
+                                    input_names=['in_files', 'reference', 'num_threads'],
+                                    output_names=['transforms']),
+                       name='register')
 
+    wf.connect(split, ('out1', _pickone), register, 'reference')
+    wf.connect(split, 'out2', register, 'in_files')
 
     get_second_inversion = pe.MapNode(niu.Function(function=get_inv, 
                                                    input_names=['mp2rage_parameters', 'inv', 'echo'],
@@ -127,142 +145,154 @@ def init_combine_mp2rage_wf(sourcedata,
                                      iterfield=['mp2rage_parameters'],
                                      name='get_second_inversion')
     get_second_inversion.inputs.inv = 2
+    wf.connect(fit_parameters, 'mp2rage_parameters', get_second_inversion, 'mp2rage_parameters')
 
-    transform_inv2_wf = init_transform_to_first_image_wf('transforms_inv2',
-                                                        n_images=n_mp2rages)
-    wf.connect(get_parameters, 'mp2rage_parameters', get_second_inversion, 'mp2rage_parameters')
-    wf.connect(get_second_inversion, 'inv2', transform_inv2_wf, 'inputnode.in_files')
-    wf.connect(convert2itk, 'itk_transform', transform_inv2_wf, 'inputnode.transforms')
-
-
-    transform_t1map_wf = init_transform_to_first_image_wf('transform_t1map',
-                                                          n_images=n_mp2rages)
-
-
-    wf.connect(make_t1w, 't1map', transform_t1map_wf, 'inputnode.in_files')
-    wf.connect(convert2itk, 'itk_transform', transform_t1map_wf, 'inputnode.transforms')
-
-    ds_t1w = pe.MapNode(DerivativesDataSink(base_directory=derivatives,
-                                         keep_dtype=False,
-                                         out_path_base='t1w',
-                                         suffix='T1w'),
-                        iterfield=['in_file', 'source_file'],
-                     name='ds_t1w')
-
-    reorient_t1w = pe.MapNode(Reorient(),
-                              iterfield=['in_file'],
-                           name='reorient_t1w')
-
-    wf.connect(make_t1w, 't1w_uni', reorient_t1w, 'in_file')
-    wf.connect(reorient_t1w, 'out_file', ds_t1w, 'in_file')
-    wf.connect(get_first_inversion, 'inv1', ds_t1w, 'source_file')
-
-    ds_t1map = pe.MapNode(DerivativesDataSink(base_directory=derivatives,
-                                         keep_dtype=False,
-                                         out_path_base='t1map',
-                                         suffix='T1w'),
-                        iterfield=['in_file', 'source_file'],
-                     name='ds_t1map')
-
-    reorient_t1map = pe.MapNode(Reorient(),
-                              iterfield=['in_file'],
-                           name='reorient_t1map')
-
-    wf.connect(make_t1w, 't1map', reorient_t1map, 'in_file')
-    wf.connect(reorient_t1map, 'out_file', ds_t1map, 'in_file')
-    wf.connect(get_first_inversion, 'inv1', ds_t1map, 'source_file')
-
-    ds_t1w_average = pe.Node(DerivativesDataSink(base_directory=derivatives,
-                                         keep_dtype=False,
-                                         out_path_base='averaged_mp2rages',
-                                         suffix='T1w',
-                                         space='average'),
-                                         name='ds_t1w_average')
-
+    transform_wf = init_transform_to_first_image_wf('transform_images',
+                                                    n_images=n_mp2rages,
+                                                    channels=['t1w', 'inv2', 't1map'])
 
+    wf.connect(make_t1w, 't1w_uni', transform_wf, 'inputnode.t1w')
+    wf.connect(get_second_inversion, 'inv2', transform_wf, 'inputnode.inv2')
+    wf.connect(make_t1w, 't1map', transform_wf, 'inputnode.t1map')
+    wf.connect(register, 'transforms', transform_wf, 'inputnode.transforms')
 
     rename = pe.Node(niu.Rename(use_fullpath=True), name='rename')
     rename.inputs.format_string = '%(path)s/sub-%(subject_id)s_ses-%(session)s_MPRAGE.nii.gz'
     rename.inputs.parse_string = '(?P<path>.+)/sub-(?P<subject_id>.+)_ses-(?P<session>.+)_acq-.+_MPRAGE.nii(.gz)?'
 
-    wf.connect(get_first_inversion, ('inv1', _pickone), rename, 'in_file')
-    reorient_average_t1w = pe.Node(Reorient(),
-                           name='reorient_average_t1w')
-    wf.connect(transform_t1w_wf, 'outputnode.mean_image', reorient_average_t1w, 'in_file')
-    wf.connect(reorient_average_t1w, 'out_file', ds_t1w_average, 'in_file')
-    wf.connect(rename, 'out_file', ds_t1w_average, 'source_file')
-
-
-    ds_t1map_average = pe.Node(DerivativesDataSink(base_directory=derivatives,
-                                         keep_dtype=False,
-                                         out_path_base='averaged_mp2rages',
-                                         suffix='T1map',
-                                         space='average'),
-                                         name='ds_t1map_average')
-
-
-    reorient_t1map_average = pe.Node(Reorient(),
-                           name='reorient_t1map_average')
-    wf.connect(rename, 'out_file', ds_t1map_average, 'source_file')
-    wf.connect(transform_t1map_wf, 'outputnode.mean_image', reorient_t1map_average, 'in_file')
-    wf.connect(reorient_t1map_average, 'out_file', ds_t1map_average, 'in_file')
-
-    ds_inv2 = pe.Node(DerivativesDataSink(base_directory=derivatives,
-                                         keep_dtype=False,
-                                         out_path_base='averaged_mp2rages',
-                                         suffix='INV2',
-                                         space='average'),
-                                         name='ds_inv2')
-
-    reorient_inv2 = pe.Node(Reorient(),
-                            name='reorient_inv2')
-
-    wf.connect(rename, 'out_file', ds_inv2, 'source_file')
-    wf.connect(transform_inv2_wf, 'outputnode.mean_image', reorient_inv2, 'in_file')
-    wf.connect(reorient_inv2, 'out_file', ds_inv2, 'in_file')
-
+    wf.connect(get_source_inversion, ('inv1', _pickone), rename, 'in_file')
+
+    # All outputs are reoriented and written by one node
+    merge_derivatives = pe.Node(niu.Merge(5), name='merge_derivatives')
+    wf.connect(make_t1w, 't1w_uni', merge_derivatives, 'in1')
+    wf.connect(make_t1w, 't1map', merge_derivatives, 'in2')
+    wf.connect(transform_wf, 'outputnode.t1w_mean', merge_derivatives, 'in3')
+    wf.connect(transform_wf, 'outputnode.t1map_mean', merge_derivatives, 'in4')
+    wf.connect(transform_wf, 'outputnode.inv2_mean', merge_derivatives, 'in5')
+
+    merge_sources = pe.Node(niu.Merge(5), name='merge_sources')
+    wf.connect(get_source_inversion, 'inv1', merge_sources, 'in1')
+    wf.connect(get_source_inversion, 'inv1', merge_sources, 'in2')
+    wf.connect(rename, 'out_file', merge_sources, 'in3')
+    wf.connect(rename, 'out_file', merge_sources, 'in4')
+    wf.connect(rename, 'out_file', merge_sources, 'in5')
+
+    ds_derivatives = pe.Node(niu.Function(function=sink_derivatives,
+                                          input_names=['in_files', 'source_files',
+                                                       'specs', 'base_directory',
+                                                       'uncrop', 'num_threads'],
+                                          output_names=['out_files']),
+                             name='ds_derivatives')
+    ds_derivatives.inputs.base_directory = derivatives
+    ds_derivatives.inputs.uncrop = crop
+    ds_derivatives.inputs.specs = [{'out_path_base': 't1w', 'suffix': 'T1w'}] * n_mp2rages + \
+                                  [{'out_path_base': 't1map', 'suffix': 'T1w'}] * n_mp2rages + \
+                                  [{'out_path_base': 'averaged_mp2rages', 'suffix': 'T1w', 'space': 'average'},
+                                   {'out_path_base': 'averaged_mp2rages', 'suffix': 'T1map', 'space': 'average'},
+                                   {'out_path_base': 'averaged_mp2rages', 'suffix': 'INV2', 'space': 'average'}]
+
+    wf.connect(merge_derivatives, 'out', ds_derivatives, 'in_files')
+    wf.connect(merge_sources, 'out', ds_derivatives, 'source_files')
+
+    # What the derivatives were made from, for the planner (provenance.py)
+    provenance = init_provenance_node('combine', derivatives,
+                                      input_names=['mp2rage_parameters'],
+                                      parameters={'crop': crop,
+                                                  'n_mp2rages': n_mp2rages,
+                                                  'registration': pyramid})
+    wf.connect(get_parameters, 'mp2rage_parameters', provenance, 'mp2rage_parameters')
+    wf.connect(rename, 'out_file', provenance, 'source_file')
+    wf.connect(ds_derivatives, 'out_files', provenance, 'out_files')
+
+    # For the stages that follow in the same graph (see pipeline.py): the
+    # averages in the working directory (on the grid of the first
+    # acquisition, cropped with `crop`), the first acquisition (renamed
+    # like the averaged derivatives are), the uncropped parameters of
+    # every acquisition and the parameters that were fitted (cropped with
+    # `crop`), so that the other stages reuse the same fits
+    outputnode = pe.Node(niu.IdentityInterface(fields=['t1w',
+                                                       't1map',
+                                                       'inv2',
+                                                       'source_file',
+                                                       'mp2rage_parameters',
+                                                       'fit_parameters']),
+                         name='outputnode')
+    wf.connect(transform_wf, 'outputnode.t1w_mean', outputnode, 't1w')
+    wf.connect(transform_wf, 'outputnode.t1map_mean', outputnode, 't1map')
+    wf.connect(transform_wf, 'outputnode.inv2_mean', outputnode, 'inv2')
+    wf.connect(rename, 'out_file', outputnode, 'source_file')
+    wf.connect(get_parameters, 'mp2rage_parameters', outputnode, 'mp2rage_parameters')
+    wf.connect(fit_parameters, 'mp2rage_parameters', outputnode, 'fit_parameters')
 
     return wf
 
 
-def init_transform_to_first_image_wf(name='transform_images', n_images=2):
+def init_transform_to_first_image_wf(name='transform_images', n_images=2,
+                                     channels=['t1w', 'inv2', 't1map'],
+                                     average_method='mean', slab_size=None):
 
 
     wf = pe.Workflow(name=name)
 
-    inputnode = pe.Node(niu.IdentityInterface(fields=['in_files',
-                                                  'transforms']),
+    inputnode = pe.Node(niu.IdentityInterface(fields=channels + ['transforms',
+                                                                 'weights']),
                         name='inputnode')
 
+    # One list per acquisition, with all its channels
+    merge_channels = pe.Node(niu.Merge(len(channels), axis='hstack'),
+                             name='merge_channels')
+    for ix, channel in enumerate(channels):
+        wf.connect(inputnode, channel, merge_channels, 'in{}'.format(ix + 1))
 
     split = pe.Node(niu.Split(splits=[1, n_images-1]),
                     name='split')
-    wf.connect(inputnode, 'in_files', split, 'inlist')
-
-    apply_sinc = pe.MapNode(ants.ApplyTransforms(interpolation='LanczosWindowedSinc'), 
-                            iterfield=['input_image'],
+    wf.connect(merge_channels, 'out', split, 'inlist')
+
+    # All channels of an acquisition share one transform and one grid, so
+    # they are resampled together
+    apply_sinc = pe.MapNode(cache_interface(niu.Function(function=resample_images,
+                                         input_names=['in_files', 'transform',
+                                                      'reference_image', 'num_threads'],
+                                         output_names=['out_files'])),
+                            iterfield=['in_files', 'transform'],
                             name='apply_sinc')
-    wf.connect(inputnode, 'transforms', apply_sinc, 'transforms')
-    wf.connect(split, ('out1', _pickone), apply_sinc, 'reference_image')
-    wf.connect(split, 'out2', apply_sinc, 'input_image')
+    wf.connect(inputnode, 'transforms', apply_sinc, 'transform')
+    wf.connect(split, ('out1', _pickfirst), apply_sinc, 'reference_image')
+    wf.connect(split, 'out2', apply_sinc, 'in_files')
     
     merge_lists = pe.Node(niu.Merge(2),
                               name='merge_lists')
     wf.connect(split, 'out1', merge_lists, 'in1')
-    wf.connect(apply_sinc, 'output_image', merge_lists, 'in2')
-
-    merge_niftis = pe.Node(fsl.Merge(dimension='t'),
-                               name='merge_niftis')
-    wf.connect(merge_lists, 'out', merge_niftis, 'in_files')
-
-    mean_image = pe.Node(fsl.MeanImage(dimension='T'),
-                       name='mean_image')
-    wf.connect(merge_niftis, 'merged_file', mean_image, 'in_file')
-
-    outputnode = pe.Node(niu.IdentityInterface(fields=['mean_image', 'transformed_images']),
+    wf.connect(apply_sinc, 'out_files', merge_lists, 'in2')
+
+    # One list per channel, with all its acquisitions
+    split_channels = pe.Node(niu.Function(function=transpose_lists,
+                                          input_names=['lists'],
+                                          output_names=['lists']),
+                             name='split_channels')
+    wf.connect(merge_lists, 'out', split_channels, 'lists')
+
+    mean_image = pe.MapNode(niu.Function(function=average_images,
+                                         input_names=['in_files', 'weights', 'method',
+                                                      'trim', 'slab_size'],
+                                         output_names=['mean_image']),
+                            iterfield=['in_files'],
+                            name='mean_image')
+    mean_image.inputs.method = average_method
+    mean_image.inputs.slab_size = slab_size
+    wf.connect(split_channels, 'lists', mean_image, 'in_files')
+    wf.connect(inputnode, 'weights', mean_image, 'weights')
+
+    split_means = pe.Node(niu.Split(splits=[1] * len(channels), squeeze=True),
+                          name='split_means')
+    wf.connect(mean_image, 'mean_image', split_means, 'inlist')
+
+    outputnode = pe.Node(niu.IdentityInterface(fields=['{}_mean'.format(channel) for channel in channels] +
+                                                      ['transformed_images']),
                          name='outputnode')
-    wf.connect(mean_image, 'out_file', outputnode, 'mean_image')
-    wf.connect(merge_lists, 'out', outputnode, 'transformed_images')
+    for ix, channel in enumerate(channels):
+        wf.connect(split_means, 'out{}'.format(ix + 1), outputnode, '{}_mean'.format(channel))
+    wf.connect(split_channels, 'lists', outputnode, 'transformed_images')
 
     return wf
 
@@ -274,19 +304,5 @@ def init_transform_to_first_image_wf(name='transform_images', n_images=2):
 
 
 if __name__ == '__main__':
-    parser = argparse.ArgumentParser()
-    parser.add_argument("subject", 
-                        type=str,
-                        help="subject to process")
-    parser.add_argument('session', 
-                        nargs='?', 
-                        default=None,
-                        help="subject to process")
-
-    args = parser.parse_args()
-
-    main('/sourcedata', 
-         '/derivatives',
-         tmp_dir='/workflow_folders',
-         subject=args.subject,
-         session=args.session)
+    import cli
+    cli.main(['combine'] + sys.argv[1:])
@@ -0,0 +1,345 @@
+import os
+import sys
+import json
+import time
+import uuid
+import fcntl
+import signal
+import importlib
+import multiprocessing
+
+# Imported once by the daemon, so that jobs (forked from it) start warm.
+# nipype's Function nodes import inside the function, which then is a
+# lookup in sys.modules
+preloaded_modules = ['numpy', 'scipy.ndimage', 'pandas', 'nibabel', 'nilearn.image',
+                     'nipype.pipeline.engine', 'nipype.interfaces.ants',
+                     'nipype.interfaces.fsl', 'bids', 'pymp2rage', 'fmriprep',
+                     'batch', 'pipeline', 'combine_scans', 'mask_mp2rage', 'make_qmri_maps',
+                     'update_fs_brainmask', 'utils', 'result_cache', 'registration',
+                     'resampling', 'nighres_worker', 'profiling']
+
+queue_subdirs = ['pending', 'running', 'done', 'failed', 'logs']
+
+
+def get_queue_dir(queue_dir=None):
+    from utils import get_cache_dir
+
+    if queue_dir is None:
+        queue_dir = os.environ.get('MP2RAGE_QUEUE_DIR', get_cache_dir('queue'))
+
+    for subdir in queue_subdirs:
+        if not os.path.exists(os.path.join(queue_dir, subdir)):
+            os.makedirs(os.path.join(queue_dir, subdir), exist_ok=True)
+
+    return queue_dir
+
+
+def submit(stage,
+           subject,
+           session=None,
+           queue_dir=None,
+           crop=False,
+           n4_fast=False,
+           n_procs=1):
+    # Puts a job in the queue and returns its filename (in pending/). The
+    # job is written elsewhere first and then renamed, so the daemon never
+    # sees half a job
+    from utils import STAGES
+
+    if stage not in STAGES:
+        raise Exception('Unknown stage {}'.format(stage))
+
+    queue_dir = get_queue_dir(queue_dir)
+    # Pending jobs run in the order of their names
+    now = time.time()
+    job_id = '{}.{:06d}_{}_{}_{}'.format(time.strftime('%Y%m%d-%H%M%S', time.localtime(now)),
+                                         int(now % 1 * 1e6), stage, subject, uuid.uuid4().hex[:8])
+
+    job = {'id': job_id,
+           'stage': stage,
+           'subject': subject,
+           'session': session,
+           'crop': crop,
+           'n4_fast': n4_fast,
+           'n_procs': n_procs,
+           'submitted': now}
+
+    fn = os.path.join(queue_dir, 'pending', '{}.json'.format(job_id))
+    _write_json(os.path.join(queue_dir, '{}.tmp'.format(job_id)), job, fn)
+
+    return fn
+
+
+def wait(job_fn, poll_interval=.5):
+    # Waits for a submitted job to finish, returns the finished job
+    queue_dir = os.path.dirname(os.path.dirname(job_fn))
+    name = os.path.basename(job_fn)
+
+    while True:
+        for state in ('done', 'failed'):
+            fn = os.path.join(queue_dir, state, name)
+            if os.path.exists(fn):
+                with open(fn) as f:
+                    return json.load(f)
+        time.sleep(poll_interval)
+
+
+class PreprocessingDaemon(object):
+    # Runs the jobs in <queue_dir>/pending, oldest first, with at most
+    # n_workers at a time. Every job runs (as a workflow of one stage for one
+    # subject, like batch.py builds them) in a process forked from the
+    # daemon, which already imported everything and indexed the BIDS
+    # folder. A crashing job only takes down its own process. Jobs move
+    # through running/ to done/ or failed/ and record when they were
+    # submitted, started and finished; status.json has the queue depth and
+    # latencies
+
+    def __init__(self,
+                 sourcedata,
+                 derivatives,
+                 tmp_dir,
+                 queue_dir=None,
+                 n_workers=2,
+                 poll_interval=.2,
+                 n_recent=50):
+        self.sourcedata = sourcedata
+        self.derivatives = derivatives
+        self.tmp_dir = tmp_dir
+        self.queue_dir = get_queue_dir(queue_dir)
+        self.n_workers = n_workers
+        self.poll_interval = poll_interval
+        self.n_recent = n_recent
+        self.running = {}
+        self.processes = {}
+        self.recent = []
+        self.started = time.time()
+        self.stopping = False
+        self.index = None
+        self._lock = None
+
+    def serve(self):
+        # Only one daemon per queue, so whatever is left in running/ was
+        # interrupted and is queued again
+        self._lock = open(os.path.join(self.queue_dir, 'daemon.lock'), 'w')
+        try:
+            fcntl.flock(self._lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise Exception('Another daemon serves {}'.format(self.queue_dir))
+
+        for name in os.listdir(os.path.join(self.queue_dir, 'running')):
+            os.replace(os.path.join(self.queue_dir, 'running', name),
+                       os.path.join(self.queue_dir, 'pending', name))
+
+        self.preload()
+
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+
+        print('Serving {} with {} workers'.format(self.queue_dir, self.n_workers))
+        sys.stdout.flush()
+
+        while not self.stopping or len(self.running) > 0:
+            self.reap()
+
+            if not self.stopping:
+                while len(self.running) < self.n_workers:
+                    job = self.claim()
+                    if job is None:
+                        break
+                    self.start(job)
+
+            self.write_status()
+            time.sleep(self.poll_interval)
+
+        self.write_status()
+        print('Stopped')
+
+    def _stop(self, signum, frame):
+        # Running jobs are finished, pending ones stay in the queue
+        if not self.stopping:
+            print('Stopping after {} running jobs'.format(len(self.running)))
+            sys.stdout.flush()
+        self.stopping = True
+
+    def preload(self):
+        from bids_index import BIDSIndex
+
+        t0 = time.time()
+        for module in preloaded_modules:
+            try:
+                importlib.import_module(module)
+            except ImportError as e:
+                print('Could not preload {}: {}'.format(module, e))
+
+        self.index = BIDSIndex(self.sourcedata)
+        self.index.update()
+
+        print('Preloaded modules and BIDS index in {:.1f}s'.format(time.time() - t0))
+
+    def get_pending(self):
+        pending_dir = os.path.join(self.queue_dir, 'pending')
+        return sorted(fn for fn in os.listdir(pending_dir) if fn.endswith('.json'))
+
+    def claim(self):
+        # The oldest pending job of a subject that has no job running. The
+        # stages of a subject share its working directory and read each
+        # other's derivatives (masking those of combining), so they run one
+        # after the other, in the order they were submitted
+        busy = {job['subject'] for job in self.running.values()}
+
+        for name in self.get_pending():
+            fn = os.path.join(self.queue_dir, 'pending', name)
+            try:
+                with open(fn) as f:
+                    job = json.load(f)
+            except (FileNotFoundError, ValueError):
+                continue
+
+            if job['subject'] in busy:
+                continue
+
+            job['started'] = time.time()
+            job['latency_s'] = job['started'] - job['submitted']
+            _write_json(os.path.join(self.queue_dir, 'running', '{}.tmp'.format(name)), job,
+                        os.path.join(self.queue_dir, 'running', name))
+            os.remove(fn)
+
+            return job
+
+        return None
+
+    def start(self, job):
+        # Only the files of this subject are re-indexed, so that a job sees
+        # data that arrived after the daemon started
+        self.index.update(subject=job['subject'])
+
+        log_fn = os.path.join(self.queue_dir, 'logs', '{}.log'.format(job['id']))
+        process = multiprocessing.get_context('fork').Process(target=run_job,
+                                                              args=(job,
+                                                                    self.sourcedata,
+                                                                    self.derivatives,
+                                                                    self.tmp_dir,
+                                                                    log_fn))
+        process.start()
+        job['pid'] = process.pid
+        job['log'] = log_fn
+        self.running[job['id']] = job
+        self.processes[job['id']] = process
+
+        print('Started {} (waited {:.2f}s)'.format(job['id'], job['latency_s']))
+        sys.stdout.flush()
+
+    def reap(self):
+        for job_id, process in list(self.processes.items()):
+            if process.is_alive():
+                continue
+
+            process.join()
+            job = self.running.pop(job_id)
+            del self.processes[job_id]
+
+            job['finished'] = time.time()
+            job['duration_s'] = job['finished'] - job['started']
+            job['exitcode'] = process.exitcode
+            state = 'done' if process.exitcode == 0 else 'failed'
+
+            name = '{}.json'.format(job_id)
+            _write_json(os.path.join(self.queue_dir, state, '{}.tmp'.format(name)), job,
+                        os.path.join(self.queue_dir, state, name))
+            os.remove(os.path.join(self.queue_dir, 'running', name))
+
+            self.recent = (self.recent + [dict(job, state=state)])[-self.n_recent:]
+
+            print('Finished {}: {} in {:.1f}s'.format(job_id, state, job['duration_s']))
+            sys.stdout.flush()
+
+    def get_status(self):
+        now = time.time()
+        latencies = [job['latency_s'] for job in self.recent]
+        durations = [job['duration_s'] for job in self.recent]
+
+        return {'pid': os.getpid(),
+                'queue_dir': self.queue_dir,
+                'up_s': now - self.started,
+                'n_workers': self.n_workers,
+                'stopping': self.stopping,
+                'updated': now,
+                'pending': len(self.get_pending()),
+                'running': [{'id': job['id'],
+                             'latency_s': job['latency_s'],
+                             'running_s': now - job['started']}
+                            for job in self.running.values()],
+                'mean_latency_s': sum(latencies) / len(latencies) if latencies else None,
+                'mean_duration_s': sum(durations) / len(durations) if durations else None,
+                'recent': [{key: job[key] for key in ('id', 'state', 'latency_s', 'duration_s')}
+                           for job in self.recent[::-1]]}
+
+    def write_status(self):
+        _write_json(os.path.join(self.queue_dir, 'status.json.tmp'), self.get_status(),
+                    os.path.join(self.queue_dir, 'status.json'))
+
+
+def run_job(job, sourcedata, derivatives, tmp_dir, log_fn):
+    # Runs in the forked process: one stage for one subject, with its output
+    # in the log of the job
+    from batch import init_subject_wf
+    from profiling import run_workflow
+
+    log = os.open(log_fn, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    os.dup2(log, sys.stdout.fileno())
+    os.dup2(log, sys.stderr.fileno())
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+    wf = init_subject_wf(sourcedata,
+                         derivatives,
+                         job['subject'],
+                         job['session'],
+                         stages=[job['stage']],
+                         crop=job['crop'],
+                         n4_fast=job['n4_fast'],
+                         num_threads=min(job['n_procs'], 8))
+
+    if wf is None:
+        raise Exception('Nothing to run for {}'.format(job['id']))
+
+    # Same working directories as batch.py, so either can reuse the other's
+    wf.base_dir = os.path.join(tmp_dir, 'mp2rage_batch')
+
+    if job['n_procs'] > 1:
+        plugin, plugin_args = 'MultiProc', {'n_procs': job['n_procs']}
+    else:
+        plugin, plugin_args = 'Linear', None
+
+    run_workflow(wf,
+                 plugin=plugin,
+                 plugin_args=plugin_args,
+                 profile_dir=os.path.join(derivatives, 'profiles'))
+
+
+def get_status(queue_dir=None):
+    # The last status the daemon wrote, with the current queue depth
+    queue_dir = get_queue_dir(queue_dir)
+    fn = os.path.join(queue_dir, 'status.json')
+
+    status = {}
+    if os.path.exists(fn):
+        with open(fn) as f:
+            status = json.load(f)
+
+    for state in ('pending', 'running', 'done', 'failed'):
+        status['n_{}'.format(state)] = len([fn for fn in os.listdir(os.path.join(queue_dir, state))
+                                            if fn.endswith('.json')])
+
+    return status
+
+
+def _write_json(tmp_fn, data, fn):
+    with open(tmp_fn, 'w') as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp_fn, fn)
+
+
+if __name__ == '__main__':
+    import cli
+    cli.main(['daemon'] + sys.argv[1:])
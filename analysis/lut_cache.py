@@ -0,0 +1,161 @@
+import os
+import json
+import time
+import pickle
+import hashlib
+import functools
+import numpy as np
+
+# Names under which pymp2rage (depending on its version) keeps the function
+# that simulates the MP2RAGE signal for a range of T1s
+lut_functions = ['MP2RAGE_lookuptable']
+
+
+class LUTCache(object):
+
+    def __init__(self, cache_dir=None, max_size_mb=None):
+        from utils import get_cache_dir
+
+        if cache_dir is None:
+            cache_dir = get_cache_dir('mp2rage_lut')
+
+        if max_size_mb is None:
+            max_size_mb = float(os.environ.get('MP2RAGE_LUT_CACHE_MB', 512))
+
+        self.cache_dir = cache_dir
+        self.max_size_mb = max_size_mb
+
+        # Lookup tables that this process already loaded (or made)
+        self.memory = {}
+
+    def get_key(self, function, args, kwargs):
+        import pymp2rage
+
+        description = {'function': '{}.{}'.format(function.__module__, function.__name__),
+                       'version': getattr(pymp2rage, '__version__', None),
+                       'args': args,
+                       'kwargs': kwargs}
+
+        description = json.dumps(description, sort_keys=True, default=_to_json)
+
+        return hashlib.sha1(description.encode()).hexdigest()
+
+    def get_fn(self, key):
+        return os.path.join(self.cache_dir, '{}.pkl'.format(key))
+
+    def load(self, key):
+        if key in self.memory:
+            return self.memory[key]
+
+        fn = self.get_fn(key)
+
+        try:
+            with open(fn, 'rb') as f:
+                result = pickle.load(f)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+        # Mark as recently used, for the eviction
+        os.utime(fn, None)
+        self.memory[key] = result
+
+        return result
+
+    def save(self, key, result):
+        self.memory[key] = result
+
+        fn = self.get_fn(key)
+        tmp_fn = '{}.{}.tmp'.format(fn, os.getpid())
+
+        with open(tmp_fn, 'wb') as f:
+            pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+        # Concurrent writers of the same table simply replace each other
+        os.replace(tmp_fn, fn)
+
+        self.evict()
+
+    def evict(self):
+        files = []
+        for fn in os.listdir(self.cache_dir):
+            if fn.endswith('.pkl'):
+                stat = os.stat(os.path.join(self.cache_dir, fn))
+                files.append((stat.st_mtime, stat.st_size, fn))
+
+        size = sum(f[1] for f in files)
+
+        # Least recently used tables go first
+        for mtime, file_size, fn in sorted(files):
+            if size <= self.max_size_mb * 1024. ** 2:
+                break
+
+            try:
+                os.remove(os.path.join(self.cache_dir, fn))
+            except OSError:
+                pass
+
+            size -= file_size
+
+    def wrap(self, function):
+
+        @functools.wraps(function)
+        def cached_function(*args, **kwargs):
+            key = self.get_key(function, args, kwargs)
+            result = self.load(key)
+
+            if result is None:
+                t0 = time.time()
+                result = function(*args, **kwargs)
+                self.save(key, result)
+                print('Cached MP2RAGE lookup table {} ({:.1f}s)'.format(key, time.time() - t0))
+
+            return result
+
+        cached_function._lut_cache = self
+        return cached_function
+
+
+def install_lut_cache(cache=None):
+    # Replaces the lookup-table function everywhere pymp2rage refers to it.
+    # Lookup tables for B1-corrected T1 maps (one per B1 value of the grid)
+    # end up in the cache as separate tables
+    import sys
+    import importlib
+
+    # (Imports pymp2rage and its submodules, so they are in sys.modules)
+    importlib.import_module('pymp2rage')
+
+    if cache is None:
+        cache = LUTCache()
+
+    modules = [module for name, module in list(sys.modules.items())
+               if module is not None and (name == 'pymp2rage' or name.startswith('pymp2rage.'))]
+
+    n_installed = 0
+    for module in modules:
+        for name in lut_functions:
+            function = getattr(module, name, None)
+
+            if function is None or not callable(function):
+                continue
+
+            if not hasattr(function, '_lut_cache'):
+                setattr(module, name, cache.wrap(function))
+
+            n_installed += 1
+
+    if n_installed == 0:
+        print('WARNING: found no lookup-table function in pymp2rage, not caching')
+
+    return cache
+
+
+def _to_json(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, tuple):
+        return list(value)
+
+    raise TypeError('Cannot use {} as part of a lookup-table key'.format(type(value)))
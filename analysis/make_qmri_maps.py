@@ -1,17 +1,25 @@
-import argparse
+import os
+import sys
 import nipype.pipeline.engine as pe
 import nipype.interfaces.utility as niu
-from utils import get_mp2rage_pars, fit_mp2rage, _pickone, get_inv
-from fmriprep.interfaces import DerivativesDataSink
-from nipype.interfaces.image import Reorient
+from utils import get_mp2rage_pars, get_mp2rage_fit, _pickone, get_inv, sink_derivatives
+from profiling import run_workflow
+from resources import set_subject_resources
+from bids_index import BIDSIndex
+from provenance import init_provenance_node
 
 def main(sourcedata,
          derivatives,
          tmp_dir,
          subject,
          session=None,
-         acquisition=None):
+         acquisition='memp2rage',
+         num_threads=8):
 
+    if session is None:
+        session = '.*'
+
+    BIDSIndex(sourcedata).update(subject=subject)
 
     wf_name = 'qmri_mp2rage_{}'.format(subject)
     wf = init_qmri_wf(sourcedata,
@@ -24,13 +32,22 @@ def main(sourcedata,
     wf.inputs.inputnode.session = session
     wf.inputs.inputnode.acquisition = acquisition
 
-    wf.run()
+    set_subject_resources(wf, sourcedata, subject, session, num_threads=num_threads)
+
+    run_workflow(wf, profile_dir=os.path.join(derivatives, 'profiles'))
 
 
 def init_qmri_wf(sourcedata,
                          derivatives,
                          acquisition='memp2rage',
-                         name='qmri_mp2rage'):
+                         name='qmri_mp2rage',
+                         from_combine=False,
+                         crop=False):
+    # With `from_combine`, the parameters of the acquisition come from the
+    # combine workflow (inputnode.mp2rage_parameters, see pipeline.py)
+    # instead of from the BIDS index, and the maps from the fit it made
+    # (of inputnode.fit_parameters, which are cropped with `crop`: the maps
+    # are then uncropped when they are written)
 
     wf = pe.Workflow(name=name)
 
@@ -38,36 +55,46 @@ def init_qmri_wf(sourcedata,
                                                       'derivatives',
                                                       'subject',
                                                       'session',
-                                                      'acquisition']),
+                                                      'acquisition',
+                                                      'mp2rage_parameters',
+                                                      'fit_parameters']),
                         name='inputnode')
 
     inputnode.inputs.sourcedata = sourcedata
     inputnode.inputs.derivatives = derivatives
 
-    
-    get_parameters = pe.Node(niu.Function(function=get_mp2rage_pars,
-                                               input_names=['sourcedata',
-                                                            'subject',
-                                                            'session',
-                                                            'acquisition'],
-                                               output_names=['mp2rage_parameters']),
-                                  name='get_mp2rage_pars')
-
-    wf.connect([(inputnode, get_parameters,
-                 [('sourcedata', 'sourcedata'),
-                  ('subject', 'subject'),
-                  ('session', 'session'),
-                  ('acquisition', 'acquisition')])])
-
-    get_qmri = pe.Node(niu.Function(function=fit_mp2rage,
+    if from_combine:
+        get_parameters = inputnode
+    else:
+        get_parameters = pe.Node(niu.Function(function=get_mp2rage_pars,
+                                              input_names=['sourcedata',
+                                                           'subject',
+                                                           'session',
+                                                           'acquisition'],
+                                              output_names=['mp2rage_parameters']),
+                                 name='get_mp2rage_pars')
+
+        wf.connect([(inputnode, get_parameters,
+                     [('sourcedata', 'sourcedata'),
+                      ('subject', 'subject'),
+                      ('session', 'session'),
+                      ('acquisition', 'acquisition')])])
+
+    get_qmri = pe.Node(niu.Function(function=get_mp2rage_fit,
                                        input_names=['mp2rage_parameters',
-                                                    'return_images'],
+                                                    'return_images',
+                                                    'fits_dir',
+                                                    'n_procs',
+                                                    'mem_gb'],
                                        output_names=['S0map', 't2starw', 't2starmap']),
                           name='get_qmri')
 
     get_qmri.inputs.return_images = ['S0map', 't2starw', 't2starmap']
 
-    wf.connect([ (get_parameters, get_qmri, [('mp2rage_parameters', 'mp2rage_parameters')]) ])
+    if from_combine:
+        wf.connect([ (inputnode, get_qmri, [('fit_parameters', 'mp2rage_parameters')]) ])
+    else:
+        wf.connect([ (get_parameters, get_qmri, [('mp2rage_parameters', 'mp2rage_parameters')]) ])
 
 
     get_first_inversion = pe.MapNode(niu.Function(function=get_inv,
@@ -86,64 +113,43 @@ def init_qmri_wf(sourcedata,
     
 
 
-    ds_S0 = pe.Node(DerivativesDataSink(base_directory=derivatives,
-                                         keep_dtype=False,
-                                         out_path_base='qmri_memp2rages',
-                                         suffix='S0',
-                                         space='average'),
-                                         name='ds_S0')
-    reorient_s0 = pe.Node(Reorient(),
-                          name='reorient_s0')
     wf.connect(get_first_inversion, ('inv1', _pickone), rename, 'in_file')
-    wf.connect(rename, 'out_file', ds_S0, 'source_file')
-    wf.connect(get_qmri, 'S0map', reorient_s0, 'in_file')
-    wf.connect(reorient_s0, 'out_file', ds_S0, 'in_file')
-
-    ds_t2starmap = pe.Node(DerivativesDataSink(base_directory=derivatives,
-                                         keep_dtype=False,
-                                         out_path_base='qmri_memp2rages',
-                                         suffix='t2starmap',
-                                         space='average'),
-                                         name='ds_t2starmap')
-    reorient_t2starmap = pe.Node(Reorient(),
-                          name='reorient_t2starmap')
-    wf.connect(rename, 'out_file', ds_t2starmap, 'source_file')
-    wf.connect(get_qmri, 't2starmap', reorient_t2starmap, 'in_file')
-    wf.connect(reorient_t2starmap, 'out_file', ds_t2starmap, 'in_file')
-
-    ds_t2starw = pe.Node(DerivativesDataSink(base_directory=derivatives,
-                                         keep_dtype=False,
-                                         out_path_base='qmri_memp2rages',
-                                         suffix='t2starw',
-                                         space='average'),
-                                         name='ds_t2starw')
-    reorient_t2w = pe.Node(Reorient(),
-                          name='reorient_t2w')
-    wf.connect(rename, 'out_file', ds_t2starw, 'source_file')
-    wf.connect(get_qmri, 't2starw', reorient_t2w, 'in_file')
-    wf.connect(reorient_t2w, 'out_file', ds_t2starw, 'in_file')
+
+    # All outputs are reoriented and written by one node
+    merge_derivatives = pe.Node(niu.Merge(3), name='merge_derivatives')
+    wf.connect(get_qmri, 'S0map', merge_derivatives, 'in1')
+    wf.connect(get_qmri, 't2starmap', merge_derivatives, 'in2')
+    wf.connect(get_qmri, 't2starw', merge_derivatives, 'in3')
+
+    merge_sources = pe.Node(niu.Merge(3), name='merge_sources')
+    wf.connect(rename, 'out_file', merge_sources, 'in1')
+    wf.connect(rename, 'out_file', merge_sources, 'in2')
+    wf.connect(rename, 'out_file', merge_sources, 'in3')
+
+    ds_derivatives = pe.Node(niu.Function(function=sink_derivatives,
+                                          input_names=['in_files', 'source_files',
+                                                       'specs', 'base_directory',
+                                                       'uncrop', 'num_threads'],
+                                          output_names=['out_files']),
+                             name='ds_derivatives')
+    ds_derivatives.inputs.base_directory = derivatives
+    ds_derivatives.inputs.uncrop = from_combine and crop
+    ds_derivatives.inputs.specs = [{'out_path_base': 'qmri_memp2rages', 'suffix': 'S0', 'space': 'average'},
+                                   {'out_path_base': 'qmri_memp2rages', 'suffix': 't2starmap', 'space': 'average'},
+                                   {'out_path_base': 'qmri_memp2rages', 'suffix': 't2starw', 'space': 'average'}]
+
+    wf.connect(merge_derivatives, 'out', ds_derivatives, 'in_files')
+    wf.connect(merge_sources, 'out', ds_derivatives, 'source_files')
+
+    provenance = init_provenance_node('qmri', derivatives,
+                                      input_names=['mp2rage_parameters'],
+                                      parameters={'crop': from_combine and crop})
+    wf.connect(get_parameters, 'mp2rage_parameters', provenance, 'mp2rage_parameters')
+    wf.connect(rename, 'out_file', provenance, 'source_file')
+    wf.connect(ds_derivatives, 'out_files', provenance, 'out_files')
 
     return wf
 
 if __name__ == '__main__':
-    parser = argparse.ArgumentParser()
-    parser.add_argument("subject", 
-                        type=str,
-                        help="subject to process")
-    parser.add_argument('session', 
-                        default='anat',
-                        help="subject to process")
-
-    parser.add_argument('acquisition', 
-                        default='memp2rage',
-                        help="Acquisition to process")
-
-    args = parser.parse_args()
-
-    main('/sourcedata', 
-         '/derivatives',
-         tmp_dir='/workflow_folders',
-         subject=args.subject,
-         session=args.session,
-         acquisition=args.acquisition)
-
+    import cli
+    cli.main(['qmri'] + sys.argv[1:])
@@ -1,105 +1,233 @@
 from bids import BIDSLayout
-import argparse
 import os
+import sys
+import warnings
 import nipype.pipeline.engine as pe
 from nipype.interfaces import ants
 from nipype.interfaces import afni
 from nipype.interfaces import fsl
 from nipype.interfaces import utility as niu
-from fmriprep.interfaces import DerivativesDataSink
-from utils import get_derivative
+from utils import get_derivative, get_intermediate_format, get_intermediate_ext, sink_derivatives
+from result_cache import cache_interface
+from profiling import run_workflow
+from resources import set_subject_resources
+from provenance import init_provenance_node
 
 
 def nighres_skullstrip(inv2, t1w, t1map):
-    from nighres.brain import mp2rage_skullstripping
+    # Runs in the persistent nighres worker (see nighres_worker.py)
     import os
-    
-    results = mp2rage_skullstripping(inv2,
-                                 t1w,
-                                 t1map,
-                                 output_dir=os.getcwd(),
-                                 save_data=True)
-    
-    return results['brain_mask'].get_filename()
+    from nipype.utils.filemanip import split_filename
+    from nighres_worker import run_nighres
+    from utils import get_intermediate_ext
+
+    _, fn, _ = split_filename(inv2)
+    out_files = run_nighres('skullstrip',
+                            [inv2, t1w, t1map],
+                            {'brain_mask': os.path.abspath('{}_strip-mask{}'.format(fn, get_intermediate_ext()))})
+
+    return out_files['brain_mask']
 
 def nighres_dura_masker(inv2, inv2_mask):
-    from nighres.brain import mp2rage_dura_estimation
     import os
-    
-    results = mp2rage_dura_estimation(inv2,
-                                 inv2_mask,
-                                 output_dir=os.getcwd(),
-                                 save_data=True)
-    
-    return results['result'].get_filename()
+    from nipype.utils.filemanip import split_filename
+    from nighres_worker import run_nighres
+    from utils import get_intermediate_ext
+
+    _, fn, _ = split_filename(inv2)
+    out_files = run_nighres('dura',
+                            [inv2, inv2_mask],
+                            {'result': os.path.abspath('{}_dura-proba{}'.format(fn, get_intermediate_ext()))})
+
+    return out_files['result']
+
+
+def downsample_for_n4(in_file, shrink_factor=4):
+    # Block-averaged copy of in_file (shrink_factor^3 voxels per voxel), plus
+    # a mask of the head to estimate the bias field in
+    import os
+    import numpy as np
+    import nibabel as nb
+    from scipy import ndimage
+    from nipype.utils.filemanip import split_filename
+    from utils import get_head_mask, get_intermediate_ext
+
+    _, fn, _ = split_filename(in_file)
+    ext = get_intermediate_ext()
+
+    img = nb.load(in_file)
+    data = img.get_fdata(dtype=np.float32)
+
+    # Pad (with the edge values) to a multiple of shrink_factor
+    f = shrink_factor
+    padding = [(0, -s % f) for s in data.shape]
+    data = np.pad(data, padding, mode='edge')
+    data = data.reshape(data.shape[0] // f, f, data.shape[1] // f, f, data.shape[2] // f, f).mean((1, 3, 5))
+
+    # Every new voxel lies in the middle of the block it averages
+    block = np.diag([f, f, f, 1.])
+    block[:3, 3] = (f - 1) / 2.
+    affine = img.affine.dot(block)
+
+    small_fn = os.path.abspath('{}_shrink-{}{}'.format(fn, f, ext))
+    nb.Nifti1Image(data, affine).to_filename(small_fn)
+
+    mask = ndimage.binary_fill_holes(get_head_mask(data))
+    mask_fn = os.path.abspath('{}_shrink-{}_mask{}'.format(fn, f, ext))
+    nb.Nifti1Image(mask.astype(np.uint8), affine).to_filename(mask_fn)
+
+    return small_fn, mask_fn
+
+
+def apply_bias_field(in_file, bias_image):
+    # Divides in_file by the (low-resolution) bias field, linearly
+    # interpolated in the log-domain to the grid of in_file
+    import os
+    import numpy as np
+    import nibabel as nb
+    from utils import get_intermediate_ext
+
+    img = nb.load(in_file)
+    bias = nb.load(bias_image)
+
+    # Coordinates of the voxels of in_file in the voxels of bias_image, per
+    # axis (the grids are aligned, see downsample_for_n4)
+    mapping = np.linalg.inv(bias.affine).dot(img.affine)
+    log_field = np.log(np.maximum(bias.get_fdata(dtype=np.float32), 1e-6))
+
+    for axis in range(3):
+        n = log_field.shape[axis]
+        coords = np.clip(mapping[axis, axis] * np.arange(img.shape[axis]) + mapping[axis, 3], 0, n - 1)
+        lower = np.floor(coords).astype(int)
+        upper = np.minimum(lower + 1, n - 1)
+        weights = (coords - lower).astype(np.float32).reshape([-1 if ax == axis else 1 for ax in range(3)])
+        log_field = (np.take(log_field, lower, axis=axis) * (1 - weights) +
+                     np.take(log_field, upper, axis=axis) * weights)
+
+    corrected = img.get_fdata(dtype=np.float32)
+    corrected *= np.exp(-log_field)
+
+    out_file = os.path.abspath('inv2_corrected{}'.format(get_intermediate_ext()))
+    corrected_img = nb.Nifti1Image(corrected, img.affine, img.header)
+    corrected_img.set_data_dtype(np.float32)
+    corrected_img.to_filename(out_file)
+
+    return out_file
+
+
+def crop_to_head(inv2, t1w, t1map, manual_inside=None, manual_outside=None,
+                 padding=10.):
+    from utils import crop_images
+
+    (inv2, t1w, t1map, manual_inside, manual_outside), bbox = crop_images([inv2, t1w, t1map,
+                                                                          manual_inside, manual_outside],
+                                                                         inv2,
+                                                                         padding=padding)
+
+    return inv2, t1w, t1map, manual_inside, manual_outside, bbox
+
+
+def resample_manual_masks(manual_inside, manual_outside, reference):
+    # The manual masks are drawn on the averaged derivatives (reoriented to
+    # RAS, never cropped); these are the same masks on the grid of
+    # `reference` (nearest neighbour, so exact for a reorientation or crop)
+    import os
+    import numpy as np
+    import nibabel as nb
+    from nipype.utils.filemanip import split_filename
+    from update_fs_brainmask import get_mask_voxels
+    from utils import get_intermediate_ext
+
+    reference = nb.load(reference)
+    out_files = []
+
+    for mask in [manual_inside, manual_outside]:
+        if mask is None:
+            out_files.append(None)
+            continue
+
+        data = np.zeros(reference.shape[:3], dtype=np.uint8)
+        data[get_mask_voxels(mask, reference)] = 1
+
+        _, fn, _ = split_filename(mask)
+        out_files.append(os.path.abspath('{}_resampled{}'.format(fn, get_intermediate_ext())))
+        nb.Nifti1Image(data, reference.affine).to_filename(out_files[-1])
+
+    return tuple(out_files)
 
 
 def mask_t1w(t1w, inv2, t1w_mask, 
                      manual_inside=None, manual_outside=None,
-                     dura_mask=None):
+                     dura_mask=None, num_threads=1):
 
-    from nilearn import image
     import os
+    import numpy as np
+    import nibabel as nb
     from nipype.utils.filemanip import split_filename
     from scipy import ndimage
+    from utils import get_bbox, get_intermediate_ext
+    from resources import limit_threads
+
+    with limit_threads(num_threads):
+        _, t1w_fn, _ = split_filename(t1w)
+        ext = get_intermediate_ext()
+
+        # Every image is loaded exactly once (uncompressed images are memory-mapped
+        # by nibabel) and all arithmetic happens in-place on float32/bool arrays
+        t1w_img = nb.load(t1w)
+        new_t1w = t1w_img.get_fdata(dtype=np.float32)
+
+        brain_mask = np.asanyarray(nb.load(t1w_mask).dataobj) > 0
 
-    _, t1w_fn, ext= split_filename(t1w)
-    
-    if manual_inside:
-        t1w_mask = image.math_img('(t1w_mask + manual_inside) > 0',
-                                  t1w_mask=t1w_mask,
-                                  manual_inside=manual_inside)
-
-    if manual_outside:
-        # Stuff like dura should be put to 0, not just multiplied with INV2
-        t1w = image.math_img('t1w * (np.ones_like(t1w) - manual_outside)',
-                             t1w=t1w,
-                             manual_outside=manual_outside)
-
-        t1w_mask = image.math_img('(t1w_mask - manual_outside) > 0',
-                                  t1w_mask=t1w_mask,
-                                  manual_outside=manual_outside)
-
-
-
-    new_t1w = image.math_img('t1w * t1w_mask * np.mean(inv2[t1w_mask == 1]/np.max(inv2))'
-                             '+ t1w * inv2/np.max(inv2) * (1-t1w_mask)',
-                              t1w=t1w,
-                              t1w_mask=t1w_mask,
-                              inv2=inv2)
-
-    if dura_mask:
-        # Dilate dura mask
-        dilated_dura_mask = ndimage.binary_dilation(image.load_img(dura_mask).get_data(),
-                                                    iterations=2)
-        dilated_dura_mask = image.new_img_like(dura_mask, dilated_dura_mask)
-
-        # Make a mask of dilated dura, but only outwards
-        dilated_dura_mask = image.math_img('(dilated_dura_mask - (t1w_mask - dura_mask)) > 0',
-                                           t1w_mask=t1w_mask,
-                                           dura_mask=dura_mask,
-                                           dilated_dura_mask=dilated_dura_mask)
-        
         if manual_inside:
-            dilated_dura_mask = image.math_img('dilated_dura_mask - manual_inside > 0',
-                                               dilated_dura_mask=dilated_dura_mask,
-                                               manual_inside=manual_inside)
+            manual_inside = np.asanyarray(nb.load(manual_inside).dataobj) > 0
+            brain_mask |= manual_inside
+
+        if manual_outside:
+            # Stuff like dura should be put to 0, not just multiplied with INV2
+            manual_outside = nb.load(manual_outside).get_fdata(dtype=np.float32)
+            new_t1w *= 1 - manual_outside
+            brain_mask &= manual_outside < 1
+            del manual_outside
+
+        # Inside the brain mask the T1w is scaled by the mean normalized INV2
+        # within the mask, outside by the normalized INV2 itself
+        weights = nb.load(inv2).get_fdata(dtype=np.float32)
+        weights /= weights.max()
+        weights[brain_mask] = weights[brain_mask].mean()
+        new_t1w *= weights
+        del weights
+
+        if dura_mask:
+            dura_mask = np.asanyarray(nb.load(dura_mask).dataobj) > 0
+
+            # Dilate dura mask, only within its (padded) bounding box
+            dilated_dura_mask = np.zeros_like(dura_mask)
+            bbox = get_bbox(dura_mask, padding=2)
+            if bbox is not None:
+                dilated_dura_mask[bbox] = ndimage.binary_dilation(dura_mask[bbox],
+                                                                  iterations=2)
+
+            # Make a mask of dilated dura, but only outwards
+            dilated_dura_mask &= ~(brain_mask & ~dura_mask)
 
-        new_t1w = image.math_img('t1w * (np.ones_like(dura_mask) - dura_mask)',
-                                  t1w=new_t1w,
-                                  dura_mask=dilated_dura_mask)
+            if manual_inside is not None:
+                dilated_dura_mask &= ~manual_inside
 
-        t1w_mask = image.math_img('(t1w_mask - dilated_dura_mask) > 0',
-                                  t1w_mask=t1w_mask,
-                                  dilated_dura_mask=dilated_dura_mask)
+            new_t1w[dilated_dura_mask] = 0
+            brain_mask &= ~dilated_dura_mask
 
-    new_t1w_fn = os.path.abspath('{}_masked{}'.format(t1w_fn, ext))
-    new_t1w.to_filename(new_t1w_fn)
+        new_t1w_fn = os.path.abspath('{}_masked{}'.format(t1w_fn, ext))
+        new_t1w_img = nb.Nifti1Image(new_t1w, t1w_img.affine, t1w_img.header)
+        new_t1w_img.set_data_dtype(np.float32)
+        new_t1w_img.to_filename(new_t1w_fn)
 
-    new_mask_fn= os.path.abspath('{}_brainmask{}'.format(t1w_fn, ext))
-    t1w_mask.to_filename(new_mask_fn)
+        new_mask_fn= os.path.abspath('{}_brainmask{}'.format(t1w_fn, ext))
+        mask_img = nb.Nifti1Image(brain_mask.astype(np.uint8), t1w_img.affine, t1w_img.header)
+        mask_img.set_data_dtype(np.uint8)
+        mask_img.to_filename(new_mask_fn)
 
-    return new_t1w_fn, new_mask_fn
+        return new_t1w_fn, new_mask_fn
 
 
 def main(sourcedata,
@@ -107,25 +235,101 @@ def main(sourcedata,
          tmp_dir,
          subject,
          num_threads=8,
-         session=None):
+         session=None,
+         crop=False,
+         n4_fast=False):
     
     if session is None:
         session = '.*'
 
+    mask_inputs = get_masking_inputs(derivatives, subject, session)
+
+    wf_name = 'mask_wf_{}'.format(subject)
+    mask_wf = init_masking_wf(name=wf_name, derivatives=derivatives, num_threads=num_threads,
+                              crop=crop, n4_fast=n4_fast)
+    mask_wf.base_dir = tmp_dir
+
+    for key, value in mask_inputs.items():
+        setattr(mask_wf.inputs.inputnode, key, value)
+
+    set_subject_resources(mask_wf, sourcedata, subject, session, num_threads=num_threads)
+
+    run_workflow(mask_wf, profile_dir=os.path.join(derivatives, 'profiles'))
+
+
+def init_fast_n4_wf(name='n4',
+                    shrink_factor=4,
+                    n_iterations=(50, 50, 30, 20),
+                    convergence_threshold=1e-6,
+                    num_threads=8):
+    # N4 on a downsampled, masked copy of the image; only applying the
+    # (smooth) bias field happens at full resolution
+
+    wf = pe.Workflow(name=name)
+
+    inputnode = pe.Node(niu.IdentityInterface(fields=['input_image']),
+                        name='inputnode')
+
+    downsample = pe.Node(niu.Function(function=downsample_for_n4,
+                                      input_names=['in_file', 'shrink_factor'],
+                                      output_names=['out_file', 'mask_file']),
+                         name='downsample')
+    downsample.inputs.shrink_factor = shrink_factor
+    wf.connect(inputnode, 'input_image', downsample, 'in_file')
+
+    n4 = pe.Node(cache_interface(ants.N4BiasFieldCorrection(copy_header=True,
+                                                            shrink_factor=1,
+                                                            n_iterations=list(n_iterations),
+                                                            convergence_threshold=convergence_threshold,
+                                                            save_bias=True,
+                                                            bias_image='inv2_bias{}'.format(get_intermediate_ext()),
+                                                            output_image='inv2_corrected{}'.format(get_intermediate_ext()),
+                                                            num_threads=num_threads)),
+                 name='n4_lowres')
+    wf.connect(downsample, 'out_file', n4, 'input_image')
+    wf.connect(downsample, 'mask_file', n4, 'mask_image')
+
+    apply_bias = pe.Node(cache_interface(niu.Function(function=apply_bias_field,
+                                                      input_names=['in_file', 'bias_image'],
+                                                      output_names=['out_file'])),
+                         name='apply_bias')
+    wf.connect(inputnode, 'input_image', apply_bias, 'in_file')
+    wf.connect(n4, 'bias_image', apply_bias, 'bias_image')
+
+    outputnode = pe.Node(niu.IdentityInterface(fields=['output_image', 'bias_image']),
+                         name='outputnode')
+    wf.connect(apply_bias, 'out_file', outputnode, 'output_image')
+    wf.connect(n4, 'bias_image', outputnode, 'bias_image')
+
+    return wf
+
+
+def get_masking_inputs(derivatives, subject, session=None):
+
     derivatives_layout = BIDSLayout(os.path.join(derivatives, 'averaged_mp2rages'))
 
     inv2 = get_bids_file(derivatives_layout, 
                          subject,
-                         suffix='INV2')
+                         suffix='INV2',
+                         session=session)
 
     t1w = get_bids_file(derivatives_layout, 
                          subject,
-                         suffix='T1w')
+                         suffix='T1w',
+                         session=session)
 
     t1map = get_bids_file(derivatives_layout, 
                          subject,
-                         suffix='T1map')
+                         suffix='T1map',
+                         session=session)
 
+    return dict({'inv2': inv2,
+                 't1w': t1w,
+                 't1map': t1map},
+                **get_manual_masks(derivatives, subject, session))
+
+
+def get_manual_masks(derivatives, subject, session=None):
 
     manual_outside = get_derivative(derivatives, type='manual_segmentation',
                                     modality='anat', subject=subject,
@@ -139,24 +343,24 @@ def main(sourcedata,
                                     space='average', session=session,
                                     check_exists=False)
 
-
-
-    wf_name = 'mask_wf_{}'.format(subject)
-    mask_wf = init_masking_wf(name=wf_name, num_threads=num_threads)
-    mask_wf.base_dir = '/workflow_folders'
-
-    mask_wf.inputs.inputnode.inv2 = inv2
-    mask_wf.inputs.inputnode.t1w = t1w
-    mask_wf.inputs.inputnode.t1map = t1map
-    mask_wf.inputs.inputnode.manual_inside = manual_inside
-    mask_wf.inputs.inputnode.manual_outside = manual_outside
-
-    mask_wf.run()
+    return {'manual_inside': manual_inside,
+            'manual_outside': manual_outside}
 
 
 def init_masking_wf(name='mask_wf',
                     derivatives='/derivatives',
-                    num_threads=8):
+                    num_threads=8,
+                    crop=False,
+                    n4_fast=False,
+                    n4_shrink_factor=4,
+                    n4_iterations=(50, 50, 30, 20),
+                    n4_convergence_threshold=1e-6,
+                    from_combine=False):
+    # With `from_combine`, the images come straight from the outputnode of
+    # the combine workflow (see pipeline.py) rather than from its
+    # derivatives: the manual masks are resampled to their grid, and the
+    # derivatives are named after, uncropped to and reoriented like
+    # `source_file`, so they end up the same as before
 
     wf = pe.Workflow(name=name)
 
@@ -164,150 +368,194 @@ def init_masking_wf(name='mask_wf',
                                                       't1w',
                                                       't1map',
                                                       'manual_inside',
-                                                      'manual_outside'],
+                                                      'manual_outside',
+                                                      'source_file'],
                                               ),
                         name='inputnode')
 
-    n4 = pe.Node(ants.N4BiasFieldCorrection(copy_header=True,
-                                            num_threads=num_threads),
-                 name='n4')
-
-    wf.connect(inputnode, 'inv2', n4, 'input_image')
-
-
-    bet = pe.Node(fsl.BET(mask=True, skull=True), name='bet')
-    wf.connect(n4, 'output_image', bet, 'in_file')
-
-
-    nighres_brain_extract = pe.Node(niu.Function(function=nighres_skullstrip,
+    if from_combine:
+        manual_masks = pe.Node(niu.Function(function=resample_manual_masks,
+                                            input_names=['manual_inside', 'manual_outside', 'reference'],
+                                            output_names=['manual_inside', 'manual_outside']),
+                               name='resample_manual_masks')
+        wf.connect(inputnode, 'manual_inside', manual_masks, 'manual_inside')
+        wf.connect(inputnode, 'manual_outside', manual_masks, 'manual_outside')
+        wf.connect(inputnode, 't1w', manual_masks, 'reference')
+    else:
+        manual_masks = inputnode
+
+    # Optionally, everything is done within the (padded) bounding box of the
+    # head in INV2, and only put back on the full grid by ds_derivatives
+    if crop:
+        crop_head = pe.Node(niu.Function(function=crop_to_head,
+                                         input_names=['inv2', 't1w', 't1map',
+                                                      'manual_inside', 'manual_outside'],
+                                         output_names=['inv2', 't1w', 't1map',
+                                                       'manual_inside', 'manual_outside',
+                                                       'bbox']),
+                            name='crop_head')
+        for field in ['inv2', 't1w', 't1map']:
+            wf.connect(inputnode, field, crop_head, field)
+        for field in ['manual_inside', 'manual_outside']:
+            wf.connect(manual_masks, field, crop_head, field)
+        images = crop_head
+        masks = crop_head
+    else:
+        images = inputnode
+        masks = manual_masks
+
+    output_type = get_intermediate_format()
+
+    if n4_fast:
+        n4 = init_fast_n4_wf(shrink_factor=n4_shrink_factor,
+                             n_iterations=n4_iterations,
+                             convergence_threshold=n4_convergence_threshold,
+                             num_threads=num_threads)
+        wf.connect(images, 'inv2', n4, 'inputnode.input_image')
+        n4_output = 'outputnode.output_image'
+    else:
+        n4 = pe.Node(cache_interface(ants.N4BiasFieldCorrection(copy_header=True,
+                                                                output_image='inv2_corrected{}'.format(get_intermediate_ext()),
+                                                                num_threads=num_threads)),
+                     name='n4')
+        wf.connect(images, 'inv2', n4, 'input_image')
+        n4_output = 'output_image'
+
+
+    bet = pe.Node(fsl.BET(mask=True, skull=True, output_type=output_type), name='bet')
+    wf.connect(n4, n4_output, bet, 'in_file')
+
+
+    nighres_brain_extract = pe.Node(cache_interface(niu.Function(function=nighres_skullstrip,
                                           input_names=['inv2', 't1w', 't1map'],
-                                          output_names=['brainmask']),
+                                          output_names=['brainmask'])),
                              name='nighres_brain_extract')
 
-    wf.connect(n4, 'output_image', nighres_brain_extract, 'inv2')
-    wf.connect(inputnode, 't1w', nighres_brain_extract, 't1w')
-    wf.connect(inputnode, 't1map', nighres_brain_extract, 't1map')
+    wf.connect(n4, n4_output, nighres_brain_extract, 'inv2')
+    wf.connect(images, 't1w', nighres_brain_extract, 't1w')
+    wf.connect(images, 't1map', nighres_brain_extract, 't1map')
 
-    dura_masker = pe.Node(niu.Function(function=nighres_dura_masker,
+    dura_masker = pe.Node(cache_interface(niu.Function(function=nighres_dura_masker,
                                           input_names=['inv2', 'inv2_mask'],
-                                          output_names=['duramask']),
+                                          output_names=['duramask'])),
                              name='dura_masker')
 
-    wf.connect(n4, 'output_image', dura_masker, 'inv2')
+    wf.connect(n4, n4_output, dura_masker, 'inv2')
     wf.connect(nighres_brain_extract, 'brainmask', dura_masker, 'inv2_mask')
 
 
 
-    afni_mask = pe.Node(afni.Automask(outputtype='NIFTI_GZ',
+    afni_mask = pe.Node(afni.Automask(outputtype=output_type,
                                       clfrac=0.5),
                         name='afni_mask')
     wf.connect(bet, 'out_file', afni_mask, 'in_file')
 
-    threshold_dura = pe.Node(fsl.Threshold(thresh=.8, args='-bin'),
+    threshold_dura = pe.Node(fsl.Threshold(thresh=.8, args='-bin', output_type=output_type),
                              name='threshold_dura')
     wf.connect(dura_masker, 'duramask', threshold_dura, 'in_file')
 
-    mask_t1map = pe.Node(fsl.ApplyMask(), name='mask_t1map')
-    wf.connect(inputnode, 't1map', mask_t1map, 'in_file')
+    mask_t1map = pe.Node(fsl.ApplyMask(output_type=output_type), name='mask_t1map')
+    wf.connect(images, 't1map', mask_t1map, 'in_file')
     wf.connect(afni_mask, 'out_file', mask_t1map, 'mask_file')
 
     t1w_masker = pe.Node(niu.Function(function=mask_t1w,
                                     input_names=['t1w', 'inv2', 't1w_mask',
                                                  'dura_mask', 'manual_inside', 
-                                                 'manual_outside'],
+                                                 'manual_outside', 'num_threads'],
                                     output_names=['out_file',
                                                   'brain_mask']),
                        name='t1w_masker')
 
 
-    wf.connect(inputnode, 't1w', t1w_masker, 't1w')
-    wf.connect(inputnode, 'manual_inside', t1w_masker, 'manual_inside')
-    wf.connect(inputnode, 'manual_outside', t1w_masker, 'manual_outside')
-    wf.connect(n4, 'output_image', t1w_masker, 'inv2')
+    wf.connect(images, 't1w', t1w_masker, 't1w')
+    wf.connect(masks, 'manual_inside', t1w_masker, 'manual_inside')
+    wf.connect(masks, 'manual_outside', t1w_masker, 'manual_outside')
+    wf.connect(n4, n4_output, t1w_masker, 'inv2')
     wf.connect(afni_mask, 'out_file', t1w_masker, 't1w_mask')
     wf.connect(threshold_dura, 'out_file', t1w_masker, 'dura_mask')
 
 
-    ds_t1map = pe.Node(DerivativesDataSink(base_directory=derivatives,
-                                         keep_dtype=False,
-                                         out_path_base='masked_mp2rages',
-                                         suffix='T1map',
-                                         desc='masked',
-                                         space='average'),
-                                         name='ds_t1map')
-
-    wf.connect(inputnode, 't1map', ds_t1map, 'source_file')
-    wf.connect(mask_t1map, 'out_file', ds_t1map, 'in_file')
-
-    ds_t1w = pe.Node(DerivativesDataSink(base_directory=derivatives,
-                                         keep_dtype=False,
-                                         out_path_base='masked_mp2rages',
-                                         desc='masked',
-                                         suffix='T1w'),
-                                         name='ds_t1w')
-
-
-    ds_dura = pe.Node(DerivativesDataSink(base_directory=derivatives,
-                                         keep_dtype=False,
-                                         out_path_base='masked_mp2rages',
-                                         desc='dura',
-                                         suffix='mask'),
-                                         name='ds_dura')
-
-    ds_brainmask = pe.Node(DerivativesDataSink(base_directory=derivatives,
-                                         keep_dtype=False,
-                                         out_path_base='masked_mp2rages',
-                                         desc='brainmask',
-                                         suffix='mask'),
-                                         name='ds_brainmask')
-
-    wf.connect(inputnode, 't1w', ds_t1w, 'source_file')
-    wf.connect(t1w_masker, 'out_file', ds_t1w, 'in_file')
-
-    wf.connect(inputnode, 't1w', ds_dura, 'source_file')
-    wf.connect(dura_masker, 'duramask', ds_dura, 'in_file')
-
-    wf.connect(inputnode, 't1w', ds_brainmask, 'source_file')
-    wf.connect(t1w_masker, 'brain_mask', ds_brainmask, 'in_file')
+    # The masks are sinked as they are, without reorienting
+    merge_derivatives = pe.Node(niu.Merge(4), name='merge_derivatives')
+    wf.connect(mask_t1map, 'out_file', merge_derivatives, 'in1')
+    wf.connect(t1w_masker, 'out_file', merge_derivatives, 'in2')
+    wf.connect(dura_masker, 'duramask', merge_derivatives, 'in3')
+    wf.connect(t1w_masker, 'brain_mask', merge_derivatives, 'in4')
+
+    merge_sources = pe.Node(niu.Merge(4), name='merge_sources')
+    if from_combine:
+        for ix in range(1, 5):
+            wf.connect(inputnode, 'source_file', merge_sources, 'in{}'.format(ix))
+    else:
+        wf.connect(inputnode, 't1map', merge_sources, 'in1')
+        wf.connect(inputnode, 't1w', merge_sources, 'in2')
+        wf.connect(inputnode, 't1w', merge_sources, 'in3')
+        wf.connect(inputnode, 't1w', merge_sources, 'in4')
+
+    ds_derivatives = pe.Node(niu.Function(function=sink_derivatives,
+                                          input_names=['in_files', 'source_files',
+                                                       'specs', 'base_directory',
+                                                       'reorient', 'uncrop', 'num_threads'],
+                                          output_names=['out_files']),
+                             name='ds_derivatives')
+    ds_derivatives.inputs.base_directory = derivatives
+    ds_derivatives.inputs.reorient = from_combine
+    ds_derivatives.inputs.uncrop = crop or from_combine
+    ds_derivatives.inputs.specs = [{'out_path_base': 'masked_mp2rages', 'suffix': 'T1map', 'desc': 'masked'},
+                                   {'out_path_base': 'masked_mp2rages', 'suffix': 'T1w', 'desc': 'masked'},
+                                   {'out_path_base': 'masked_mp2rages', 'suffix': 'mask', 'desc': 'dura'},
+                                   {'out_path_base': 'masked_mp2rages', 'suffix': 'mask', 'desc': 'brainmask'}]
+
+    # The source file is not in the average space yet
+    if from_combine:
+        ds_derivatives.inputs.specs = [dict(spec, space='average') for spec in ds_derivatives.inputs.specs]
+
+    wf.connect(merge_derivatives, 'out', ds_derivatives, 'in_files')
+    wf.connect(merge_sources, 'out', ds_derivatives, 'source_files')
+
+    # The averaged images are covered by the manifest of combining (its
+    # digest is recorded as upstream), so only the manual masks are inputs
+    provenance = init_provenance_node('mask', derivatives,
+                                      input_names=['manual_inside', 'manual_outside'],
+                                      parameters={'crop': crop,
+                                                  'n4_fast': n4_fast,
+                                                  'n4_shrink_factor': n4_shrink_factor,
+                                                  'n4_iterations': list(n4_iterations),
+                                                  'n4_convergence_threshold': n4_convergence_threshold},
+                                      route='combine' if from_combine else None)
+    wf.connect(inputnode, 'manual_inside', provenance, 'manual_inside')
+    wf.connect(inputnode, 'manual_outside', provenance, 'manual_outside')
+    wf.connect(inputnode, 'source_file' if from_combine else 't1w', provenance, 'source_file')
+    wf.connect(ds_derivatives, 'out_files', provenance, 'out_files')
 
     return wf
 
 def get_bids_file(layout,
                   subject,
                   suffix,
+                  session=None,
                   filter=None):
 
+    # (Without a session, e.g. for datasets without sessions, any)
+    entities = {'session': session} if session else {}
+
     img = layout.get(subject=subject,
                      suffix=suffix,
-                     return_type='file')
+                     return_type='file',
+                     **entities)
 
     if filter is not None:
         img = [im for im in img if filter in im]
 
     if len(img) == 0:
-        raise Exception('Found no image for {}, {}'.format(modality, 
+        raise Exception('Found no image for {}, {}'.format(suffix, 
                                                            filter))
     if len(img) > 1:
-        warnings.warn('Found more than one {}-image, using {}'.format(modality,
+        warnings.warn('Found more than one {}-image, using {}'.format(suffix,
                                                                       img[0]))
 
     return img[0]
 
 if __name__ == '__main__':
-    parser = argparse.ArgumentParser()
-    parser.add_argument("subject", 
-                        type=str,
-                        help="subject to process")
-    parser.add_argument('session', 
-                        nargs='?', 
-                        default=None,
-                        help="subject to process")
-
-    args = parser.parse_args()
-
-    main('/sourcedata', 
-         '/derivatives',
-         tmp_dir='/workflow_folders',
-         subject=args.subject,
-         session=args.session)
-
+    import cli
+    cli.main(['mask'] + sys.argv[1:])
@@ -0,0 +1,269 @@
+import argparse
+import os
+import sys
+import time
+import fcntl
+import secrets
+import tempfile
+import threading
+import traceback
+import subprocess
+from multiprocessing.connection import Listener, Client
+
+# nighres functions the worker runs, by job name
+functions = {'skullstrip': ('nighres.brain', 'mp2rage_skullstripping'),
+             'dura': ('nighres.brain', 'mp2rage_dura_estimation')}
+
+
+def get_worker_dir():
+    # Unix socket paths are limited to ~100 characters, so not in the cache dir
+    worker_dir = os.path.join(tempfile.gettempdir(), 'mp2rage_nighres_{}'.format(os.getuid()))
+
+    if not os.path.exists(worker_dir):
+        os.makedirs(worker_dir, mode=0o700, exist_ok=True)
+
+    return worker_dir
+
+
+def get_authkey():
+    # Connections are authenticated (they carry pickles) with a key that only
+    # this user can read
+    fn = os.path.join(get_worker_dir(), 'authkey')
+
+    if not os.path.exists(fn):
+        fd = os.open(fn + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(secrets.token_bytes(32))
+        os.replace(fn + '.tmp', fn)
+
+    with open(fn, 'rb') as f:
+        return f.read()
+
+
+class NighresWorker(object):
+    # Runs nighres jobs, one at a time, in a process that keeps the JVM (and
+    # the CBS-tools classes) loaded. Results are sent back as arrays; the last
+    # few are also kept in memory, so that a job that gets the output of a
+    # previous one (e.g., the skullstrip mask for the dura estimation) does
+    # not read it from disk again
+
+    def __init__(self, address, idle_timeout=900, n_kept=4):
+        self.address = address
+        self.idle_timeout = idle_timeout
+        self.n_kept = n_kept
+        self.images = {}
+        self.last_active = time.time()
+        self.busy = False
+        # Held while a connection is taken on and while the watchdog stops
+        # the worker, so that it does not stop during a job
+        self.lock = threading.Lock()
+
+    def serve(self):
+        if os.path.exists(self.address):
+            os.remove(self.address)
+
+        listener = Listener(self.address, family='AF_UNIX', authkey=get_authkey())
+        print('nighres worker listening on {}'.format(self.address))
+        sys.stdout.flush()
+
+        watchdog = threading.Thread(target=self._watchdog)
+        watchdog.daemon = True
+        watchdog.start()
+
+        # Import nighres (and JCC) right away, not on the first job
+        self.get_function('skullstrip')
+
+        while True:
+            with listener.accept() as connection:
+                with self.lock:
+                    self.busy = True
+                try:
+                    self.handle(connection)
+                except (EOFError, OSError):
+                    pass
+                finally:
+                    with self.lock:
+                        self.busy = False
+                        self.last_active = time.time()
+
+    def _watchdog(self):
+        # A client that connects just before the worker stops gets EOFError
+        # (and starts a new worker, see run_nighres); once a job was taken
+        # on, the worker does not stop before it is done
+        while True:
+            time.sleep(10)
+            with self.lock:
+                if not self.busy and time.time() - self.last_active > self.idle_timeout:
+                    print('nighres worker idle for {}s, stopping'.format(self.idle_timeout))
+                    try:
+                        os.remove(self.address)
+                    finally:
+                        os._exit(0)
+
+    def get_function(self, name):
+        import importlib
+
+        module, function = functions[name]
+        return getattr(importlib.import_module(module), function)
+
+    def handle(self, connection):
+        job = connection.recv()
+
+        try:
+            t0 = time.time()
+            results = run_job(job, images=self.images)
+            print('{} ({:.1f}s)'.format(job['function'], time.time() - t0))
+        except Exception:
+            connection.send({'error': traceback.format_exc()})
+            return
+
+        connection.send({'results': {key: _to_arrays(img) for key, img in results.items()}})
+
+        # The client tells where (and when) it wrote the results
+        written = connection.recv()
+        for key, (fn, mtime_ns) in written.items():
+            self.images[fn] = (results[key], mtime_ns)
+
+        while len(self.images) > self.n_kept:
+            del self.images[next(iter(self.images))]
+
+
+def run_job(job, images=None):
+    # Runs a nighres function on the files in job['args'], using the images
+    # in `images` (path -> (image, mtime_ns)) if they did not change on disk
+    import importlib
+
+    if images is None:
+        images = {}
+
+    args = []
+    for arg in job['args']:
+        if isinstance(arg, str) and arg in images and os.stat(arg).st_mtime_ns == images[arg][1]:
+            arg = images[arg][0]
+        args.append(arg)
+
+    module, function = functions[job['function']]
+    function = getattr(importlib.import_module(module), function)
+
+    results = function(*args, save_data=False)
+
+    return {key: results[key] for key in job['outputs']}
+
+
+def run_nighres(function, args, out_files):
+    # Runs a nighres function in the persistent worker (started if needed)
+    # and writes the outputs (name -> filename in out_files). Set
+    # MP2RAGE_NIGHRES_WORKERS=0 to run nighres in this process instead
+    import nibabel as nb
+
+    job = {'function': function,
+           'args': args,
+           'outputs': list(out_files)}
+
+    n_workers = int(os.environ.get('MP2RAGE_NIGHRES_WORKERS', 1))
+
+    if n_workers <= 0:
+        for key, img in run_job(job).items():
+            img.to_filename(out_files[key])
+        return out_files
+
+    # Every worker serves one client at a time. A worker that stopped (idle,
+    # or crashed) before it answered is replaced by a fresh one, once (a
+    # stopping worker removes its socket first)
+    with _claim_worker(n_workers) as address:
+        for attempt in range(2):
+            connection = _connect(address)
+
+            try:
+                connection.send(job)
+                response = connection.recv()
+            except (EOFError, ConnectionResetError, BrokenPipeError):
+                connection.close()
+                if attempt > 0:
+                    raise
+                print('nighres worker {} stopped, starting a new one'.format(address))
+            else:
+                break
+
+        with connection:
+            if 'error' in response:
+                raise Exception('nighres worker failed:\n{}'.format(response['error']))
+
+            written = {}
+            for key, (data, affine, header) in response['results'].items():
+                nb.Nifti1Image(data, affine, header).to_filename(out_files[key])
+                written[key] = (out_files[key], os.stat(out_files[key]).st_mtime_ns)
+
+            connection.send(written)
+
+    return out_files
+
+
+class _claim_worker(object):
+    # Locks the first free worker slot (or waits for the first one)
+
+    def __init__(self, n_workers):
+        self.n_workers = n_workers
+        self.lock = None
+
+    def __enter__(self):
+        worker_dir = get_worker_dir()
+
+        for ix in range(self.n_workers):
+            self.lock = open(os.path.join(worker_dir, 'worker-{}.lock'.format(ix)), 'w')
+            try:
+                fcntl.flock(self.lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                self.lock.close()
+                continue
+            return os.path.join(worker_dir, 'worker-{}.sock'.format(ix))
+
+        # All workers are busy
+        self.lock = open(os.path.join(worker_dir, 'worker-0.lock'), 'w')
+        fcntl.flock(self.lock, fcntl.LOCK_EX)
+        return os.path.join(worker_dir, 'worker-0.sock')
+
+    def __exit__(self, *args):
+        self.lock.close()
+
+
+def _connect(address, timeout=120):
+    try:
+        return Client(address, family='AF_UNIX', authkey=get_authkey())
+    except (FileNotFoundError, ConnectionRefusedError):
+        pass
+
+    # Nobody is listening: start a worker, detached from this process
+    log = open(address.replace('.sock', '.log'), 'a')
+    subprocess.Popen([sys.executable, os.path.abspath(__file__), address],
+                     cwd=os.path.dirname(os.path.abspath(__file__)),
+                     stdout=log, stderr=subprocess.STDOUT,
+                     start_new_session=True)
+
+    t0 = time.time()
+    while time.time() - t0 < timeout:
+        try:
+            return Client(address, family='AF_UNIX', authkey=get_authkey())
+        except (FileNotFoundError, ConnectionRefusedError):
+            time.sleep(.5)
+
+    raise Exception('nighres worker did not start, see {}'.format(log.name))
+
+
+def _to_arrays(img):
+    import numpy as np
+    return np.asanyarray(img.dataobj), img.affine, img.header
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('address',
+                        help="Unix socket to listen on")
+    parser.add_argument('--idle-timeout',
+                        type=float,
+                        default=900,
+                        help="stop after this many seconds without jobs")
+
+    args = parser.parse_args()
+
+    NighresWorker(args.address, idle_timeout=args.idle_timeout).serve()
@@ -0,0 +1,261 @@
+import argparse
+import os
+import json
+import numpy as np
+import nibabel as nb
+
+# T1 (s), proton density and T2* (s) of the tissue classes at 7T
+tissues = {'background': (0., 0., 0.),
+           'scalp': (.4, .9, .02),
+           'skull': (.6, .1, .01),
+           'csf': (4., 1., .1),
+           'gm': (1.9, .8, .033),
+           'wm': (1.15, .7, .028)}
+
+# Sequence parameters of the two protocols (times in seconds)
+protocols = {'mp2rage': {'InversionRepetitionTime': 5.,
+                         'InversionTime': (.8, 2.7),
+                         'FlipAngle': (4, 5),
+                         'ExcitationRepetitionTime': .0062,
+                         'EchoTime': (.0025,)},
+             'memp2rage': {'InversionRepetitionTime': 6.,
+                           'InversionTime': (.67, 3.855),
+                           'FlipAngle': (7, 6),
+                           'ExcitationRepetitionTime': .0291,
+                           'EchoTime': (.006, .0145, .023, .0315)}}
+
+
+def get_phantom(shape, head_fraction=1.):
+    # Nested ellipsoids: scalp, skull, CSF, grey matter and white matter. The
+    # head spans head_fraction of the FOV along every axis
+    grid = np.ogrid[tuple(slice(0, s) for s in shape)]
+    radius = np.sqrt(sum(((g - s / 2.) / (s / 2.)) ** 2 for g, s in zip(grid, shape))) / head_fraction
+
+    # Some gyrification, so the grey matter is not a perfect shell
+    angle = np.arctan2(grid[1] - shape[1] / 2., grid[0] - shape[0] / 2.)
+    folding = .03 * np.sin(8 * angle) * np.cos(6. * grid[2] / shape[2] * np.pi)
+
+    labels = np.zeros(shape, dtype=np.uint8)
+    for ix, (name, outer) in enumerate([('scalp', .95), ('skull', .88), ('csf', .82),
+                                        ('gm', .78), ('wm', .65)]):
+        if name == 'wm':
+            labels[radius + folding < outer] = ix + 1
+        else:
+            labels[radius < outer] = ix + 1
+
+    return labels
+
+
+def get_b1(shape):
+    # Smooth, centrally brightened transmit field, as typical at 7T
+    grid = np.ogrid[tuple(slice(0, s) for s in shape)]
+    radius2 = sum(((g - s / 2.) / (s / 2.)) ** 2 for g, s in zip(grid, shape))
+    return (1.15 - .35 * radius2).astype(np.float32)
+
+
+def simulate_mp2rage(labels, protocol, b1, rng, noise=.005, inversion_efficiency=.96):
+    # Simplified MP2RAGE signal: the readout after every inversion sees a
+    # longitudinal magnetization of 1 - (1 + efficiency) * exp(-TI / T1),
+    # weighted by PD, the (B1-scaled) flip angle and T2*-decay
+    t1 = np.zeros(labels.shape, dtype=np.float32)
+    pd = np.zeros(labels.shape, dtype=np.float32)
+    t2star = np.ones(labels.shape, dtype=np.float32)
+
+    for ix, (t1_, pd_, t2star_) in enumerate(tissues.values()):
+        t1[labels == ix] = t1_
+        pd[labels == ix] = pd_
+        t2star[labels == ix] = t2star_ if t2star_ > 0 else 1.
+
+    t1[t1 == 0] = 1.
+
+    # Smooth background phase
+    grid = np.ogrid[tuple(slice(0, s) for s in labels.shape)]
+    phase = sum(np.pi * (g / float(s)) * w for g, s, w in zip(grid, labels.shape, (.7, -.4, .3)))
+
+    images = {}
+    for inv, (ti, flip_angle) in enumerate(zip(protocol['InversionTime'], protocol['FlipAngle'])):
+        mz = 1 - (1 + inversion_efficiency) * np.exp(-ti / t1)
+        signal = pd * np.sin(np.deg2rad(flip_angle) * b1) * mz
+
+        # Only the second inversion is multi-echo
+        echo_times = protocol['EchoTime'] if inv == 1 else protocol['EchoTime'][:1]
+
+        for echo, te in enumerate(echo_times):
+            decayed = signal * np.exp(-te / t2star)
+            complex_signal = decayed * np.exp(1j * phase)
+            complex_signal += rng.normal(0, noise, labels.shape) + 1j * rng.normal(0, noise, labels.shape)
+
+            images[(inv + 1, echo + 1)] = (np.abs(complex_signal).astype(np.float32),
+                                           np.angle(complex_signal).astype(np.float32))
+
+    return images
+
+
+def make_phantom_dataset(sourcedata,
+                         subject='01',
+                         session='1',
+                         shape=(96, 96, 72),
+                         resolution=None,
+                         acquisitions=('mp2rage', 'memp2rage'),
+                         b1map=True,
+                         seed=0,
+                         head_fraction=1.):
+    # Writes a BIDS MP2RAGE/MEMP2RAGE dataset (magnitude and phase of every
+    # inversion and echo, with sidecars) as get_mp2rage_pars expects it
+    if resolution is None:
+        resolution = 240. / shape[0]
+
+    rng = np.random.RandomState(seed)
+    labels = get_phantom(shape, head_fraction=head_fraction)
+    b1 = get_b1(shape)
+
+    affine = np.diag([resolution, resolution, resolution, 1.])
+    affine[:3, 3] = -np.array(shape) * resolution / 2.
+
+    anat_dir = os.path.join(sourcedata, 'sub-{}'.format(subject), 'ses-{}'.format(session), 'anat')
+    if not os.path.exists(anat_dir):
+        os.makedirs(anat_dir)
+
+    if not os.path.exists(os.path.join(sourcedata, 'dataset_description.json')):
+        with open(os.path.join(sourcedata, 'dataset_description.json'), 'w') as f:
+            json.dump({'Name': 'MP2RAGE phantom', 'BIDSVersion': '1.1.1'}, f)
+
+    fns = []
+    for acquisition in acquisitions:
+        protocol = protocols[acquisition]
+        images = simulate_mp2rage(labels, protocol, b1, rng)
+        multi_echo = len(protocol['EchoTime']) > 1
+
+        for (inv, echo), (magnitude, phase) in sorted(images.items()):
+            echo_str = '_echo-{}'.format(echo) if (multi_echo and inv == 2) else ''
+            stem = 'sub-{}_ses-{}_acq-{}_inv-{}{}'.format(subject, session, acquisition, inv, echo_str)
+
+            for part, data in [('mag', magnitude), ('phase', phase)]:
+                fns.append(os.path.join(anat_dir, '{}_part-{}_MPRAGE.nii.gz'.format(stem, part)))
+                nb.Nifti1Image(data, affine).to_filename(fns[-1])
+
+            sidecar = {'InversionRepetitionTime': protocol['InversionRepetitionTime'],
+                       'InversionTime': protocol['InversionTime'][inv - 1],
+                       'FlipAngle': protocol['FlipAngle'][inv - 1],
+                       'ExcitationRepetitionTime': protocol['ExcitationRepetitionTime'],
+                       'RepetitionTime': protocol['ExcitationRepetitionTime'],
+                       'EchoTime': protocol['EchoTime'][echo - 1],
+                       'NumberShots': shape[2],
+                       'MagneticFieldStrength': 7}
+
+            fns.append(os.path.join(anat_dir, '{}_MPRAGE.json'.format(stem)))
+            with open(fns[-1], 'w') as f:
+                json.dump(sidecar, f, indent=2)
+
+    if b1map:
+        fmap_dir = os.path.join(sourcedata, 'sub-{}'.format(subject), 'ses-{}'.format(session), 'fmap')
+        if not os.path.exists(fmap_dir):
+            os.makedirs(fmap_dir)
+
+        # The B1 map is acquired at a much lower resolution
+        factor = 4
+        b1_affine = affine.copy()
+        b1_affine[:3, :3] *= factor
+        fns.append(os.path.join(fmap_dir, 'sub-{}_ses-{}_B1map.nii.gz'.format(subject, session)))
+        nb.Nifti1Image(b1[::factor, ::factor, ::factor] * 100., b1_affine).to_filename(fns[-1])
+
+    return fns
+
+
+def make_phantom_derivatives(derivatives,
+                             subject='01',
+                             session='1',
+                             shape=(96, 96, 72),
+                             resolution=None):
+    # The derivatives the masking and Freesurfer-steps read besides the
+    # averaged images: manual masks and a Freesurfer brain mask
+    if resolution is None:
+        resolution = 240. / shape[0]
+
+    labels = get_phantom(shape)
+    affine = np.diag([resolution, resolution, resolution, 1.])
+    affine[:3, 3] = -np.array(shape) * resolution / 2.
+
+    # A strip of sagittal sinus in the CSF that should be masked out, and a
+    # bit of cortex that should be kept
+    outside = np.zeros(shape, dtype=np.uint8)
+    strip = (slice(shape[0] // 2 - 2, shape[0] // 2 + 2), slice(None), slice(shape[2] // 2, None))
+    outside[strip] = labels[strip] == 3
+
+    inside = (labels == 4) & (np.arange(shape[0])[:, np.newaxis, np.newaxis] < shape[0] // 4)
+
+    fns = {}
+    anat_dir = os.path.join(derivatives, 'manual_segmentation', 'sub-{}'.format(subject),
+                            'ses-{}'.format(session), 'anat')
+    if not os.path.exists(anat_dir):
+        os.makedirs(anat_dir)
+
+    for description, data in [('outside', outside), ('gm', inside)]:
+        fns[description] = os.path.join(anat_dir,
+                                        'sub-{}_ses-{}_space-average_desc-{}_mask.nii.gz'.format(subject,
+                                                                                                 session,
+                                                                                                 description))
+        nb.Nifti1Image(data.astype(np.uint8), affine).to_filename(fns[description])
+
+    # Freesurfer works at 1 mm, conformed to 256^3
+    fs_dir = os.path.join(derivatives, 'freesurfer', 'sub-{}'.format(subject), 'mri')
+    if not os.path.exists(fs_dir):
+        os.makedirs(fs_dir)
+
+    conformed_shape = (256, 256, 256)
+    fs_affine = np.diag([-1., 1., 1., 1.])
+    fs_affine[:3, 3] = [128, -128, -128]
+
+    fs_labels = get_phantom(conformed_shape)
+    brainmask = np.where(fs_labels >= 4, 110, 0).astype(np.uint8)
+    fns['brainmask'] = os.path.join(fs_dir, 'brainmask.mgz')
+    nb.freesurfer.MGHImage(brainmask, fs_affine).to_filename(fns['brainmask'])
+
+    return fns
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('sourcedata',
+                        help="folder to write the BIDS dataset to")
+    parser.add_argument('--derivatives',
+                        default=None,
+                        help="also write manual masks and a Freesurfer brainmask here")
+    parser.add_argument('--subjects',
+                        nargs='+',
+                        default=['01'])
+    parser.add_argument('--session',
+                        default='1')
+    parser.add_argument('--shape',
+                        nargs=3,
+                        type=int,
+                        default=[96, 96, 72],
+                        help="matrix size")
+    parser.add_argument('--resolution',
+                        type=float,
+                        default=None,
+                        help="isotropic voxel size (mm, default: a 240 mm FOV)")
+    parser.add_argument('--head-fraction',
+                        type=float,
+                        default=1.,
+                        help="extent of the head as a fraction of the FOV (<1 leaves empty margins)")
+    parser.add_argument('--no-b1map',
+                        action='store_true')
+
+    args = parser.parse_args()
+
+    for subject in args.subjects:
+        make_phantom_dataset(args.sourcedata,
+                             subject=subject,
+                             session=args.session,
+                             shape=tuple(args.shape),
+                             resolution=args.resolution,
+                             b1map=not args.no_b1map,
+                             head_fraction=args.head_fraction)
+
+        if args.derivatives:
+            make_phantom_derivatives(args.derivatives,
+                                     subject=subject,
+                                     session=args.session,
+                                     shape=tuple(args.shape),
+                                     resolution=args.resolution)
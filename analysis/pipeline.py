@@ -0,0 +1,187 @@
+import os
+import sys
+import nipype.pipeline.engine as pe
+import nipype.interfaces.utility as niu
+from combine_scans import init_combine_mp2rage_wf
+from make_qmri_maps import init_qmri_wf
+from mask_mp2rage import init_masking_wf, get_masking_inputs, get_manual_masks
+from utils import _pickone, STAGES
+from profiling import run_workflow
+from bids_index import BIDSIndex
+from resources import set_subject_resources
+
+# The acquisitions the combine workflow gets, in this order: all are
+# registered to the first one, which is also the one of the qMRI maps
+acquisitions = ['memp2rage', 'mp2rage']
+
+
+def main(sourcedata,
+         derivatives,
+         tmp_dir,
+         subject,
+         session=None,
+         stages=('combine', 'qmri', 'mask'),
+         n_procs=4,
+         crop=False,
+         n4_fast=False,
+         memory_gb=None):
+
+    # (Once, for all nodes that look up the parameters of the subject)
+    BIDSIndex(sourcedata).update(subject=subject)
+
+    wf = init_pipeline_wf(sourcedata,
+                          derivatives,
+                          subject,
+                          session,
+                          stages=stages,
+                          name='mp2rage_pipeline_{}'.format(subject),
+                          crop=crop,
+                          n4_fast=n4_fast,
+                          num_threads=min(n_procs, 8),
+                          memory_gb=memory_gb)
+
+    if wf is None:
+        raise Exception('Nothing to run for subject {}'.format(subject))
+
+    wf.base_dir = tmp_dir
+
+    run_workflow(wf,
+                 plugin='MultiProc',
+                 plugin_args=get_plugin_args(n_procs, memory_gb),
+                 profile_dir=os.path.join(derivatives, 'profiles'))
+
+
+def init_pipeline_wf(sourcedata,
+                     derivatives,
+                     subject,
+                     session=None,
+                     stages=('combine', 'qmri', 'mask'),
+                     name='mp2rage_pipeline',
+                     crop=False,
+                     n4_fast=False,
+                     num_threads=8,
+                     memory_gb=None):
+    # The stages of one subject as one graph. When combining is one of them,
+    # masking gets the averages and qMRI the parameters of the MEMP2RAGE
+    # straight from the combine workflow, so neither waits for (nor indexes
+    # or reads) its derivatives, and the qMRI maps are made while the
+    # acquisitions are still being registered and averaged. Stages that run
+    # on their own find their inputs in the derivatives, as before. The
+    # nodes declare the memory and processes they need (see resources.py,
+    # within memory_gb and num_threads), so the scheduler does not start
+    # more of them than fit, and use as many threads as they declared
+
+    for stage in stages:
+        if stage not in STAGES:
+            raise Exception('Unknown stage {}'.format(stage))
+
+    wf = pe.Workflow(name=name)
+    stage_wfs = []
+    combine_wf = None
+
+    if 'combine' in stages:
+        combine_wf = init_combine_mp2rage_wf(sourcedata=sourcedata,
+                                             derivatives=derivatives,
+                                             name='combine_mp2rages_{}'.format(subject),
+                                             crop=crop)
+
+        combine_wf.inputs.inputnode.subject = subject
+        combine_wf.inputs.inputnode.session = session if session else '.*'
+        combine_wf.inputs.inputnode.acquisition = acquisitions
+        stage_wfs.append(combine_wf)
+
+    if 'qmri' in stages:
+        qmri_wf = init_qmri_wf(sourcedata,
+                               derivatives,
+                               name='qmri_mp2rage_{}'.format(subject),
+                               from_combine=combine_wf is not None,
+                               crop=crop)
+
+        if combine_wf is not None:
+            wf.connect(combine_wf, ('outputnode.mp2rage_parameters', _pickone),
+                       qmri_wf, 'inputnode.mp2rage_parameters')
+            wf.connect(combine_wf, ('outputnode.fit_parameters', _pickone),
+                       qmri_wf, 'inputnode.fit_parameters')
+        else:
+            qmri_wf.inputs.inputnode.subject = subject
+            qmri_wf.inputs.inputnode.session = session if session else '.*'
+            qmri_wf.inputs.inputnode.acquisition = 'memp2rage'
+        stage_wfs.append(qmri_wf)
+
+    if 'mask' in stages:
+        try:
+            if combine_wf is not None:
+                mask_inputs = get_manual_masks(derivatives, subject, session)
+            else:
+                mask_inputs = get_masking_inputs(derivatives, subject, session)
+        except Exception as e:
+            print('Skipping masking of {}: {}'.format(subject, e))
+        else:
+            mask_wf = init_masking_wf(name='mask_wf_{}'.format(subject),
+                                      derivatives=derivatives,
+                                      crop=crop,
+                                      n4_fast=n4_fast,
+                                      num_threads=num_threads,
+                                      from_combine=combine_wf is not None)
+            for key, value in mask_inputs.items():
+                setattr(mask_wf.inputs.inputnode, key, value)
+
+            if combine_wf is not None:
+                for field in ['t1w', 't1map', 'inv2', 'source_file']:
+                    wf.connect(combine_wf, 'outputnode.{}'.format(field),
+                               mask_wf, 'inputnode.{}'.format(field))
+                # (Also makes sure it is written first)
+                wf.connect(combine_wf, ('provenance.manifest', _aslist),
+                           mask_wf, 'provenance.upstream')
+            stage_wfs.append(mask_wf)
+
+    if 'fs-brainmask' in stages:
+        fs_brainmask = pe.Node(niu.Function(function=run_update_fs_brainmask,
+                                            input_names=['derivatives',
+                                                         'subject',
+                                                         'session'],
+                                            output_names=[]),
+                               name='update_fs_brainmask')
+        fs_brainmask.inputs.derivatives = derivatives
+        fs_brainmask.inputs.subject = subject
+        fs_brainmask.inputs.session = session
+        # Its inputs are not files nipype could hash; update_fs_brainmask
+        # skips edits that were applied already itself
+        fs_brainmask.overwrite = True
+        stage_wfs.append(fs_brainmask)
+
+    if len(stage_wfs) == 0:
+        return None
+
+    # (Connected stages are in the graph already)
+    wf.add_nodes([stage_wf for stage_wf in stage_wfs if stage_wf not in wf._graph])
+
+    set_subject_resources(wf, sourcedata, subject, session,
+                          num_threads=num_threads, memory_gb=memory_gb)
+
+    return wf
+
+
+def get_plugin_args(n_procs, memory_gb=None):
+    # MultiProc starts nodes as long as their n_procs and mem_gb fit in
+    # these (by default all memory)
+    plugin_args = {'n_procs': n_procs}
+
+    if memory_gb is not None:
+        plugin_args['memory_gb'] = memory_gb
+
+    return plugin_args
+
+
+def _aslist(value):
+    return [value]
+
+
+def run_update_fs_brainmask(derivatives, subject, session):
+    from update_fs_brainmask import main
+    main(None, derivatives, None, subject=subject, session=session)
+
+
+if __name__ == '__main__':
+    import cli
+    cli.main(['pipeline'] + sys.argv[1:])
@@ -0,0 +1,337 @@
+import os
+import json
+import time
+import threading
+from resources import record_peaks
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+class WorkflowProfiler(object):
+    # Records, for every node of a workflow, wall time (from nipype's status
+    # callbacks) and CPU time, peak RSS, bytes read/written and peak thread
+    # count. The latter are sampled (with psutil) from all processes of the
+    # run, which are attributed to the node whose working directory they are
+    # in: nipype runs every node, including its command-line tools, inside
+    # the node directory. That only covers plugins that run the nodes in
+    # this process or its children (Linear, MultiProc): with sample=False
+    # (e.g., for SharedFSPlugin or the cluster plugins, whose nodes run in
+    # other process trees or on other machines), only wall times are
+    # recorded
+
+    def __init__(self, wf, interval=.5, status_callback=None, sample=True):
+        self.wf = wf
+        self.interval = interval
+        self.status_callback = status_callback
+        self.sampled = sample and psutil is not None
+        self.base_dir = os.path.join(os.path.abspath(wf.base_dir), wf.name)
+        self.nodes = {}
+        self.processes = {}
+        self.graph = None
+        self.declared = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __call__(self, node, status):
+        key = self.get_key(node.output_dir())
+        now = time.time()
+        record = self._get_record(key)
+
+        if status == 'start':
+            record['start'] = min(record['start'] or now, now)
+        elif status in ('end', 'exception'):
+            record['end'] = max(record['end'] or now, now)
+            record['n_runs'] += 1
+            if status == 'exception':
+                record['status'] = 'failed'
+
+        if self.status_callback is not None:
+            self.status_callback(node, status)
+
+    def __getstate__(self):
+        # Nodes keep the plugin arguments, and nipype pickles nodes
+        state = dict(self.__dict__)
+        state['_stop'] = state['_thread'] = None
+        return state
+
+    def get_key(self, node_dir):
+        # Subnodes of MapNodes (<mapnode>/mapflow/_<name><i>) count for their
+        # MapNode
+        node_dir = os.path.relpath(node_dir, self.base_dir)
+        return node_dir.split('{}mapflow{}'.format(os.sep, os.sep))[0]
+
+    def _get_record(self, key):
+        if key not in self.nodes:
+            self.nodes[key] = {'node': key,
+                               'start': None,
+                               'end': None,
+                               'n_runs': 0,
+                               'status': 'ok',
+                               'cpu_time_s': 0.,
+                               'peak_rss_mb': 0.,
+                               'read_mb': 0.,
+                               'written_mb': 0.,
+                               'peak_threads': 0}
+        return self.nodes[key]
+
+    def start(self):
+        # The dependencies between the nodes, for the critical path
+        # (the nodes of the flat graph are copies without a base_dir)
+        graph = self.wf._create_flat_graph()
+        self.graph = {}
+        for node in graph.nodes():
+            key = _get_node_key(node)
+            self.graph[key] = [_get_node_key(parent) for parent in graph.predecessors(node)]
+
+            # What the node declared, to compare with what it used (see
+            # resources.py)
+            self.declared[key] = {'mem_gb': node.mem_gb, 'n_procs': node.n_procs}
+            if getattr(node, 'resource_model', None) is not None:
+                self.declared[key].update({'resource_model': node.resource_model,
+                                           'resource_estimate': node.resource_estimate,
+                                           'resource_correction': node.resource_correction})
+
+        if psutil is None:
+            print('psutil is not installed, only profiling wall times')
+            return
+
+        if not self.sampled:
+            print('Nodes run outside of this process, only profiling wall times')
+            return
+
+        self._thread = threading.Thread(target=self._sample_loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _sample_loop(self):
+        main_process = psutil.Process()
+        while not self._stop.wait(self.interval):
+            self.sample(main_process)
+
+    def sample(self, main_process):
+        current = {}
+
+        try:
+            processes = [main_process] + main_process.children(recursive=True)
+        except psutil.Error:
+            return
+
+        for process in processes:
+            try:
+                with process.oneshot():
+                    cwd = process.cwd()
+                    rss = process.memory_info().rss
+                    cpu_times = process.cpu_times()
+                    cpu = cpu_times.user + cpu_times.system
+                    threads = process.num_threads()
+                    try:
+                        io = process.io_counters()
+                        io = (io.read_bytes, io.write_bytes)
+                    except (psutil.Error, AttributeError):
+                        io = (0, 0)
+            except psutil.Error:
+                continue
+
+            if not cwd.startswith(self.base_dir + os.sep):
+                # Idle workers, or the main process in between nodes
+                self.processes[process.pid] = (cpu, io)
+                continue
+
+            key = self.get_key(cwd)
+            record = self._get_record(key)
+
+            # Processes (e.g., pool workers) outlive nodes, so CPU time and
+            # I/O are attributed as increments since the previous sample
+            last_cpu, last_io = self.processes.get(process.pid, (0., (0, 0)))
+            record['cpu_time_s'] += max(cpu - last_cpu, 0.)
+            record['read_mb'] += max(io[0] - last_io[0], 0) / 1024. ** 2
+            record['written_mb'] += max(io[1] - last_io[1], 0) / 1024. ** 2
+            self.processes[process.pid] = (cpu, io)
+
+            rss_, threads_ = current.get(key, (0, 0))
+            current[key] = (rss_ + rss, threads_ + threads)
+
+        for key, (rss, threads) in current.items():
+            record = self.nodes[key]
+            record['peak_rss_mb'] = max(record['peak_rss_mb'], rss / 1024. ** 2)
+            record['peak_threads'] = max(record['peak_threads'], threads)
+
+    def get_profile(self):
+        nodes = []
+        t0 = min([record['start'] for record in self.nodes.values() if record['start']] or [0])
+
+        for key, record in sorted(self.nodes.items(), key=lambda item: item[1]['start'] or 0):
+            record = dict(record, **self.declared.get(key, {}))
+            if record['start'] is not None and record['end'] is not None:
+                record['wall_time_s'] = record['end'] - record['start']
+                record['start_s'] = record['start'] - t0
+            else:
+                record['wall_time_s'] = None
+                record['start_s'] = None
+
+            # How busy the node kept the threads it declared (above 1: it
+            # used more than its share)
+            if self.sampled and record['wall_time_s'] and record.get('n_procs'):
+                record['cpu_utilisation'] = record['cpu_time_s'] / record['wall_time_s'] / record['n_procs']
+            else:
+                record['cpu_utilisation'] = None
+            del record['start'], record['end']
+            nodes.append(record)
+
+        critical_path, critical_time = self.get_critical_path()
+
+        return {'workflow': self.wf.name,
+                'base_dir': self.base_dir,
+                'sampled': self.sampled,
+                'wall_time_s': max([record['end'] for record in self.nodes.values() if record['end']] or [t0]) - t0,
+                'critical_path': critical_path,
+                'critical_path_s': critical_time,
+                'nodes': nodes}
+
+    def get_critical_path(self):
+        # Longest path (in wall time) through the graph of nodes that ran
+        durations = {}
+        for key, record in self.nodes.items():
+            if record['start'] is not None and record['end'] is not None:
+                durations[key] = record['end'] - record['start']
+
+        finish = {}
+        previous = {}
+
+        def _finish(key):
+            if key not in finish:
+                finish[key] = 0.
+                previous[key] = None
+                for parent in self.graph.get(key, []):
+                    if _finish(parent) > finish[key]:
+                        finish[key] = finish[parent]
+                        previous[key] = parent
+                finish[key] += durations.get(key, 0.)
+            return finish[key]
+
+        for key in self.graph:
+            _finish(key)
+
+        if len(finish) == 0:
+            return [], 0.
+
+        key = max(finish, key=finish.get)
+        total = finish[key]
+        path = []
+        while key is not None:
+            path.insert(0, key)
+            key = previous[key]
+
+        return path, total
+
+    def write(self, profile_dir):
+        if not os.path.exists(profile_dir):
+            os.makedirs(profile_dir, exist_ok=True)
+
+        profile = self.get_profile()
+        fn = os.path.join(profile_dir, '{}_{}'.format(self.wf.name,
+                                                       time.strftime('%Y%m%d-%H%M%S')))
+
+        with open(fn + '.json', 'w') as f:
+            json.dump(profile, f, indent=2)
+
+        with open(fn + '.html', 'w') as f:
+            f.write(get_html(profile))
+
+        print('Wrote profile to {}.json/.html (critical path {:.1f}s of {:.1f}s)'.format(fn,
+                                                                                          profile['critical_path_s'],
+                                                                                          profile['wall_time_s']))
+
+        return fn + '.json', fn + '.html'
+
+
+def _get_node_key(node):
+    # The node directory, relative to that of the workflow
+    return os.path.join(*(node._hierarchy.split('.')[1:] + [node.name]))
+
+
+# The nipype plugins that run the nodes in the process of the run or its
+# children, whose resource use the profiler can sample
+local_plugins = ('Linear', 'MultiProc', 'LegacyMultiProc')
+
+
+def run_workflow(wf, plugin='Linear', plugin_args=None, profile_dir=None, interval=.5):
+    # wf.run(), with a profile of every node written to profile_dir (if given).
+    # plugin is the name of a nipype plugin or a plugin class of our own
+    # (e.g., sharedfs.SharedFSPlugin)
+    if profile_dir is None:
+        return wf.run(plugin=_get_plugin(plugin, plugin_args), plugin_args=plugin_args)
+
+    plugin_args = dict(plugin_args or {})
+    profiler = WorkflowProfiler(wf,
+                                interval=interval,
+                                status_callback=plugin_args.get('status_callback'),
+                                sample=plugin in local_plugins)
+    plugin_args['status_callback'] = profiler
+
+    profiler.start()
+    try:
+        return wf.run(plugin=_get_plugin(plugin, plugin_args), plugin_args=plugin_args)
+    finally:
+        profiler.stop()
+        profiler.write(profile_dir)
+        record_peaks(profiler.get_profile())
+
+
+def _get_plugin(plugin, plugin_args):
+    if isinstance(plugin, str):
+        return plugin
+    return plugin(plugin_args=plugin_args)
+
+
+def _format_cell(column, value):
+    if value is None:
+        return ''
+    if column == 'cpu_utilisation':
+        return '{:.2f}'.format(value)
+    if isinstance(value, float):
+        return '{:.1f}'.format(value)
+    return value
+
+
+def get_html(profile):
+    # A table of all nodes, with a timeline bar per node; nodes on the
+    # critical path are highlighted
+    total = max(profile['wall_time_s'], 1e-6)
+    critical = set(profile['critical_path'])
+    columns = ['wall_time_s', 'cpu_time_s', 'cpu_utilisation', 'peak_rss_mb', 'mem_gb', 'read_mb', 'written_mb',
+               'peak_threads', 'n_procs', 'n_runs', 'status']
+
+    rows = []
+    for node in profile['nodes']:
+        if node['start_s'] is not None:
+            bar = ('<div style="margin-left:{:.2f}%;width:{:.2f}%;background:{};height:1em"></div>'
+                   .format(100 * node['start_s'] / total,
+                           max(100 * node['wall_time_s'] / total, .2),
+                           '#d62728' if node['node'] in critical else '#1f77b4'))
+        else:
+            bar = ''
+
+        cells = ''.join('<td>{}</td>'.format(_format_cell(c, node.get(c))) for c in columns)
+        rows.append('<tr{}><td>{}</td>{}<td style="width:40%">{}</td></tr>'.format(' style="font-weight:bold"' if node['node'] in critical else '',
+                                                                                   node['node'], cells, bar))
+
+    return ('<html><head><meta charset="utf-8"><title>Profile {workflow}</title>'
+            '<style>body{{font-family:sans-serif}} td,th{{padding:2px 8px;text-align:right}} td:first-child{{text-align:left}}</style>'
+            '</head><body><h1>Profile {workflow}</h1>'
+            '<p>Wall time {wall:.1f}s, critical path {critical:.1f}s: {path}</p>'
+            '<table><tr><th>node</th>{header}<th>timeline</th></tr>{rows}</table>'
+            '</body></html>').format(workflow=profile['workflow'],
+                                     wall=profile['wall_time_s'],
+                                     critical=profile['critical_path_s'],
+                                     path=' &rarr; '.join(profile['critical_path']),
+                                     header=''.join('<th>{}</th>'.format(c) for c in columns),
+                                     rows='\n'.join(rows))
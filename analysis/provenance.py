@@ -0,0 +1,365 @@
+import os
+import re
+import json
+import time
+import hashlib
+
+# Stages whose results (through their derivatives or the working directory)
+# another stage uses
+stage_dependencies = {'combine': [],
+                      'qmri': [],
+                      'mask': ['combine'],
+                      'fs-brainmask': []}
+
+bids_entities = re.compile('(^|/)sub-(?P<subject>[a-zA-Z0-9]+)(_ses-(?P<session>[a-zA-Z0-9]+))?_[^/]*$')
+
+
+def get_manifest_fn(derivatives, stage, subject, session=None):
+    path = os.path.join(os.path.abspath(derivatives), 'provenance', 'sub-{}'.format(subject))
+    name = 'sub-{}'.format(subject)
+
+    if session:
+        path = os.path.join(path, 'ses-{}'.format(session))
+        name += '_ses-{}'.format(session)
+
+    return os.path.join(path, '{}_stage-{}_provenance.json'.format(name, stage))
+
+
+def get_entities(fn):
+    # Subject and session of a BIDS-named file
+    match = bids_entities.search(fn)
+
+    if match is None:
+        raise Exception('Could not find subject (and session) in {}'.format(fn))
+
+    return match.group('subject'), match.group('session')
+
+
+def hash_inputs(value, hash_file=None):
+    # Every (existing) file in value becomes its path and content hash
+    from result_cache import ResultCache, _replace_files
+
+    if hash_file is None:
+        hash_file = ResultCache().hash_file
+
+    return _replace_files(value, lambda fn: {'path': fn, 'hash': hash_file(fn)})
+
+
+def get_input_digests(inputs, hash_file=None):
+    # Per input (leaving out the ones that are not there, e.g., manual
+    # masks that were never drawn): its hashed value and digest
+    inputs = hash_inputs({name: value for name, value in inputs.items() if value is not None},
+                         hash_file)
+
+    return inputs, {name: get_digest(value) for name, value in inputs.items()}
+
+
+def get_digest(value):
+    description = json.dumps(value, sort_keys=True, default=str)
+    return hashlib.blake2b(description.encode(), digest_size=16).hexdigest()
+
+
+def get_stage_digest(input_digests, parameters, upstream):
+    # What a stage computes from: the digests of its inputs, its parameters
+    # and the digests of the stages it uses
+    return get_digest({'inputs': input_digests,
+                       'parameters': parameters,
+                       'upstream': upstream})
+
+
+def write_provenance(derivatives, stage, source_file, parameters, out_files,
+                     upstream=None, route=None, **inputs):
+    # Node version of record_provenance, for the subject/session of
+    # source_file; the keyword arguments are the inputs, by name
+    from provenance import get_entities, record_provenance
+
+    subject, session = get_entities(source_file)
+
+    return record_provenance(derivatives, stage, subject, session, inputs,
+                             parameters, out_files, upstream, route)
+
+
+def record_provenance(derivatives, stage, subject, session, inputs, parameters,
+                      out_files, upstream=None, route=None):
+    # Records, next to the derivatives of a stage, what it computed them
+    # from: the hashes of all input files, the parameters and the digests
+    # of upstream stages (given as their manifests; by default the ones in
+    # derivatives). route is the stage that fed it directly (e.g.,
+    # 'combine' for masking in the pipeline), if any: not part of the
+    # digest, but the planner reruns the stage the same way
+    from result_cache import ResultCache
+
+    hash_file = ResultCache().hash_file
+    inputs, input_digests = get_input_digests(inputs, hash_file)
+
+    if upstream is None:
+        upstream = [get_manifest_fn(derivatives, dependency, subject, session)
+                    for dependency in stage_dependencies[stage]]
+        upstream = [fn for fn in upstream if os.path.exists(fn)]
+
+    upstream_digests = {}
+    for fn in upstream:
+        with open(fn) as f:
+            manifest = json.load(f)
+        upstream_digests[manifest['stage']] = manifest['digest']
+
+    if not isinstance(out_files, list):
+        out_files = [out_files]
+
+    manifest = {'stage': stage,
+                'subject': subject,
+                'session': session,
+                'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+                'digest': get_stage_digest(input_digests, parameters, upstream_digests),
+                'parameters': parameters,
+                'inputs': inputs,
+                'input_digests': input_digests,
+                'upstream': upstream_digests,
+                'route': route,
+                'outputs': {fn: hash_file(fn) for fn in out_files if fn and os.path.isfile(fn)}}
+
+    return write_manifest(get_manifest_fn(derivatives, stage, subject, session), manifest)
+
+
+def write_manifest(fn, manifest):
+    if not os.path.exists(os.path.dirname(fn)):
+        os.makedirs(os.path.dirname(fn), exist_ok=True)
+
+    tmp_fn = '{}.{}.tmp'.format(fn, os.getpid())
+    with open(tmp_fn, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True, default=str)
+    os.replace(tmp_fn, fn)
+
+    return fn
+
+
+def load_manifest(derivatives, stage, subject, session=None):
+    fn = get_manifest_fn(derivatives, stage, subject, session)
+
+    if not os.path.exists(fn):
+        return None
+
+    with open(fn) as f:
+        return json.load(f)
+
+
+def init_provenance_node(stage, derivatives, input_names, parameters, name='provenance',
+                         route=None):
+    import nipype.pipeline.engine as pe
+    import nipype.interfaces.utility as niu
+
+    node = pe.Node(niu.Function(function=write_provenance,
+                                input_names=['derivatives', 'stage', 'source_file',
+                                             'parameters', 'out_files', 'upstream',
+                                             'route'] + list(input_names),
+                                output_names=['manifest']),
+                   name=name)
+    node.inputs.derivatives = derivatives
+    node.inputs.stage = stage
+    node.inputs.parameters = parameters
+    node.inputs.route = route
+
+    return node
+
+
+def get_current_inputs(sourcedata, derivatives, stage, subject, session=None):
+    # The inputs a stage would get now, named as in its manifest
+    import io
+    import contextlib
+    from utils import get_mp2rage_pars
+    from mask_mp2rage import get_manual_masks
+    from pipeline import acquisitions
+
+    if stage in ['combine', 'qmri']:
+        # (Without the tables get_mp2rage_pars prints)
+        with contextlib.redirect_stdout(io.StringIO()):
+            mp2rage_parameters = [get_mp2rage_pars(sourcedata, subject, session or '.*', acquisition)
+                                  for acquisition in acquisitions]
+
+        if stage == 'combine':
+            return {'mp2rage_parameters': mp2rage_parameters}
+        else:
+            return {'mp2rage_parameters': mp2rage_parameters[0]}
+
+    if stage == 'mask':
+        return get_manual_masks(derivatives, subject, session)
+
+    if stage == 'fs-brainmask':
+        from update_fs_brainmask import get_brainmask_fn
+        return dict({'brainmask': get_brainmask_fn(derivatives, subject)},
+                    **get_manual_masks(derivatives, subject, session))
+
+    raise Exception('Unknown stage {}'.format(stage))
+
+
+def get_affected_nodes(wf, fields=None):
+    # The nodes of wf (keys as in profiling.py) downstream of the given
+    # fields of its inputnode, or all of them if fields is None
+    from profiling import _get_node_key
+
+    graph = wf._create_flat_graph()
+    keys = {node: _get_node_key(node) for node in graph.nodes()}
+
+    if fields is None:
+        return sorted(key for node, key in keys.items() if node.name != 'inputnode')
+
+    inputnode = [node for node, key in keys.items() if key == 'inputnode']
+    affected = set()
+    todo = []
+
+    for node in inputnode:
+        for _, target, data in graph.out_edges(node, data=True):
+            sources = [source[0] if isinstance(source, tuple) else source
+                       for source, _ in data['connect']]
+            if any(source in fields for source in sources):
+                todo.append(target)
+
+    while todo:
+        node = todo.pop()
+        if node not in affected:
+            affected.add(node)
+            todo += list(graph.successors(node))
+
+    return sorted(keys[node] for node in affected)
+
+
+def plan(sourcedata,
+         derivatives,
+         subject_sessions,
+         stages=('combine', 'qmri', 'mask'),
+         crop=False,
+         n4_fast=False):
+    # For every subject/session and stage: whether its derivatives are up to
+    # date with the current sourcedata, manual masks and parameters (as
+    # recorded in the provenance manifests) and, if not, why and which
+    # nodes are affected. Only those are recomputed when the stale stages
+    # rerun: nipype finds the others in the working directory (their
+    # inputs did not change) and the expensive ones are also in the result
+    # cache
+    from pipeline import init_pipeline_wf
+
+    stage_wf_names = {'combine': 'combine_mp2rages_{}',
+                      'qmri': 'qmri_mp2rage_{}',
+                      'mask': 'mask_wf_{}'}
+    entries = []
+
+    for subject, session in subject_sessions:
+        # All stages, wired like in the pipeline, for their parameters
+        wf = init_pipeline_wf(sourcedata, derivatives, subject, session,
+                              stages=['combine', 'qmri', 'mask'],
+                              crop=crop, n4_fast=n4_fast)
+
+        digests = {}
+        subject_entries = []
+
+        for stage in ['combine', 'qmri', 'mask', 'fs-brainmask']:
+            entry = {'subject': subject,
+                     'session': session,
+                     'stage': stage,
+                     'nodes': []}
+            subject_entries.append(entry)
+
+            if stage in stage_wf_names:
+                parameters = wf.get_node(stage_wf_names[stage].format(subject)) \
+                    .get_node('provenance').inputs.parameters
+            else:
+                parameters = {}
+
+            try:
+                inputs = get_current_inputs(sourcedata, derivatives, stage, subject, session)
+            except Exception as e:
+                entry.update({'status': 'missing inputs', 'reason': str(e)})
+                digests[stage] = None
+                continue
+
+            _, input_digests = get_input_digests(inputs)
+            upstream = {dependency: digests.get(dependency) for dependency in stage_dependencies[stage]}
+            digests[stage] = get_stage_digest(input_digests, parameters, upstream)
+
+            manifest = load_manifest(derivatives, stage, subject, session)
+            entry['route'] = manifest.get('route') if manifest else None
+
+            if manifest is None:
+                entry.update({'status': 'stale', 'reason': 'never ran'})
+            elif manifest['digest'] == digests[stage]:
+                entry.update({'status': 'up to date', 'reason': ''})
+            else:
+                changed = sorted(name for name in set(input_digests) | set(manifest['input_digests'])
+                                 if input_digests.get(name) != manifest['input_digests'].get(name))
+                reasons = ['changed {}'.format(name) for name in changed]
+                entry['fields'] = changed
+
+                if parameters != manifest['parameters']:
+                    reasons.append('changed parameters')
+                    entry['fields'] = None
+
+                for dependency in sorted(upstream):
+                    if upstream[dependency] != manifest['upstream'].get(dependency):
+                        reasons.append('{} changed'.format(dependency))
+                        entry['fields'] = None
+
+                entry.update({'status': 'stale', 'reason': ', '.join(reasons)})
+
+        # A stale stage that an up-to-date stage fed directly (masking in
+        # the pipeline gets the averages from the working directory of
+        # combining) reruns in that graph again: on its own it would read
+        # the derivatives instead, and all its nodes would rerun. nipype
+        # finds the nodes of the up-to-date stage in the working directory
+        statuses = {entry['stage']: entry['status'] for entry in subject_entries}
+        for entry in subject_entries:
+            route = entry.pop('route')
+            if entry['status'] == 'stale' and entry['stage'] in stages and \
+                    statuses.get(route) == 'up to date':
+                entry['with_stages'] = [route]
+
+        # The affected nodes, in the graph that reruns the stale stages
+        run_stages = get_stale_stages(subject_entries, stages).get((subject, session), [])
+        run_wf = init_pipeline_wf(sourcedata, derivatives, subject, session, stages=run_stages,
+                                  crop=crop, n4_fast=n4_fast)
+
+        for entry in subject_entries:
+            if entry['stage'] in run_stages and entry['status'] == 'stale' and \
+                    entry['stage'] in stage_wf_names:
+                name = stage_wf_names[entry['stage']].format(subject)
+                stage_wf = run_wf.get_node(name) or wf.get_node(name)
+                entry['nodes'] = get_affected_nodes(stage_wf, entry.pop('fields', None))
+            entry.pop('fields', None)
+
+        entries += [entry for entry in subject_entries if entry['stage'] in stages]
+
+    return entries
+
+
+def get_stale_stages(entries, stages=None):
+    # (subject, session) -> stages to rerun (of stages, if given), with the
+    # up-to-date stages they rerun with
+    subject_stages = {}
+
+    for entry in entries:
+        if entry['status'] == 'stale' and (stages is None or entry['stage'] in stages):
+            run_stages = subject_stages.setdefault((entry['subject'], entry['session']), [])
+            for stage in entry.get('with_stages', []) + [entry['stage']]:
+                if stage not in run_stages:
+                    run_stages.append(stage)
+
+    return subject_stages
+
+
+def format_plan(entries):
+    lines = []
+
+    for entry in entries:
+        name = 'sub-{}'.format(entry['subject'])
+        if entry['session']:
+            name += '_ses-{}'.format(entry['session'])
+
+        line = '{} {}: {}'.format(name, entry['stage'], entry['status'])
+        if entry['reason']:
+            line += ' ({})'.format(entry['reason'])
+        if entry.get('with_stages'):
+            line += ', reruns in the graph of {}'.format(', '.join(entry['with_stages']))
+        lines.append(line)
+
+        lines += ['    {}'.format(node) for node in entry['nodes']]
+
+    return '\n'.join(lines)
@@ -0,0 +1,168 @@
+import os
+import json
+import hashlib
+
+# Rigid registration from coarse (4x downsampled, smoothed) to native
+# resolution, as antsRegistration parameters
+pyramid = {'shrink_factors': [4, 2, 1],
+           'smoothing_sigmas': [2., 1., 0.],
+           'number_of_iterations': [1000, 500, 100],
+           'metric': 'MI',
+           'radius_or_number_of_bins': 32,
+           'sampling_percentage': .25,
+           'convergence_threshold': 1e-6}
+
+
+def register_rigid(in_files, reference, num_threads=None, parameters=None):
+    # Rigid ITK transforms (as resample_images expects them, i.e., from
+    # reference to in_file) of all in_files, registered concurrently. Every
+    # transform is cached under the contents of both images, so registering
+    # the same pair again (in any workflow) is instant
+    import os
+    import shutil
+    from concurrent.futures import ThreadPoolExecutor
+    from nipype.utils.filemanip import split_filename
+    from registration import TransformCache, run_ants_rigid, pyramid
+
+    if parameters is None:
+        parameters = pyramid
+
+    if num_threads is None:
+        num_threads = 1
+
+    cache = TransformCache()
+    keys = [cache.get_key(reference, fn, parameters) for fn in in_files]
+    missing = [(fn, key) for fn, key in zip(in_files, keys) if cache.load(key) is None]
+
+    if len(missing) > 0:
+        # The pairs share the threads
+        threads_per_pair = max(num_threads // len(missing), 1)
+
+        def _register(fn_key):
+            fn, key = fn_key
+            _, prefix, _ = split_filename(fn)
+            work_dir = os.path.abspath('register_{}'.format(prefix))
+            transform = run_ants_rigid(reference, fn, work_dir, parameters,
+                                       num_threads=threads_per_pair)
+            cache.save(key, transform)
+
+        with ThreadPoolExecutor(len(missing)) as executor:
+            list(executor.map(_register, missing))
+
+    print('Registered {} images ({} from the transform cache)'.format(len(in_files),
+                                                                      len(in_files) - len(missing)))
+
+    transforms = []
+    for fn, key in zip(in_files, keys):
+        _, prefix, _ = split_filename(fn)
+        transforms.append(os.path.abspath('{}_rigid.mat'.format(prefix)))
+        shutil.copyfile(cache.load(key), transforms[-1])
+
+    return transforms
+
+
+def run_ants_rigid(fixed, moving, work_dir, parameters, num_threads=1):
+    # One antsRegistration-call; the command line comes from nipype, but it
+    # runs in its own directory, so that several can run in threads
+    import os
+    import shlex
+    import subprocess
+    from nipype.interfaces import ants
+
+    n_levels = len(parameters['shrink_factors'])
+
+    if not os.path.exists(work_dir):
+        os.makedirs(work_dir)
+
+    reg = ants.Registration(fixed_image=[fixed],
+                            moving_image=[moving],
+                            dimension=3,
+                            initial_moving_transform_com=1,
+                            transforms=['Rigid'],
+                            transform_parameters=[(.1,)],
+                            metric=[parameters['metric']],
+                            metric_weight=[1.],
+                            radius_or_number_of_bins=[parameters['radius_or_number_of_bins']],
+                            sampling_strategy=['Regular'],
+                            sampling_percentage=[parameters['sampling_percentage']],
+                            number_of_iterations=[parameters['number_of_iterations'][:n_levels]],
+                            convergence_threshold=[parameters['convergence_threshold']],
+                            convergence_window_size=[10],
+                            shrink_factors=[parameters['shrink_factors']],
+                            smoothing_sigmas=[parameters['smoothing_sigmas']],
+                            sigma_units=['vox'],
+                            winsorize_lower_quantile=.005,
+                            winsorize_upper_quantile=.995,
+                            collapse_output_transforms=True,
+                            write_composite_transform=False,
+                            output_transform_prefix=os.path.join(work_dir, 'rigid_'),
+                            num_threads=num_threads)
+
+    environ = dict(os.environ, ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS=str(num_threads))
+
+    # (As a list of arguments, without a shell that would expand the
+    # brackets and whatever else is in the paths)
+    with open(os.path.join(work_dir, 'antsRegistration.log'), 'w') as log:
+        result = subprocess.run(shlex.split(reg.cmdline), cwd=work_dir, env=environ,
+                                stdout=log, stderr=subprocess.STDOUT)
+
+    if result.returncode != 0:
+        raise Exception('antsRegistration of {} to {} failed, see {}'.format(moving, fixed,
+                                                                            os.path.join(work_dir,
+                                                                                         'antsRegistration.log')))
+
+    return os.path.join(work_dir, 'rigid_0GenericAffine.mat')
+
+
+class TransformCache(object):
+    # Transforms keyed by the contents of the fixed and moving image and the
+    # registration parameters
+
+    def __init__(self, cache_dir=None):
+        from utils import get_cache_dir
+        from result_cache import ResultCache
+
+        if cache_dir is None:
+            cache_dir = get_cache_dir('transforms')
+
+        self.cache_dir = cache_dir
+
+        # (Memoized) content hashes, shared with the result cache
+        self.hash_file = ResultCache().hash_file
+
+    def get_key(self, fixed, moving, parameters):
+        description = json.dumps({'fixed': self.hash_file(fixed),
+                                  'moving': self.hash_file(moving),
+                                  'parameters': parameters}, sort_keys=True)
+
+        return hashlib.blake2b(description.encode(), digest_size=20).hexdigest()
+
+    def get_fn(self, key):
+        return os.path.join(self.cache_dir, '{}.mat'.format(key))
+
+    def load(self, key):
+        fn = self.get_fn(key)
+
+        if os.path.exists(fn):
+            return fn
+
+        return None
+
+    def save(self, key, transform):
+        import shutil
+        import tempfile
+
+        # A temporary file of its own (threads of one process and processes
+        # on other machines, with the same pid, save at the same time), in
+        # the cache dir so that the rename is atomic
+        fn = self.get_fn(key)
+        fd, tmp_fn = tempfile.mkstemp(suffix='.tmp', dir=self.cache_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f, open(transform, 'rb') as transform_file:
+                shutil.copyfileobj(transform_file, f)
+            os.replace(tmp_fn, fn)
+        except BaseException:
+            os.remove(tmp_fn)
+            raise
+
+        return fn
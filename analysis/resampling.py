@@ -0,0 +1,166 @@
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+# NIfTI (RAS) <-> ITK (LPS) physical coordinates
+ras2lps = np.diag([-1., -1., 1., 1.])
+
+
+def read_itk_transform(fn):
+    # Returns the 4x4 matrix that maps physical (LPS) points of the fixed
+    # (reference) space onto the moving space, as ITK/ANTs applies it
+    if fn.endswith('.mat'):
+        from scipy.io import loadmat
+        mat = loadmat(fn)
+        key = [k for k in mat.keys() if not k.startswith('__') and k != 'fixed'][0]
+        parameters = mat[key].ravel()
+        center = mat['fixed'].ravel()
+    else:
+        parameters = center = None
+        with open(fn) as f:
+            for line in f:
+                if line.startswith('Transform:') and 'Affine' not in line and 'MatrixOffset' not in line:
+                    raise Exception('{}: only affine ITK-transforms are supported'.format(fn))
+                if line.startswith('Parameters:'):
+                    parameters = np.array(line.split(':')[1].split(), dtype=float)
+                elif line.startswith('FixedParameters:'):
+                    center = np.array(line.split(':')[1].split(), dtype=float)
+
+        if parameters is None:
+            raise Exception('Could not read transform parameters from {}'.format(fn))
+
+        if center is None:
+            center = np.zeros(3)
+
+    matrix = parameters[:9].reshape((3, 3))
+    translation = parameters[9:12]
+
+    transform = np.eye(4)
+    transform[:3, :3] = matrix
+    transform[:3, 3] = translation + center - matrix.dot(center)
+
+    return transform
+
+
+def lanczos_kernel(x, radius=3):
+    # Windowed sinc as in itk::WindowedSincInterpolateImageFunction with a
+    # LanczosWindowFunction (what ANTs uses for 'LanczosWindowedSinc')
+    return np.sinc(x) * np.sinc(x / radius)
+
+
+def get_voxel_transform(reference_affine, moving_affine, transform):
+    # Maps voxel indices of the reference grid onto voxel indices of the moving grid
+    return np.linalg.inv(moving_affine).dot(ras2lps).dot(transform).dot(ras2lps).dot(reference_affine)
+
+
+def resample_chunk(channels, shape, voxel_transform, out_shape, start, stop, radius=3):
+    ijk = np.array(np.unravel_index(np.arange(start, stop), out_shape), dtype=float)
+    index = voxel_transform[:3, :3].dot(ijk) + voxel_transform[:3, 3:]
+
+    inside = np.all((index >= -.5) & (index < np.array(shape)[:, np.newaxis] - .5), 0)
+    index = index[:, inside]
+
+    base = np.floor(index).astype(int)
+    distance = index - base
+
+    offsets = np.arange(2 * radius) - radius + 1
+    flat_index = np.zeros((index.shape[1], 1), dtype=np.intp)
+    weights = np.ones((index.shape[1], 1), dtype=np.float32)
+
+    # The sample positions and kernel weights are computed once and
+    # shared by all channels
+    for dim in range(3):
+        x = distance[dim][:, np.newaxis] - offsets[np.newaxis, :]
+        dim_weights = lanczos_kernel(x, radius)
+
+        # On a grid point, the kernel is exactly a delta function
+        on_grid = distance[dim] == 0
+        dim_weights[on_grid] = offsets == 0
+
+        # Zero-flux Neumann boundary condition
+        dim_index = np.clip(base[dim][:, np.newaxis] + offsets[np.newaxis, :], 0, shape[dim] - 1)
+
+        flat_index = (flat_index[:, :, np.newaxis] * shape[dim] + dim_index[:, np.newaxis, :]).reshape((index.shape[1], -1))
+        weights = (weights[:, :, np.newaxis] * dim_weights[:, np.newaxis, :].astype(np.float32)).reshape((index.shape[1], -1))
+
+    result = []
+    for data in channels:
+        values = np.zeros(stop - start, dtype=np.float32)
+        values[inside] = (np.take(data, flat_index) * weights).sum(1)
+        result.append(values)
+
+    return result
+
+
+def resample_to_grid(channels, moving_affine, reference_shape, reference_affine, transform,
+                     radius=3, chunk_size=32768, num_threads=None):
+
+    shape = channels[0].shape
+    voxel_transform = get_voxel_transform(reference_affine, moving_affine, transform)
+    n_voxels = int(np.prod(reference_shape))
+
+    flat_channels = [np.ascontiguousarray(data, dtype=np.float32).ravel() for data in channels]
+    results = [np.zeros(n_voxels, dtype=np.float32) for data in channels]
+
+    def _resample(start):
+        stop = min(start + chunk_size, n_voxels)
+        values = resample_chunk(flat_channels, shape, voxel_transform, reference_shape,
+                                start, stop, radius=radius)
+        for result, value in zip(results, values):
+            result[start:stop] = value
+
+    if num_threads is None:
+        num_threads = 1
+
+    with ThreadPoolExecutor(num_threads) as executor:
+        list(executor.map(_resample, range(0, n_voxels, chunk_size)))
+
+    return [result.reshape(reference_shape) for result in results]
+
+
+def resample_images(in_files, transform, reference_image, num_threads=None):
+    import os
+    import numpy as np
+    import nibabel as nb
+    from nipype.utils.filemanip import split_filename
+    from resampling import read_itk_transform, resample_to_grid
+    from utils import get_intermediate_ext
+
+    if type(in_files) is not list:
+        in_files = [in_files]
+
+    if type(transform) is list:
+        if len(transform) != 1:
+            raise Exception('resample_images only applies a single transform')
+        transform = transform[0]
+
+    reference = nb.load(reference_image)
+    transform = read_itk_transform(transform)
+
+    images = [nb.load(fn) for fn in in_files]
+
+    # Channels that share a grid are resampled in one go
+    grids = []
+    for ix, image in enumerate(images):
+        for grid in grids:
+            if image.shape == grid['shape'] and np.allclose(image.affine, grid['affine']):
+                grid['channels'].append(ix)
+                break
+        else:
+            grids.append({'shape': image.shape, 'affine': image.affine, 'channels': [ix]})
+
+    out_files = [None] * len(in_files)
+    for grid in grids:
+        channels = [images[ix].get_fdata(dtype=np.float32) for ix in grid['channels']]
+        resampled = resample_to_grid(channels, grid['affine'],
+                                     reference.shape[:3], reference.affine,
+                                     transform, num_threads=num_threads)
+        del channels
+
+        for ix, data in zip(grid['channels'], resampled):
+            _, fn, _ = split_filename(in_files[ix])
+            out_files[ix] = os.path.abspath('{}_trans{}'.format(fn, get_intermediate_ext()))
+            out_image = nb.Nifti1Image(data, reference.affine, reference.header)
+            out_image.set_data_dtype(np.float32)
+            out_image.to_filename(out_files[ix])
+
+    return out_files
@@ -0,0 +1,281 @@
+import os
+import io
+import json
+import contextlib
+import numpy as np
+
+# How much memory and how many processes the expensive nodes need, by node
+# name: base_gb plus `copies` float64 copies of the largest source grid (a
+# function of the image size, see get_image_size), on `n_procs` processes.
+# Nodes that size their work to their budget (the fits, see
+# get_mp2rage_slab_size) get it as inputs; their peak follows their budget,
+# so, like nodes whose work happens in another process (nighres, in its
+# persistent worker), they are not corrected by measured peaks. Other nodes
+# keep nipype's defaults (0.2 GB, 1 process). n_procs is also the number
+# of threads a node uses (see set_threads). Copies are counted in float64
+# volumes whatever the dtype in the headers: every node casts on loading
+# (pymp2rage and get_fdata to float64, ITK and our own NumPy code to
+# float32, as half a copy), so the stored dtype says little about its
+# memory; what the counts miss, the measured peaks correct
+node_models = {
+    # pymp2rage keeps ~4 float64 copies per input volume, plus the maps
+    'make_t1w': {'base_gb': .5, 'copies': lambda size: 4 * size['n_volumes'] + 8, 'n_procs': 4,
+                 'adaptive': True},
+    'get_qmri': {'base_gb': .5, 'copies': lambda size: 4 * size['n_volumes'] + 8, 'n_procs': 4,
+                 'adaptive': True},
+    'crop_head': {'base_gb': .3, 'copies': 2},
+    'register': {'base_gb': .5, 'copies': 2, 'n_procs': 4},
+    # All channels of an acquisition (float32 in and out)
+    'apply_sinc': {'base_gb': .3, 'copies': 3, 'n_procs': 4},
+    # A float32 stack of all acquisitions, and its sorted copy
+    'mean_image': {'base_gb': .3, 'copies': lambda size: size['n_acquisitions'] + 1},
+    'n4': {'base_gb': .3, 'copies': 3, 'n_procs': 8},
+    'n4_lowres': {'base_gb': .3, 'copies': .5, 'n_procs': 8},
+    'downsample': {'base_gb': .3, 'copies': 1.5},
+    'apply_bias': {'base_gb': .3, 'copies': 1.5},
+    'bet': {'base_gb': .3, 'copies': 1.5},
+    'afni_mask': {'base_gb': .3, 'copies': 1.5, 'n_procs': 2},
+    'nighres_brain_extract': {'base_gb': 2.5, 'copies': 4, 'learn': False},
+    'dura_masker': {'base_gb': 2.5, 'copies': 3, 'learn': False},
+    't1w_masker': {'base_gb': .3, 'copies': 2.5},
+    'resample_manual_masks': {'base_gb': .3, 'copies': 1.5},
+    # (Compresses with write_gzip)
+    'ds_derivatives': {'base_gb': .3, 'copies': 1.5, 'n_procs': 2},
+}
+
+# What ITK (ANTs), OpenMP (AFNI, FSL) and the BLAS libraries of NumPy read
+# for their number of threads
+thread_variables = ['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS', 'OMP_NUM_THREADS',
+                    'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']
+
+# Corrections from measured peaks are kept within these bounds
+min_correction = .5
+max_correction = 4.
+n_measurements = 10
+
+
+def get_system_memory_gb():
+    try:
+        return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') / 1024. ** 3
+    except (ValueError, OSError, AttributeError):
+        return 8.
+
+
+def get_image_size(sourcedata, subject, session=None):
+    # From the headers of the sources of a subject: the number of voxels of
+    # the largest grid, the most image volumes (inversions, echoes,
+    # magnitude and phase) of an acquisition and the number of acquisitions
+    import nibabel as nb
+    from utils import get_mp2rage_pars
+    from pipeline import acquisitions
+
+    size = {'n_voxels': 0, 'n_volumes': 0, 'n_acquisitions': 0}
+
+    for acquisition in acquisitions:
+        try:
+            # (Without the tables get_mp2rage_pars prints)
+            with contextlib.redirect_stdout(io.StringIO()):
+                parameters = get_mp2rage_pars(sourcedata, subject, session or '.*', acquisition)
+        except Exception:
+            continue
+
+        fns = [fn for value in parameters.values() for fn in (value if type(value) is list else [value])
+               if isinstance(fn, str) and fn.endswith(('.nii', '.nii.gz'))]
+
+        size['n_voxels'] = max(size['n_voxels'], int(np.prod(nb.load(parameters['inv1']).shape[:3])))
+        size['n_volumes'] = max(size['n_volumes'], len(fns))
+        size['n_acquisitions'] += 1
+
+    if size['n_acquisitions'] == 0:
+        return None
+
+    return size
+
+
+def get_history_fn():
+    from utils import get_cache_dir
+    return os.path.join(get_cache_dir('resources'), 'peaks.json')
+
+
+def load_history(fn=None):
+    if fn is None:
+        fn = get_history_fn()
+
+    if not os.path.exists(fn):
+        return {}
+
+    with open(fn) as f:
+        return json.load(f)
+
+
+def get_correction(history, model):
+    # Measured peak / estimate of the last runs, with some headroom
+    ratios = history.get(model, [])
+
+    if len(ratios) == 0:
+        return 1.
+
+    return float(np.clip(1.2 * max(ratios), min_correction, max_correction))
+
+
+def estimate_resources(model, size):
+    # (mem_gb, n_procs) of a node, as estimated by its model
+    spec = node_models[model]
+    copies = spec['copies'](size) if callable(spec['copies']) else spec['copies']
+    mem_gb = spec['base_gb'] + copies * size['n_voxels'] * 8. / 1024. ** 3
+
+    return mem_gb, spec.get('n_procs', 1)
+
+
+def is_learned(model):
+    spec = node_models.get(model, {})
+    return spec.get('learn', True) and not spec.get('adaptive', False)
+
+
+def set_resources(wf, size, memory_gb=None, n_procs=None, history=None):
+    # Sets mem_gb and n_procs of all nodes of wf that have a model (within
+    # the budget of the run, or a node could never start)
+    if memory_gb is None:
+        memory_gb = .9 * get_system_memory_gb()
+
+    if history is None:
+        history = load_history()
+
+    estimates = {}
+
+    for node in wf._get_all_nodes():
+        if node.name not in node_models:
+            continue
+
+        estimate, node_procs = estimate_resources(node.name, size)
+        correction = get_correction(history, node.name) if is_learned(node.name) else 1.
+        mem_gb = min(estimate * correction, memory_gb)
+        if n_procs is not None:
+            node_procs = min(node_procs, n_procs)
+
+        # (mem_gb is read-only after construction; MapNodes pass _mem_gb on
+        # to their subnodes)
+        node._mem_gb = mem_gb
+        # (For record_peaks, through the profile: mem_gb may be clipped)
+        node.resource_model = node.name
+        node.resource_estimate = estimate
+        node.resource_correction = correction
+
+        node.n_procs = node_procs
+
+        if node_models[node.name].get('adaptive'):
+            node.inputs.mem_gb = mem_gb
+            node.inputs.n_procs = node.n_procs
+
+        estimates[node.fullname] = (mem_gb, node.n_procs)
+
+    return estimates
+
+
+def set_threads(wf, n_procs):
+    # Every node of wf runs on at most n_procs threads (its share of the
+    # budget of the run: the scheduler only starts nodes whose n_procs fit
+    # in it), passed on as num_threads (ANTs, AFNI and our own functions
+    # that have one) and, for command-line tools, through the environment.
+    # Nodes that size their work (see node_models) and got no n_procs from
+    # set_resources (no headers, or no model) get the same
+    from nipype.interfaces.base import isdefined
+
+    for node in wf._get_all_nodes():
+        num_threads = min(node.n_procs, n_procs)
+        # (Also sets num_threads, if the interface has one)
+        node.n_procs = num_threads
+
+        if hasattr(node.interface.inputs, 'num_threads'):
+            node.inputs.num_threads = num_threads
+
+        if hasattr(node.interface.inputs, 'n_procs') and not isdefined(node.inputs.n_procs):
+            node.inputs.n_procs = num_threads
+
+        if hasattr(node.interface.inputs, 'environ'):
+            node.inputs.environ = dict(node.inputs.environ, **get_thread_environ(num_threads))
+
+
+def set_subject_resources(wf, sourcedata, subject, session=None, num_threads=8, memory_gb=None):
+    # set_resources (from the headers of the subject, if it has any
+    # sources) and set_threads, within num_threads and memory_gb
+    size = get_image_size(sourcedata, subject, session)
+    if size is not None:
+        set_resources(wf, size, memory_gb=memory_gb, n_procs=num_threads)
+    set_threads(wf, num_threads)
+
+
+def get_thread_environ(num_threads):
+    return {variable: str(num_threads) for variable in thread_variables}
+
+
+@contextlib.contextmanager
+def limit_threads(num_threads):
+    # For nodes that run in-process (Function nodes): within the block,
+    # NumPy's BLAS (with threadpoolctl, if installed) and the tools the node
+    # starts use num_threads. MultiProc runs the next nodes in the same
+    # worker process, so the environment and the thread pools are restored
+    # afterwards
+    old_environ = {variable: os.environ.get(variable) for variable in thread_variables}
+    os.environ.update(get_thread_environ(num_threads))
+
+    try:
+        try:
+            from threadpoolctl import threadpool_limits
+        except ImportError:
+            yield
+        else:
+            with threadpool_limits(limits=num_threads):
+                yield
+    finally:
+        for variable, value in old_environ.items():
+            if value is None:
+                os.environ.pop(variable, None)
+            else:
+                os.environ[variable] = value
+
+
+def limit_process_threads(num_threads):
+    # Like limit_threads, for the lifetime of a process that only does our
+    # work (e.g., as the initializer of a process pool)
+    os.environ.update(get_thread_environ(num_threads))
+
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        return
+
+    threadpool_limits(limits=num_threads)
+
+
+def record_peaks(profile, history_fn=None):
+    # Learns, per node model, how the measured peak memory (see
+    # profiling.py) compares to the estimate
+    if not profile.get('sampled'):
+        return
+
+    if history_fn is None:
+        history_fn = get_history_fn()
+
+    history = load_history(history_fn)
+    changed = False
+
+    for node in profile['nodes']:
+        model = node.get('resource_model')
+
+        if model is None or not is_learned(model) or node['status'] != 'ok' or \
+                node['n_runs'] == 0 or not node.get('resource_estimate') or not node['peak_rss_mb']:
+            continue
+
+        # Relative to the estimate of the model (before the correction and
+        # the budget of the run)
+        ratios = history.setdefault(model, [])
+        ratios.append(node['peak_rss_mb'] / 1024. / node['resource_estimate'])
+        del ratios[:-n_measurements]
+        changed = True
+
+    if changed:
+        tmp_fn = '{}.{}.tmp'.format(history_fn, os.getpid())
+        with open(tmp_fn, 'w') as f:
+            json.dump(history, f, indent=2)
+        os.replace(tmp_fn, history_fn)
@@ -0,0 +1,375 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+from nipype.interfaces import ants, utility as niu
+
+# Inputs that change how, not what, an interface computes
+ignored_inputs = ['num_threads', 'environ', 'terminal_output', 'ignore_exception',
+                  'args_num_threads', 'n_procs', 'mem_gb']
+
+
+class ResultCache(object):
+    # Content-addressed store of interface results, shared by all workflows
+    # (whatever their name or base_dir). Entries are keyed by the contents
+    # of the input files and the other input values
+
+    def __init__(self, cache_dir=None, quota_gb=None):
+        from utils import get_cache_dir, connect_sqlite
+
+        if cache_dir is None:
+            cache_dir = get_cache_dir('results')
+
+        if quota_gb is None:
+            quota_gb = float(os.environ.get('MP2RAGE_RESULT_CACHE_GB', 50))
+
+        self.cache_dir = cache_dir
+        self.quota_gb = quota_gb
+
+        # Hashes of files that did not change (same size and mtime) are
+        # looked up instead of recomputed (with a rollback journal instead
+        # of WAL if the cache is on a network filesystem)
+        self.connection = connect_sqlite(os.path.join(cache_dir, 'file_hashes.sqlite'))
+        self.connection.execute('CREATE TABLE IF NOT EXISTS file_hashes ('
+                                'path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, hash TEXT)')
+        self.connection.commit()
+
+    def hash_file(self, fn):
+        stat = os.stat(fn)
+        row = self.connection.execute('SELECT hash FROM file_hashes WHERE path = ? AND size = ? AND mtime_ns = ?',
+                                      (fn, stat.st_size, stat.st_mtime_ns)).fetchone()
+
+        if row is not None:
+            return row[0]
+
+        file_hash = hashlib.blake2b(digest_size=16)
+        with open(fn, 'rb') as f:
+            for block in iter(lambda: f.read(2 ** 23), b''):
+                file_hash.update(block)
+        file_hash = file_hash.hexdigest()
+
+        self.connection.execute('INSERT OR REPLACE INTO file_hashes VALUES (?, ?, ?, ?)',
+                                (fn, stat.st_size, stat.st_mtime_ns, file_hash))
+        self.connection.commit()
+
+        return file_hash
+
+    def get_key(self, interface):
+        import nipype
+
+        inputs = {}
+        for name, value in interface.inputs.get_traitsfree().items():
+            if name not in ignored_inputs:
+                inputs[name] = _replace_files(value, self.hash_file)
+
+        description = {'interface': '{}.{}'.format(interface.__class__.__module__,
+                                                   interface.__class__.__name__),
+                       'nipype': nipype.__version__,
+                       'inputs': inputs}
+
+        # Function nodes compute with the helpers they import from this
+        # repository (e.g., utils.fit_mp2rage), not only with their own code
+        if isinstance(interface, niu.Function):
+            description['code'] = get_code_hash(interface.inputs.function_str)
+
+        description = json.dumps(description, sort_keys=True, default=str)
+
+        return hashlib.blake2b(description.encode(), digest_size=20).hexdigest()
+
+    def get_entry_dir(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def load(self, key, cwd):
+        # Copies the cached files into cwd and returns the outputs, or None
+        entry_dir = self.get_entry_dir(key)
+        manifest_fn = os.path.join(entry_dir, 'outputs.json')
+
+        try:
+            with open(manifest_fn) as f:
+                manifest = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+        for relpath in manifest['files']:
+            fn = os.path.join(cwd, relpath)
+            if not os.path.exists(os.path.dirname(fn)):
+                os.makedirs(os.path.dirname(fn))
+            shutil.copyfile(os.path.join(entry_dir, 'files', relpath), fn)
+
+        # Mark as recently used, for the eviction
+        os.utime(manifest_fn, None)
+
+        return _restore_files(manifest['outputs'], cwd)
+
+    def save(self, key, outputs, cwd, external_files=True):
+        # Stores outputs; files in cwd keep their relative path, other files
+        # (only if external_files) are stored under their basename
+        files = {}
+
+        def _store(fn):
+            if os.path.abspath(fn).startswith(os.path.abspath(cwd) + os.sep):
+                relpath = os.path.relpath(fn, cwd)
+            elif external_files:
+                relpath = os.path.join('external', os.path.basename(fn))
+            else:
+                raise ValueError('{} is not in {}'.format(fn, cwd))
+
+            files[relpath] = fn
+            return {'__cached_file__': relpath}
+
+        try:
+            outputs = _replace_files(outputs, _store)
+        except ValueError as e:
+            print('Not caching result: {}'.format(e))
+            return
+
+        entry_dir = self.get_entry_dir(key)
+        if os.path.exists(entry_dir):
+            return
+
+        if not os.path.exists(os.path.dirname(entry_dir)):
+            os.makedirs(os.path.dirname(entry_dir), exist_ok=True)
+
+        tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(entry_dir))
+        size = 0
+        for relpath, fn in files.items():
+            cached_fn = os.path.join(tmp_dir, 'files', relpath)
+            if not os.path.exists(os.path.dirname(cached_fn)):
+                os.makedirs(os.path.dirname(cached_fn))
+            shutil.copyfile(fn, cached_fn)
+            size += os.path.getsize(cached_fn)
+
+        with open(os.path.join(tmp_dir, 'outputs.json'), 'w') as f:
+            json.dump({'outputs': outputs,
+                       'files': sorted(files),
+                       'size': size}, f, default=str)
+
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # Somebody else stored the same result in the meantime
+            shutil.rmtree(tmp_dir)
+
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for prefix in os.listdir(self.cache_dir):
+            prefix_dir = os.path.join(self.cache_dir, prefix)
+            if len(prefix) != 2 or not os.path.isdir(prefix_dir):
+                continue
+
+            for key in os.listdir(prefix_dir):
+                manifest_fn = os.path.join(prefix_dir, key, 'outputs.json')
+                try:
+                    with open(manifest_fn) as f:
+                        size = json.load(f)['size']
+                    entries.append((os.path.getmtime(manifest_fn), size, os.path.join(prefix_dir, key)))
+                except (IOError, OSError, ValueError, KeyError):
+                    continue
+
+        total = sum(entry[1] for entry in entries)
+
+        # Least recently used entries go first
+        for mtime, size, entry_dir in sorted(entries):
+            if total <= self.quota_gb * 1024. ** 3:
+                break
+
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total -= size
+
+
+class CachedInterfaceMixin(object):
+
+    def _run_interface(self, runtime):
+        if float(os.environ.get('MP2RAGE_RESULT_CACHE_GB', 50)) <= 0:
+            return super(CachedInterfaceMixin, self)._run_interface(runtime)
+
+        cache = ResultCache()
+        key = cache.get_key(self)
+        outputs = cache.load(key, runtime.cwd)
+        self._restored_outputs = None
+
+        if outputs is not None:
+            print('Restored {} from result cache ({})'.format(self.__class__.__name__, key))
+            if isinstance(self, niu.Function):
+                self._out.update(outputs)
+            else:
+                self._restored_outputs = outputs
+            return runtime
+
+        runtime = super(CachedInterfaceMixin, self)._run_interface(runtime)
+
+        if isinstance(self, niu.Function):
+            cache.save(key, dict(self._out), runtime.cwd, external_files=True)
+        else:
+            # Command-line interfaces list their outputs from their inputs,
+            # so only results within the working directory can be restored
+            from nipype.interfaces.base import isdefined
+            outputs = {name: value for name, value in self._list_outputs().items()
+                       if isdefined(value)}
+            cache.save(key, outputs, runtime.cwd, external_files=False)
+
+        return runtime
+
+    def _list_outputs(self):
+        # Command-line interfaces (e.g., N4's bias image) may list their
+        # outputs from what they worked out building the command line, which
+        # a restored result never did
+        if getattr(self, '_restored_outputs', None) is not None:
+            return dict(self._restored_outputs)
+
+        return super(CachedInterfaceMixin, self)._list_outputs()
+
+
+# Interfaces of which the results can be cached. These are proper module-level
+# classes, so that nipype can pickle them
+
+
+class CachedFunction(CachedInterfaceMixin, niu.Function):
+    pass
+
+
+class CachedN4BiasFieldCorrection(CachedInterfaceMixin, ants.N4BiasFieldCorrection):
+    pass
+
+
+cached_classes = {niu.Function: CachedFunction,
+                  ants.N4BiasFieldCorrection: CachedN4BiasFieldCorrection}
+
+
+def cache_interface(interface):
+    # Makes an interface look up its results in the ResultCache before
+    # running, and store them after
+    if isinstance(interface, CachedInterfaceMixin):
+        return interface
+
+    if interface.__class__ not in cached_classes:
+        raise Exception('No cached version of {}'.format(interface.__class__.__name__))
+
+    interface.__class__ = cached_classes[interface.__class__]
+    return interface
+
+
+def get_code_hash(source):
+    # Content hash of the helpers of this repository that source uses: the
+    # definitions it imports (Function nodes import inside their function,
+    # e.g., `from utils import fit_mp2rage`), the ones of the same module
+    # those refer to, and so on
+    definitions = {}
+    todo = _get_references(source)
+
+    while todo:
+        module, name = todo.pop()
+        if (module, name) in definitions:
+            continue
+
+        definition = _get_definition(module, name)
+        if definition is None:
+            # Not a module of this repository
+            continue
+
+        definitions[(module, name)] = definition
+        todo |= _get_references(definition, module)
+
+    code_hash = hashlib.blake2b(digest_size=16)
+    for (module, name), definition in sorted(definitions.items(), key=lambda item: (item[0][0], item[0][1] or '')):
+        code_hash.update('{}.{}\0{}\0'.format(module, name, definition).encode())
+
+    return code_hash.hexdigest()
+
+
+def _get_references(source, module=None):
+    # (module, name) of everything source imports from other modules (name
+    # None for a whole module), and of the top-level definitions of module
+    # it refers to
+    import ast
+    import textwrap
+
+    references = set()
+    names = set()
+
+    for node in ast.walk(ast.parse(textwrap.dedent(source))):
+        if isinstance(node, ast.ImportFrom) and node.module and node.level == 0:
+            references |= {(node.module, alias.name) for alias in node.names}
+        elif isinstance(node, ast.Import):
+            references |= {(alias.name, None) for alias in node.names}
+        elif isinstance(node, ast.Name):
+            names.add(node.id)
+
+    if module is not None:
+        definitions = _parse_module(module)[1]
+        references |= {(module, name) for name in names if name in definitions}
+
+    return references
+
+
+def _get_definition(module, name):
+    # Source of a top-level definition of a module of this repository (the
+    # whole module if name is None or not defined there), or None
+    parsed = _parse_module(module)
+
+    if parsed is None:
+        return None
+
+    source, definitions = parsed
+    if name is None or name not in definitions:
+        return source
+
+    return definitions[name]
+
+
+_parsed_modules = {}
+
+
+def _parse_module(module):
+    # (source, {name: source of its definition}) of a module next to this
+    # one, or None
+    import ast
+
+    fn = os.path.join(os.path.dirname(os.path.abspath(__file__)), '{}.py'.format(module))
+
+    if not os.path.exists(fn):
+        return None
+
+    key = (fn, os.stat(fn).st_mtime_ns)
+    if key not in _parsed_modules:
+        with open(fn) as f:
+            source = f.read()
+
+        definitions = {}
+        for node in ast.parse(source).body:
+            if isinstance(node, (ast.FunctionDef, ast.ClassDef)):
+                targets = [node.name]
+            elif isinstance(node, ast.Assign):
+                targets = [target.id for target in node.targets if isinstance(target, ast.Name)]
+            else:
+                continue
+
+            for target in targets:
+                definitions[target] = ast.get_source_segment(source, node)
+
+        _parsed_modules[key] = (source, definitions)
+
+    return _parsed_modules[key]
+
+
+def _replace_files(value, function):
+    if isinstance(value, str) and os.path.isfile(value):
+        return function(value)
+    if isinstance(value, (list, tuple)):
+        return [_replace_files(v, function) for v in value]
+    if isinstance(value, dict):
+        return {k: _replace_files(v, function) for k, v in value.items()}
+    return value
+
+
+def _restore_files(value, cwd):
+    if isinstance(value, dict):
+        if '__cached_file__' in value:
+            return os.path.join(cwd, value['__cached_file__'])
+        return {k: _restore_files(v, cwd) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_restore_files(v, cwd) for v in value]
+    return value
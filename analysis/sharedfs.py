@@ -0,0 +1,402 @@
+import os
+import sys
+import json
+import time
+import uuid
+import socket
+import signal
+import subprocess
+from nipype.pipeline.plugins.base import SGELikeBatchManagerBase, logger
+from nipype.pipeline.plugins.tools import create_pyscript
+from utils import get_cache_dir
+from resources import get_system_memory_gb
+
+# A job folder on storage that all machines mount: the plugin puts the nodes
+# that are ready to run in pending/, workers claim them by renaming them into
+# running/ (atomic, so exactly one worker gets a job) under a name with a
+# claim token of their own, touch them there as a heartbeat while they run,
+# and move them to done/ with their exit code. The results themselves are in
+# the node directories, as with the other batch plugins, so the working
+# directory has to be shared as well. All times are compared with times of
+# the file server (see get_shared_time), as the clocks of the machines may
+# differ
+job_subdirs = ['pending', 'running', 'done', 'logs']
+
+
+def get_job_dir(job_dir=None):
+    if job_dir is None:
+        job_dir = os.environ.get('MP2RAGE_JOB_DIR', get_cache_dir('jobs'))
+
+    job_dir = os.path.abspath(job_dir)
+
+    for subdir in job_subdirs:
+        os.makedirs(os.path.join(job_dir, subdir), exist_ok=True)
+
+    return job_dir
+
+
+def write_job(fn, job):
+    tmp_fn = os.path.join(os.path.dirname(fn), '.{}.tmp'.format(os.path.basename(fn)))
+    with open(tmp_fn, 'w') as f:
+        json.dump(job, f, indent=2)
+    os.replace(tmp_fn, fn)
+
+
+def read_job(fn):
+    try:
+        with open(fn) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        # Claimed, requeued or still being written
+        return None
+
+
+def get_claimed_fn(fn, token):
+    # The name of job fn in running/, claimed with token
+    return '{}@{}.json'.format(fn[:-len('.json')], token)
+
+
+def get_job_fn(claimed_fn):
+    # The name of the job in pending/ and done/
+    return '{}.json'.format(claimed_fn[:-len('.json')].rsplit('@', 1)[0])
+
+
+def get_shared_time(job_dir):
+    # The current time of the file server, from a file touched there (with
+    # the current time, like the heartbeats are)
+    fn = os.path.join(job_dir, '.clock')
+
+    with open(fn, 'a'):
+        pass
+    os.utime(fn)
+
+    return os.stat(fn).st_mtime
+
+
+def requeue_stale_jobs(job_dir, heartbeat_timeout=60.):
+    # Jobs whose worker stopped touching them (it died, or its machine did)
+    # go back to pending/. Every worker and the plugin do this, so it
+    # happens as long as anyone is alive. Returns the requeued jobs
+    requeued = []
+    now = get_shared_time(job_dir)
+    running_dir = os.path.join(job_dir, 'running')
+
+    for claimed_fn in os.listdir(running_dir):
+        if not claimed_fn.endswith('.json'):
+            continue
+
+        try:
+            age = now - os.stat(os.path.join(running_dir, claimed_fn)).st_mtime
+        except FileNotFoundError:
+            continue
+
+        if age > heartbeat_timeout:
+            fn = get_job_fn(claimed_fn)
+            try:
+                os.rename(os.path.join(running_dir, claimed_fn), os.path.join(job_dir, 'pending', fn))
+            except FileNotFoundError:
+                continue
+            logger.warning('Requeued job %s (no heartbeat for %.0fs)', fn, age)
+            requeued.append(fn)
+
+    return requeued
+
+
+class SharedFSPlugin(SGELikeBatchManagerBase):
+    # Runs the nodes of a workflow on any number of workers (see
+    # SharedFSWorker, `mp2rage-preproc worker`) on any machine that shares
+    # the job folder and the working directory. plugin_args:
+    #  - job_dir: the job folder (default: $MP2RAGE_JOB_DIR or /cache/jobs)
+    #  - heartbeat_timeout: seconds after which a running job without a
+    #    heartbeat is requeued (default 60)
+    #  - max_jobs: number of nodes queued at the same time (default: all
+    #    that are ready)
+
+    def __init__(self, **kwargs):
+        plugin_args = kwargs.get('plugin_args') or {}
+
+        self._job_dir = get_job_dir(plugin_args.get('job_dir'))
+        self._heartbeat_timeout = plugin_args.get('heartbeat_timeout', 60.)
+        self._run_id = uuid.uuid4().hex[:8]
+        self._jobs = {}
+        self._n_jobs = 0
+        self._last_requeue = 0.
+
+        super(SharedFSPlugin, self).__init__('#!/bin/bash', **kwargs)
+
+    def _submit_job(self, node, updatehash=False):
+        # No batch script: workers run the node script with their own
+        # python
+        return self._submit_batchtask(create_pyscript(node, updatehash=updatehash), node)
+
+    def _submit_batchtask(self, scriptfile, node):
+        self._n_jobs += 1
+        taskid = self._n_jobs
+
+        # Sorting by name is sorting by submission
+        name = '{}_{}_{:06d}_{}.json'.format(time.strftime('%Y%m%d-%H%M%S'), self._run_id,
+                                             taskid, node.name)
+        job = {'id': name[:-len('.json')],
+               'node': node.fullname,
+               'script': scriptfile,
+               'node_dir': node.output_dir(),
+               'n_procs': node.n_procs,
+               'mem_gb': node.mem_gb,
+               'submitted': time.time()}
+
+        write_job(os.path.join(self._job_dir, 'pending', name), job)
+
+        self._jobs[taskid] = name
+        self._pending[taskid] = node.output_dir()
+
+        return taskid
+
+    def _is_pending(self, taskid):
+        if time.time() - self._last_requeue > self._heartbeat_timeout / 4.:
+            requeue_stale_jobs(self._job_dir, self._heartbeat_timeout)
+            self._last_requeue = time.time()
+
+        done_fn = os.path.join(self._job_dir, 'done', self._jobs[taskid])
+
+        if not os.path.exists(done_fn):
+            return True
+
+        # (Without an exit code while the worker is still writing it)
+        job = read_job(done_fn)
+        if job is not None and job.get('exitcode', 0) != 0:
+            logger.warning('Job %s failed on %s (exit code %s, log %s)', job['id'],
+                           job['worker'], job['exitcode'], job['log'])
+
+        return False
+
+    def _clear_task(self, taskid):
+        super(SharedFSPlugin, self)._clear_task(taskid)
+        del self._jobs[taskid]
+
+
+class SharedFSWorker(object):
+    # Claims and runs jobs from the job folder, as many at the same time as
+    # fit in n_procs and mem_gb (by the n_procs and mem_gb of their nodes;
+    # by default 90% of the memory of the machine), oldest first, but
+    # skipping the ones that do not fit yet. Runs until there were no jobs
+    # for idle_timeout seconds (0: forever) or it gets SIGTERM/SIGINT, in
+    # which case it stops its jobs and requeues them
+
+    def __init__(self, job_dir=None, n_procs=1, mem_gb=None, worker_id=None, heartbeat_interval=10.,
+                 heartbeat_timeout=60., poll_interval=.5, idle_timeout=0.):
+        self.job_dir = get_job_dir(job_dir)
+        self.n_procs = n_procs
+        self.mem_gb = mem_gb if mem_gb is not None else .9 * get_system_memory_gb()
+        self.worker_id = worker_id or '{}_{}'.format(socket.gethostname(), os.getpid())
+        self.heartbeat_interval = min(heartbeat_interval, heartbeat_timeout / 4.)
+        self.heartbeat_timeout = heartbeat_timeout
+        self.poll_interval = poll_interval
+        self.idle_timeout = idle_timeout
+        self.running = {}
+        self.n_done = 0
+        self._stop = False
+
+    def serve(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        print('Worker {} running jobs from {} ({} processes, {:.1f} GB)'.format(self.worker_id,
+                                                                                   self.job_dir,
+                                                                                   self.n_procs,
+                                                                                   self.mem_gb))
+        last_active = time.time()
+        last_requeue = 0.
+
+        while not self._stop:
+            if time.time() - last_requeue > self.heartbeat_timeout / 4.:
+                requeue_stale_jobs(self.job_dir, self.heartbeat_timeout)
+                last_requeue = time.time()
+
+            self.reap()
+            self.heartbeat()
+
+            while self.start(self.claim()):
+                pass
+
+            if self.running:
+                last_active = time.time()
+            elif self.idle_timeout and time.time() - last_active > self.idle_timeout:
+                break
+
+            time.sleep(self.poll_interval)
+
+        self.stop_jobs()
+
+        print('Worker {} stopped after {} jobs'.format(self.worker_id, self.n_done))
+
+    def stop(self, signum=None, frame=None):
+        self._stop = True
+
+    def stop_jobs(self):
+        # Stops the running jobs and puts them back in pending/
+        for fn in list(self.running):
+            process, job, _ = self.running.pop(fn)
+            kill_job(process)
+            try:
+                os.rename(self.get_running_path(fn, job),
+                          os.path.join(self.job_dir, 'pending', fn))
+            except FileNotFoundError:
+                pass
+
+    def get_running_path(self, fn, job):
+        return os.path.join(self.job_dir, 'running', get_claimed_fn(fn, job['claim']))
+
+    def get_free_procs(self):
+        return self.n_procs - sum(job['n_procs'] for _, job, _ in self.running.values())
+
+    def get_free_mem_gb(self):
+        return self.mem_gb - sum(job['mem_gb'] for _, job, _ in self.running.values())
+
+    def claim(self):
+        # The oldest pending job that fits, or None
+        free_procs = self.get_free_procs()
+        free_mem_gb = self.get_free_mem_gb()
+        pending_dir = os.path.join(self.job_dir, 'pending')
+
+        for fn in sorted(os.listdir(pending_dir)):
+            if not fn.endswith('.json') or fn.startswith('.'):
+                continue
+
+            job = read_job(os.path.join(pending_dir, fn))
+            if job is None:
+                continue
+
+            # Nodes that need more than this worker has run on their own
+            job['n_procs'] = min(job.get('n_procs') or 1, self.n_procs)
+            job['mem_gb'] = min(job.get('mem_gb') or 0., self.mem_gb)
+            if job['n_procs'] > free_procs or job['mem_gb'] > free_mem_gb:
+                continue
+
+            # The rename keeps the time of the file, which may be older
+            # than the heartbeat timeout (queued long ago, or requeued), so
+            # it is touched first: in running/ it is fresh from the start.
+            # The claim token in its name there tells this claim from later
+            # ones of the same job (after it was requeued)
+            job['claim'] = uuid.uuid4().hex[:12]
+            try:
+                os.utime(os.path.join(pending_dir, fn))
+                os.rename(os.path.join(pending_dir, fn), self.get_running_path(fn, job))
+            except FileNotFoundError:
+                # Another worker was first
+                continue
+
+            return fn, job
+
+        return None
+
+    def start(self, claimed):
+        if claimed is None:
+            return False
+
+        fn, job = claimed
+        log_fn = os.path.join(self.job_dir, 'logs', '{}.log'.format(job['id']))
+
+        # The nodes unpickle (and Function nodes import) the modules here
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join([os.path.dirname(os.path.abspath(__file__))] +
+                                            [path for path in [env.get('PYTHONPATH')] if path])
+
+        # In a session of its own, so that stopping it also stops the
+        # programs the node runs (see kill_job)
+        with open(log_fn, 'a') as log:
+            process = subprocess.Popen([sys.executable, job['script']],
+                                       cwd=os.path.dirname(job['script']),
+                                       stdout=log, stderr=subprocess.STDOUT, env=env,
+                                       start_new_session=True)
+
+        job.update({'worker': self.worker_id,
+                    'started': time.time(),
+                    'log': log_fn})
+        self.running[fn] = (process, job, time.time())
+
+        return True
+
+    def heartbeat(self):
+        now = time.time()
+
+        for fn, (process, job, last_beat) in list(self.running.items()):
+            if now - last_beat > self.heartbeat_interval:
+                try:
+                    os.utime(self.get_running_path(fn, job))
+                except FileNotFoundError:
+                    # Requeued while we were (too) busy; somebody else will
+                    # run it (or already does, under a claim of its own)
+                    logger.warning('Lost job %s, stopping it', fn)
+                    kill_job(process)
+                    del self.running[fn]
+                    continue
+                self.running[fn] = (process, job, now)
+
+    def reap(self):
+        for fn, (process, job, _) in list(self.running.items()):
+            exitcode = process.poll()
+
+            if exitcode is None:
+                continue
+
+            del self.running[fn]
+            job.update({'finished': time.time(),
+                        'duration_s': time.time() - job['started'],
+                        'exitcode': exitcode})
+
+            # The result is in the node directory already; the job file
+            # tells the plugin to look. It is moved there first, which only
+            # works if the claim is still ours: a job that was requeued
+            # meanwhile belongs to whoever claimed it again
+            done_fn = os.path.join(self.job_dir, 'done', fn)
+            try:
+                os.rename(self.get_running_path(fn, job), done_fn)
+            except FileNotFoundError:
+                logger.warning('Lost job %s, not reporting it', fn)
+                continue
+
+            write_job(done_fn, job)
+            self.n_done += 1
+
+
+def kill_job(process):
+    # Terminates the job and everything it started (its process group)
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+    except ProcessLookupError:
+        pass
+    process.wait()
+
+
+class LocalWorkers(object):
+    # n worker processes on this machine, for as long as the with-block
+    # runs; to use (and test) the shared-filesystem plugin on one machine
+
+    def __init__(self, n_workers, job_dir=None, n_procs=1, mem_gb=None, heartbeat_timeout=60.):
+        self.n_workers = n_workers
+        self.job_dir = job_dir
+        self.n_procs = n_procs
+        self.mem_gb = mem_gb
+        self.heartbeat_timeout = heartbeat_timeout
+        self.processes = []
+
+    def __enter__(self):
+        cli = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cli.py')
+        job_dir = get_job_dir(self.job_dir) if self.n_workers else None
+        # The workers share the memory of this machine
+        mem_gb = (self.mem_gb if self.mem_gb is not None else .9 * get_system_memory_gb()) / max(self.n_workers, 1)
+
+        for ix in range(self.n_workers):
+            self.processes.append(subprocess.Popen([sys.executable, cli, 'worker',
+                                                    '--job-dir', job_dir,
+                                                    '--n-procs', str(self.n_procs),
+                                                    '--mem-gb', str(mem_gb),
+                                                    '--heartbeat-timeout', str(self.heartbeat_timeout),
+                                                    '--worker-id', '{}_local{}'.format(socket.gethostname(), ix)]))
+        return self
+
+    def __exit__(self, *args):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.wait()
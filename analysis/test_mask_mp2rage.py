@@ -0,0 +1,48 @@
+import numpy as np
+import nibabel as nb
+import pytest
+from scipy import ndimage
+from benchmark import make_masking_data, _mask_t1w_math_img
+from mask_mp2rage import mask_t1w
+
+# Run with `python -m pytest test_mask_mp2rage.py` (from this folder)
+
+
+@pytest.mark.parametrize('masks', [['manual_inside', 'manual_outside'],
+                                   ['manual_inside', 'manual_outside', 'dura_mask']])
+def test_mask_t1w_matches_math_img(tmp_path, monkeypatch, masks):
+    # The NumPy implementation gives the same brain mask and masked T1w as
+    # the original chain of math_img expressions
+    pytest.importorskip('nilearn')
+
+    inputs = make_masking_data(str(tmp_path), resolution=4.)
+    inputs = {key: fn for key, fn in inputs.items()
+              if key in ['t1w', 'inv2', 't1w_mask'] + masks}
+
+    outputs = {}
+    for method, function in [('math_img', _mask_t1w_math_img),
+                             ('numpy', mask_t1w)]:
+        (tmp_path / method).mkdir()
+        monkeypatch.chdir(tmp_path / method)
+        outputs[method] = [nb.load(fn).get_fdata() for fn in function(**inputs)]
+
+    reference_t1w, reference_mask = outputs['math_img']
+    new_t1w, new_mask = outputs['numpy']
+    reference_mask = reference_mask > 0
+    new_mask = new_mask > 0
+
+    assert reference_mask.any() and not reference_mask.all()
+    assert np.allclose(reference_t1w, new_t1w, rtol=1e-4, atol=1e-3)
+
+    if 'dura_mask' in inputs:
+        # math_img subtracts the dilated dura from the (uint8) brain mask, so
+        # where the dura lies outside of it, it wraps around and adds the
+        # dura instead. mask_t1w removes it, like the T1w is zeroed there
+        dura = nb.load(inputs['dura_mask']).get_fdata() > 0
+        dilated = ndimage.binary_dilation(dura, iterations=2)
+
+        assert np.array_equal(reference_mask[~dilated], new_mask[~dilated])
+        assert not (new_mask & dilated & (new_t1w == 0)).any()
+        assert not (new_mask & ~reference_mask).any()
+    else:
+        assert np.array_equal(reference_mask, new_mask)
@@ -0,0 +1,82 @@
+import os
+import shutil
+import numpy as np
+import nibabel as nb
+import pytest
+
+# Run with `python -m pytest test_provenance.py` (from this folder). Needs
+# the tools of the pipeline (ANTs, FSL, AFNI, nighres and pymp2rage)
+tools = ['antsRegistration', 'N4BiasFieldCorrection', 'bet', 'fslmaths', '3dAutomask']
+shape = (48, 48, 36)
+
+
+def _get_results(base_dir):
+    # Node directory (relative to base_dir) -> modification time of its
+    # result file, which nipype only writes when the node runs
+    results = {}
+
+    for dirpath, dirnames, filenames in os.walk(base_dir):
+        dirnames[:] = [d for d in dirnames if d != 'mapflow']
+        fn = 'result_{}.pklz'.format(os.path.basename(dirpath))
+        if fn in filenames:
+            results[os.path.relpath(dirpath, base_dir)] = os.stat(os.path.join(dirpath, fn)).st_mtime_ns
+
+    return results
+
+
+def test_plan_reports_the_nodes_that_rerun(tmp_path, monkeypatch):
+    # After a full run, editing a manual mask makes masking stale. The plan
+    # reruns it in the graph it ran in (with combining, up to date) and the
+    # nodes it reports are exactly the ones that execute
+    for module in ['pymp2rage', 'nighres']:
+        pytest.importorskip(module)
+    for tool in tools:
+        if shutil.which(tool) is None:
+            pytest.skip('{} is not installed'.format(tool))
+
+    monkeypatch.setenv('MP2RAGE_CACHE_DIR', str(tmp_path / 'cache'))
+    monkeypatch.setenv('MP2RAGE_NIGHRES_WORKERS', '0')
+
+    from phantom import make_phantom_dataset, make_phantom_derivatives
+    from provenance import plan, get_stale_stages
+    from mask_mp2rage import get_manual_masks
+    import batch
+
+    sourcedata = str(tmp_path / 'sourcedata')
+    derivatives = str(tmp_path / 'derivatives')
+    tmp_dir = str(tmp_path / 'work')
+    make_phantom_dataset(sourcedata, shape=shape)
+    make_phantom_derivatives(derivatives, shape=shape)
+
+    stages = ['combine', 'qmri', 'mask']
+    batch.main(sourcedata, derivatives, tmp_dir, subjects=['01'], stages=stages, n_procs=2)
+
+    entries = plan(sourcedata, derivatives, [('01', '1')], stages=stages)
+    assert all(entry['status'] == 'up to date' for entry in entries)
+
+    manual_outside = get_manual_masks(derivatives, '01', '1')['manual_outside']
+    img = nb.load(manual_outside)
+    data = np.asanyarray(img.dataobj).copy()
+    data[tuple(n // 2 for n in data.shape[:3])] = 1 - data[tuple(n // 2 for n in data.shape[:3])]
+    nb.Nifti1Image(data, img.affine, img.header).to_filename(manual_outside)
+
+    entries = {entry['stage']: entry for entry in plan(sourcedata, derivatives, [('01', '1')],
+                                                       stages=stages)}
+    assert entries['combine']['status'] == 'up to date'
+    assert entries['qmri']['status'] == 'up to date'
+    assert entries['mask']['status'] == 'stale'
+    assert entries['mask']['with_stages'] == ['combine']
+
+    subject_stages = get_stale_stages(entries.values())
+    assert subject_stages == {('01', '1'): ['combine', 'mask']}
+
+    base_dir = os.path.join(tmp_dir, 'mp2rage_batch', 'sub_01_ses_1')
+    before = _get_results(base_dir)
+    batch.main(sourcedata, derivatives, tmp_dir, subject_stages=subject_stages, n_procs=2)
+    after = _get_results(base_dir)
+
+    executed = sorted(key for key, mtime in after.items() if before.get(key) != mtime)
+    reported = sorted(os.path.join('mask_wf_01', node) for node in entries['mask']['nodes'])
+
+    assert executed and executed == reported
+    assert 'mask_wf_01/n4' not in executed
@@ -0,0 +1,61 @@
+import numpy as np
+import nibabel as nb
+from benchmark import make_transform
+from resampling import resample_to_grid, resample_images, read_itk_transform
+
+# Run with `python -m pytest test_resampling.py` (from this folder)
+resolution = 2.
+
+
+def _make_data(shape=(20, 24, 16), n_channels=2):
+    rng = np.random.RandomState(0)
+    return [rng.normal(size=shape).astype(np.float32) for _ in range(n_channels)]
+
+
+def _get_affine(shape):
+    affine = np.diag([resolution, resolution, resolution, 1.])
+    affine[:3, 3] = -np.array(shape) * resolution / 2.
+    return affine
+
+
+def test_identity_returns_the_input(tmp_path, monkeypatch):
+    # On the grid points, the windowed sinc is a delta function: resampling
+    # with the identity onto the same grid changes nothing
+    channels = _make_data()
+    affine = _get_affine(channels[0].shape)
+
+    in_files = []
+    for ix, data in enumerate(channels):
+        in_files.append(str(tmp_path / 'channel{}.nii'.format(ix)))
+        nb.Nifti1Image(data, affine).to_filename(in_files[-1])
+
+    transform = make_transform(str(tmp_path), rotation=0., translation=(0., 0., 0.))
+    assert np.allclose(read_itk_transform(transform), np.eye(4))
+
+    monkeypatch.chdir(tmp_path)
+    out_files = resample_images(in_files, transform, in_files[0], num_threads=2)
+
+    for data, out_file in zip(channels, out_files):
+        out = nb.load(out_file)
+        assert np.allclose(out.affine, affine)
+        assert np.array_equal(out.get_fdata(dtype=np.float32), data)
+
+
+def test_shift_by_whole_voxels():
+    # A translation (in ITK's LPS coordinates) by whole voxels moves the
+    # voxels along; those from outside the moving image are zero
+    channels = _make_data()
+    affine = _get_affine(channels[0].shape)
+
+    transform = np.eye(4)
+    transform[:3, 3] = [2 * resolution, 0, resolution]
+
+    resampled = resample_to_grid(channels, affine, channels[0].shape, affine, transform,
+                                 chunk_size=1000, num_threads=2)
+
+    for data, out in zip(channels, resampled):
+        # (L is -R: the moving point of voxel i is i - 2 along x, and k + 1
+        # along z)
+        assert np.array_equal(out[2:, :, :-1], data[:-2, :, 1:])
+        assert not out[:2].any()
+        assert not out[:, :, -1].any()
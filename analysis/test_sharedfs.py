@@ -0,0 +1,191 @@
+import os
+import time
+import signal
+import threading
+import nipype.pipeline.engine as pe
+import nipype.interfaces.utility as niu
+from sharedfs import (SharedFSPlugin, SharedFSWorker, LocalWorkers, get_job_dir, write_job,
+                      requeue_stale_jobs)
+
+# Run with `python -m pytest test_sharedfs.py` (from this folder). Workers
+# requeue jobs without a heartbeat for this many seconds
+heartbeat_timeout = 4.
+
+
+def run_toy_job(marker_dir, name, seconds):
+    # Leaves a file per attempt, named after the worker and the job process
+    import os
+    import time
+
+    open(os.path.join(marker_dir, '{}_{}_{}.pid'.format(name, os.getppid(), os.getpid())), 'w').close()
+    time.sleep(seconds)
+
+    return seconds
+
+
+def _get_attempts(marker_dir, name):
+    return [fn for fn in os.listdir(marker_dir) if fn.startswith(name + '_')]
+
+
+def _is_alive(pid):
+    # (Zombies, not reaped by a container without init, are dead)
+    try:
+        with open('/proc/{}/stat'.format(pid)) as f:
+            return f.read().split(')')[-1].split()[0] != 'Z'
+    except FileNotFoundError:
+        return False
+
+
+def _wait_for(condition, timeout=60.):
+    start = time.time()
+    while not condition():
+        if time.time() - start > timeout:
+            raise AssertionError('Timed out')
+        time.sleep(.1)
+
+
+def test_requeue_of_killed_worker(tmp_path):
+    # A worker (and its job) dies mid-job, as when its machine goes down:
+    # the job goes back to pending/ and the other worker runs it
+    job_dir = get_job_dir(str(tmp_path / 'jobs'))
+    marker_dir = str(tmp_path / 'markers')
+    os.makedirs(marker_dir)
+
+    wf = pe.Workflow(name='toy', base_dir=str(tmp_path / 'work'))
+    first = pe.Node(niu.Function(function=run_toy_job,
+                                 input_names=['marker_dir', 'name', 'seconds'],
+                                 output_names=['seconds']),
+                    name='first')
+    first.inputs.marker_dir = marker_dir
+    first.inputs.name = 'first'
+    first.inputs.seconds = 3.
+
+    second = pe.Node(niu.Function(function=run_toy_job,
+                                  input_names=['marker_dir', 'name', 'seconds'],
+                                  output_names=['seconds']),
+                     name='second')
+    second.inputs.marker_dir = marker_dir
+    second.inputs.name = 'second'
+    wf.connect(first, 'seconds', second, 'seconds')
+
+    def kill_first_attempt():
+        _wait_for(lambda: _get_attempts(marker_dir, 'first'))
+        _, worker_pid, job_pid = _get_attempts(marker_dir, 'first')[0][:-len('.pid')].split('_')
+        os.kill(int(worker_pid), signal.SIGKILL)
+        os.kill(int(job_pid), signal.SIGKILL)
+
+    killer = threading.Thread(target=kill_first_attempt)
+
+    with LocalWorkers(2, job_dir=job_dir, mem_gb=2., heartbeat_timeout=heartbeat_timeout):
+        killer.start()
+        wf.run(plugin=SharedFSPlugin(plugin_args={'job_dir': job_dir,
+                                                  'heartbeat_timeout': heartbeat_timeout}))
+    killer.join()
+
+    first_attempts = _get_attempts(marker_dir, 'first')
+    assert len(first_attempts) == 2
+    # (By the other worker)
+    assert len(set(fn.split('_')[1] for fn in first_attempts)) == 2
+    assert len(_get_attempts(marker_dir, 'second')) == 1
+    assert os.listdir(os.path.join(job_dir, 'pending')) == []
+    assert os.listdir(os.path.join(job_dir, 'running')) == []
+    assert len(os.listdir(os.path.join(job_dir, 'done'))) == 2
+
+
+def test_stop_jobs_stops_their_programs(tmp_path):
+    # A stopped worker stops what its jobs started, too, and requeues them
+    job_dir = get_job_dir(str(tmp_path / 'jobs'))
+    pid_fn = str(tmp_path / 'child.pid')
+    script = str(tmp_path / 'job.py')
+
+    with open(script, 'w') as f:
+        f.write('import subprocess, time\n'
+                'child = subprocess.Popen(["sleep", "600"])\n'
+                'open({!r}, "w").write(str(child.pid))\n'
+                'time.sleep(600)\n'.format(pid_fn))
+
+    fn = 'job.json'
+    write_job(os.path.join(job_dir, 'pending', fn),
+              {'id': 'job', 'node': 'job', 'script': script, 'node_dir': str(tmp_path),
+               'n_procs': 1, 'mem_gb': .1, 'submitted': time.time()})
+
+    # (Queued long ago: a fresh claim must not look stale)
+    os.utime(os.path.join(job_dir, 'pending', fn), (0, 0))
+
+    worker = SharedFSWorker(job_dir, mem_gb=1., heartbeat_timeout=heartbeat_timeout)
+    assert worker.start(worker.claim())
+    running_fn = worker.get_running_path(fn, worker.running[fn][1])
+    assert time.time() - os.stat(running_fn).st_mtime < heartbeat_timeout
+
+    _wait_for(lambda: os.path.exists(pid_fn) and os.path.getsize(pid_fn) > 0)
+    child_pid = int(open(pid_fn).read())
+    assert _is_alive(child_pid)
+
+    worker.stop_jobs()
+
+    _wait_for(lambda: not _is_alive(child_pid), timeout=10.)
+    assert os.listdir(os.path.join(job_dir, 'pending')) == [fn]
+    assert os.listdir(os.path.join(job_dir, 'running')) == []
+
+
+
+def _write_sleep_job(job_dir, tmp_path, fn='job.json', seconds=600):
+    script = str(tmp_path / 'sleep.py')
+    with open(script, 'w') as f:
+        f.write('import time\ntime.sleep({})\n'.format(seconds))
+
+    write_job(os.path.join(job_dir, 'pending', fn),
+              {'id': fn[:-len('.json')], 'node': 'job', 'script': script, 'node_dir': str(tmp_path),
+               'n_procs': 1, 'mem_gb': .1, 'submitted': time.time()})
+    return fn
+
+
+def test_requeue_uses_the_time_of_the_file_server(tmp_path, monkeypatch):
+    # A machine whose clock is ahead does not requeue the jobs of the others
+    job_dir = get_job_dir(str(tmp_path / 'jobs'))
+    fn = _write_sleep_job(job_dir, tmp_path)
+
+    worker = SharedFSWorker(job_dir, mem_gb=1., heartbeat_timeout=heartbeat_timeout)
+    assert worker.start(worker.claim())
+
+    try:
+        now = time.time()
+        monkeypatch.setattr(time, 'time', lambda: now + 3600.)
+        assert requeue_stale_jobs(job_dir, heartbeat_timeout) == []
+    finally:
+        monkeypatch.undo()
+        worker.stop_jobs()
+
+    assert os.listdir(os.path.join(job_dir, 'pending')) == [fn]
+
+
+def test_requeued_job_belongs_to_the_new_claim(tmp_path):
+    # A worker that missed its heartbeats (and so lost the job to another
+    # one) stops it, and does not report it as done when it finishes
+    job_dir = get_job_dir(str(tmp_path / 'jobs'))
+    fn = _write_sleep_job(job_dir, tmp_path)
+
+    first = SharedFSWorker(job_dir, mem_gb=1., heartbeat_timeout=heartbeat_timeout)
+    second = SharedFSWorker(job_dir, mem_gb=1., heartbeat_timeout=heartbeat_timeout)
+    assert first.start(first.claim())
+    first_process, first_job, _ = first.running[fn]
+
+    running_fn = os.path.join(job_dir, 'running', os.listdir(os.path.join(job_dir, 'running'))[0])
+    os.utime(running_fn, (0, 0))
+    assert requeue_stale_jobs(job_dir, heartbeat_timeout) == [fn]
+    assert second.start(second.claim())
+
+    # (The heartbeat is due)
+    first.running[fn] = first.running[fn][:2] + (0.,)
+    first.heartbeat()
+    assert fn not in first.running
+    assert first_process.poll() is not None
+
+    # Had it finished instead, it would not report the job either
+    first.running[fn] = (first_process, first_job, 0.)
+    first.reap()
+    assert os.listdir(os.path.join(job_dir, 'done')) == []
+    assert len(os.listdir(os.path.join(job_dir, 'running'))) == 1
+
+    second.stop_jobs()
+    assert os.listdir(os.path.join(job_dir, 'pending')) == [fn]
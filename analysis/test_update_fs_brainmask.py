@@ -0,0 +1,110 @@
+import os
+import numpy as np
+import nibabel as nb
+import pytest
+from update_fs_brainmask import get_mask_voxels
+
+# Run with `python -m pytest test_update_fs_brainmask.py` (from this folder)
+
+
+def _get_rotation(degrees):
+    angle = np.deg2rad(degrees)
+    rotation = np.eye(4)
+    rotation[:2, :2] = [[np.cos(angle), -np.sin(angle)],
+                        [np.sin(angle), np.cos(angle)]]
+    return rotation
+
+
+def _make_brainmask(shape=(64, 64, 64)):
+    # Like Freesurfer's conformed 1 mm space (LIA), with a ball of brain
+    affine = np.array([[-1., 0, 0, 32.],
+                       [0, 0, 1., -32.],
+                       [0, -1., 0, 32.],
+                       [0, 0, 0, 1.]])
+    grid = np.ogrid[tuple(slice(0, s) for s in shape)]
+    radius = np.sqrt(sum((g - s / 2.) ** 2 for g, s in zip(grid, shape)))
+    data = np.where(radius < 20, 110, 0).astype(np.uint8)
+    return nb.freesurfer.MGHImage(data, affine)
+
+
+def _make_mask(path, name, center, mask_affine, shape=(40, 40, 30), radius=5.):
+    # A ball (in world coordinates) on the grid of mask_affine
+    ijk = np.indices(shape).reshape(3, -1).T
+    xyz = nb.affines.apply_affine(mask_affine, ijk)
+    data = (np.linalg.norm(xyz - center, axis=1) < radius).reshape(shape).astype(np.uint8)
+
+    fn = os.path.join(path, '{}.nii.gz'.format(name))
+    nb.Nifti1Image(data, mask_affine).to_filename(fn)
+    return fn
+
+
+def _get_dense_voxels(mask_fn, target):
+    # The original implementation: the whole mask resampled to the target
+    from nilearn import image
+    resampled = image.resample_to_img(mask_fn, target, interpolation='nearest')
+    return np.asanyarray(resampled.dataobj) > 0
+
+
+@pytest.mark.parametrize('resolution, degrees', [(1.3, 0.), (.7, 0.), (.8, 10.)])
+def test_sparse_matches_dense(tmp_path, resolution, degrees):
+    # Looking up only the brainmask voxels in the bounding box of a mask
+    # selects the same voxels as resampling the whole mask
+    pytest.importorskip('nilearn')
+
+    brainmask = _make_brainmask()
+    mask_affine = _get_rotation(degrees).dot(np.diag([resolution] * 3 + [1.]))
+    mask_affine[:3, 3] = [-13.1, -12.3, -9.7]
+
+    mask_fn = _make_mask(str(tmp_path), 'mask', center=[3.2, -1.1, 2.4], mask_affine=mask_affine)
+
+    dense = _get_dense_voxels(mask_fn, brainmask)
+    sparse = np.zeros(brainmask.shape, dtype=bool)
+    sparse[get_mask_voxels(mask_fn, brainmask)] = True
+
+    assert dense.any()
+    assert np.array_equal(dense, sparse)
+
+
+def test_empty_and_outside_masks(tmp_path):
+    brainmask = _make_brainmask()
+    mask_affine = np.diag([1., 1., 1., 1.])
+
+    empty_fn = _make_mask(str(tmp_path), 'empty', center=[0, 0, 0], mask_affine=mask_affine, radius=0.)
+    assert len(get_mask_voxels(empty_fn, brainmask)[0]) == 0
+
+    # (Beyond the field of view of the brain mask)
+    mask_affine[:3, 3] = 500.
+    outside_fn = _make_mask(str(tmp_path), 'outside', center=[520., 520., 510.],
+                            mask_affine=mask_affine)
+    assert len(get_mask_voxels(outside_fn, brainmask)[0]) == 0
+
+
+def test_edits_match_dense(tmp_path):
+    # main() removes the outside mask from the brain mask and adds the grey
+    # matter mask where it was empty, like the dense computation, and does
+    # not touch the brain mask again on a rerun with the same edits
+    pytest.importorskip('nilearn')
+    from phantom import make_phantom_derivatives
+    from update_fs_brainmask import main, get_brainmask_fn
+    from mask_mp2rage import get_manual_masks
+
+    derivatives = str(tmp_path / 'derivatives')
+    make_phantom_derivatives(derivatives, shape=(48, 48, 36))
+
+    brainmask_fn = get_brainmask_fn(derivatives, '01')
+    brainmask = nb.load(brainmask_fn)
+    data = np.asarray(brainmask.dataobj).copy()
+    masks = get_manual_masks(derivatives, '01', '1')
+
+    outside = _get_dense_voxels(masks['manual_outside'], brainmask)
+    inside = _get_dense_voxels(masks['manual_inside'], brainmask)
+    expected = np.where(outside, 0, data)
+    expected = np.where(inside & (expected == 0), 1, expected)
+    assert not np.array_equal(expected, data)
+
+    main(None, derivatives, str(tmp_path / 'work'), '01', '1')
+    assert np.array_equal(np.asarray(nb.load(brainmask_fn).dataobj), expected)
+
+    mtime = os.stat(brainmask_fn).st_mtime_ns
+    main(None, derivatives, str(tmp_path / 'work'), '01', '1')
+    assert os.stat(brainmask_fn).st_mtime_ns == mtime
@@ -0,0 +1,36 @@
+import gzip
+import numpy as np
+import nibabel as nb
+import pytest
+from utils import write_gzip, image_to_bytes
+
+# Run with `python -m pytest test_utils.py` (from this folder)
+
+
+@pytest.mark.parametrize('block_size', [2 ** 20, 4096, 1000])
+def test_write_gzip_round_trip(tmp_path, block_size):
+    # Blocks deflated in parallel (also of sizes that do not divide the
+    # data) make a single gzip member that nibabel reads back unchanged
+    rng = np.random.RandomState(0)
+    data = rng.normal(size=(30, 20, 10)).astype(np.float32)
+    data[:10] = 0
+    affine = np.diag([.7, .7, .7, 1.])
+    img = nb.Nifti1Image(data, affine)
+
+    out_file = str(tmp_path / 'image.nii.gz')
+    write_gzip(image_to_bytes(img), out_file, num_threads=4, block_size=block_size)
+
+    with gzip.open(out_file) as f:
+        assert f.read() == image_to_bytes(img)
+
+    loaded = nb.load(out_file)
+    assert np.allclose(loaded.affine, affine)
+    assert np.array_equal(loaded.get_fdata(dtype=np.float32), data)
+
+
+def test_write_gzip_empty(tmp_path):
+    out_file = str(tmp_path / 'empty.gz')
+    write_gzip(b'', out_file, num_threads=2)
+
+    with gzip.open(out_file) as f:
+        assert f.read() == b''
@@ -1,7 +1,10 @@
-import argparse
 from utils import get_derivative
 import os
-from nilearn import image
+import sys
+import json
+import hashlib
+import itertools
+import numpy as np
 import nibabel as nb
 
 def main(sourcedata,
@@ -10,64 +13,138 @@ def main(sourcedata,
          subject,
          session=None):
 
-    
-    brainmask_fn = os.path.join(derivatives, 'freesurfer', 'sub-{}'.format(subject),
-                             'mri', 'brainmask.mgz')
+
+    brainmask_fn = get_brainmask_fn(derivatives, subject)
 
     if not os.path.exists(brainmask_fn):
         raise Exception('Brainmask {} does not exits. Did you run Freesurfer?'.format(brainmask_fn))
 
-    brainmask = image.load_img(brainmask_fn)
-
     manual_outside = get_derivative(derivatives, type='manual_segmentation',
                                     modality='anat', subject=subject,
                                     suffix='mask', description='outside',
                                     space='average', session=session,
                                     check_exists=False)
 
-    manual_outside = image.resample_to_img(manual_outside, brainmask,
-                                           interpolation='nearest')
-
     manual_inside = get_derivative(derivatives, type='manual_segmentation',
                                     modality='anat', subject=subject,
                                     suffix='mask', description='gm',
                                     space='average', session=session,
                                     check_exists=False)
 
-    manual_inside = image.resample_to_img(manual_inside, brainmask,
-                                           interpolation='nearest')
+    if manual_outside is None and manual_inside is None:
+        print('No manual edits for subject {}'.format(subject))
+        record_provenance(derivatives, subject, session, brainmask_fn, manual_outside, manual_inside)
+        return
+
+    # The edits were already applied to exactly this brain mask
+    hash_fn = brainmask_fn.replace('.mgz', '_manual_edits.json')
+    edits_hash = get_edits_hash(brainmask_fn, manual_outside, manual_inside)
 
-    new_brainmask = image.math_img('brainmask * (np.ones_like(brainmask) - manual_outside)' 
-                               '+ (manual_inside - (brainmask > 0)) ',
-                               brainmask=brainmask,
-                               manual_inside=manual_inside,
-                               manual_outside=manual_outside)
-    print(new_brainmask.shape)
+    if os.path.exists(hash_fn):
+        with open(hash_fn) as f:
+            if json.load(f).get('hash') == edits_hash:
+                print('Brain mask has NOT been altered (edits already applied)')
+                record_provenance(derivatives, subject, session, brainmask_fn, manual_outside, manual_inside)
+                return
 
-    new_brainmask = nb.freesurfer.MGHImage(new_brainmask.get_data(), brainmask.affine, brainmask.header)
+    brainmask = nb.load(brainmask_fn)
+    data = np.asarray(brainmask.dataobj)
+    new_data = data.copy()
 
-    if not (brainmask.get_data() == new_brainmask.get_data()).all():
+    # Voxels inside the brain that were manually marked as outside are
+    # removed; grey matter that Freesurfer missed is added (with value 1)
+    if manual_outside is not None:
+        new_data[get_mask_voxels(manual_outside, brainmask)] = 0
+
+    if manual_inside is not None:
+        inside = get_mask_voxels(manual_inside, brainmask)
+        new_data[inside] = np.where(new_data[inside] == 0, 1, new_data[inside])
+
+    if not (data == new_data).all():
         print('Brain mask has been altered')
-        new_brainmask.to_filename(brainmask_fn)
+        nb.freesurfer.MGHImage(new_data, brainmask.affine, brainmask.header).to_filename(brainmask_fn)
         print('writing to {}'.format(brainmask_fn))
+        edits_hash = get_edits_hash(brainmask_fn, manual_outside, manual_inside)
     else:
         print('Brain mask has NOT been altered')
-                               
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser()
-    parser.add_argument("subject", 
-                        type=str,
-                        help="subject to process")
-    parser.add_argument('session', 
-                        nargs='?', 
-                        default=None,
-                        help="subject to process")
-
-    args = parser.parse_args()
-
-    main('/sourcedata', 
-         '/derivatives',
-         tmp_dir='/workflow_folders',
-         subject=args.subject,
-         session=args.session)
 
+    with open(hash_fn, 'w') as f:
+        json.dump({'hash': edits_hash,
+                   'manual_outside': manual_outside,
+                   'manual_inside': manual_inside}, f, indent=2)
+
+    record_provenance(derivatives, subject, session, brainmask_fn, manual_outside, manual_inside)
+
+
+def get_brainmask_fn(derivatives, subject):
+    return os.path.join(derivatives, 'freesurfer', 'sub-{}'.format(subject),
+                        'mri', 'brainmask.mgz')
+
+
+def record_provenance(derivatives, subject, session, brainmask_fn, manual_outside, manual_inside):
+    # For the planner (provenance.py): the brain mask as it is now, with the
+    # edits, so that it is stale again once Freesurfer rewrites it
+    import provenance
+    provenance.record_provenance(derivatives, 'fs-brainmask', subject, session,
+                                 inputs={'brainmask': brainmask_fn,
+                                         'manual_inside': manual_inside,
+                                         'manual_outside': manual_outside},
+                                 parameters={},
+                                 out_files=[brainmask_fn])
+
+
+def get_edits_hash(brainmask_fn, *mask_fns):
+    edits_hash = hashlib.sha1()
+
+    for fn in (brainmask_fn,) + mask_fns:
+        edits_hash.update(str(fn).encode())
+        if fn is not None:
+            with open(fn, 'rb') as f:
+                for block in iter(lambda: f.read(2 ** 20), b''):
+                    edits_hash.update(block)
+
+    return edits_hash.hexdigest()
+
+
+def get_mask_voxels(mask_fn, target):
+    # Indices of the voxels of target that lie in the mask, when resampled
+    # with nearest-neighbour interpolation. Only the target voxels within
+    # the bounding box of the mask are looked at.
+    mask = nb.load(mask_fn)
+    mask_data = np.asarray(mask.dataobj) > 0
+
+    if not mask_data.any():
+        return tuple(np.zeros((3, 0), dtype=int))
+
+    nonzero = np.nonzero(mask_data)
+    lower = np.array([ix.min() for ix in nonzero]) - .5
+    upper = np.array([ix.max() for ix in nonzero]) + .5
+
+    # Bounding box of the mask in target voxels
+    mask_to_target = np.linalg.inv(target.affine).dot(mask.affine)
+    corners = np.array(list(itertools.product(*zip(lower, upper))))
+    corners = nb.affines.apply_affine(mask_to_target, corners)
+
+    shape = np.array(target.shape[:3])
+    lower = np.clip(np.floor(corners.min(0)).astype(int), 0, shape)
+    upper = np.clip(np.ceil(corners.max(0)).astype(int) + 1, 0, shape)
+
+    if (upper <= lower).any():
+        return tuple(np.zeros((3, 0), dtype=int))
+
+    grid = np.mgrid[tuple(slice(l, u) for l, u in zip(lower, upper))].reshape(3, -1).T
+
+    # Nearest mask voxel of every target voxel in the box
+    mask_ix = np.round(nb.affines.apply_affine(np.linalg.inv(mask_to_target), grid)).astype(int)
+    valid = ((mask_ix >= 0) & (mask_ix < mask_data.shape[:3])).all(1)
+
+    grid = grid[valid]
+    mask_ix = mask_ix[valid]
+    inside = mask_data[tuple(mask_ix.T)]
+
+    return tuple(grid[inside].T)
+
+
+if __name__ == '__main__':
+    import cli
+    cli.main(['fs-brainmask'] + sys.argv[1:])
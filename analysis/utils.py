@@ -1,8 +1,298 @@
 import os
 
+STAGES = ['combine', 'qmri', 'mask', 'fs-brainmask']
+
 def _pickone(input):
     return input[0]
 
+def _pickfirst(input):
+    return input[0][0]
+
+def transpose_lists(lists):
+    return [list(l) for l in zip(*lists)]
+
+def get_cache_dir(*subdirs):
+    # Caches that should survive wiping /workflow_folders
+    cache_dir = os.environ.get('MP2RAGE_CACHE_DIR',
+                               os.path.join(os.path.expanduser('~'), '.cache', 'mp2rage_preprocessing'))
+    cache_dir = os.path.join(cache_dir, *subdirs)
+
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+
+    return cache_dir
+
+network_filesystems = ('nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', 'lustre', 'gpfs',
+                       'beegfs', 'ceph', 'glusterfs', 'fuse.sshfs', 'fuse.glusterfs')
+journal_modes = ('DELETE', 'TRUNCATE', 'PERSIST', 'WAL')
+
+def is_network_filesystem(path):
+    # The filesystem type of the mount point path is on, from /proc/mounts
+    # (False where that does not exist)
+    path = os.path.realpath(path)
+    fstype = None
+    mount_point = ''
+
+    try:
+        with open('/proc/mounts') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                mount = fields[1].replace('\\040', ' ')
+                if (path == mount or path.startswith(mount.rstrip(os.sep) + os.sep)) and \
+                        len(mount) > len(mount_point):
+                    mount_point, fstype = mount, fields[2]
+    except OSError:
+        return False
+
+    return fstype in network_filesystems
+
+def connect_sqlite(db_path, timeout=60):
+    # WAL lets readers and a writer work at the same time, but needs shared
+    # memory between the processes and so does not work on a network
+    # filesystem (e.g., a /cache shared by the machines of sharedfs.py
+    # workers): there, the rollback journal is used.
+    # MP2RAGE_SQLITE_JOURNAL_MODE overrides the choice
+    import sqlite3
+
+    journal_mode = os.environ.get('MP2RAGE_SQLITE_JOURNAL_MODE')
+    if journal_mode is None:
+        journal_mode = 'DELETE' if is_network_filesystem(os.path.dirname(db_path)) else 'WAL'
+    elif journal_mode.upper() not in journal_modes:
+        raise Exception('Unknown journal mode {} (use one of {})'.format(journal_mode,
+                                                                         ', '.join(journal_modes)))
+
+    connection = sqlite3.connect(db_path, timeout=timeout)
+    connection.execute('PRAGMA journal_mode={}'.format(journal_mode))
+
+    return connection
+
+intermediate_formats = {'NIFTI': '.nii',
+                        'NIFTI_GZ': '.nii.gz'}
+
+def get_intermediate_format():
+    # Format of the files in the working directories, named like FSL's
+    # output_type. Uncompressed NIfTI (the default) can be memory-mapped by
+    # downstream nodes, only the derivatives that are sinked get compressed
+    output_type = os.environ.get('MP2RAGE_INTERMEDIATE_FORMAT', 'NIFTI')
+
+    if output_type not in intermediate_formats:
+        raise Exception('Unknown intermediate format {} (use one of {})'.format(output_type,
+                                                                                ', '.join(intermediate_formats)))
+
+    return output_type
+
+def set_intermediate_format(output_type):
+    # Set through the environment, so that Function nodes running in other
+    # processes see the same setting
+    if output_type not in intermediate_formats:
+        raise Exception('Unknown intermediate format {} (use one of {})'.format(output_type,
+                                                                                ', '.join(intermediate_formats)))
+
+    os.environ['MP2RAGE_INTERMEDIATE_FORMAT'] = output_type
+
+def get_intermediate_ext():
+    return intermediate_formats[get_intermediate_format()]
+
+def image_to_bytes(img):
+    # Uncompressed, single-file (.nii) representation of an image
+    import io
+
+    bio = io.BytesIO()
+    file_map = img.make_file_map({'image': bio, 'header': bio})
+    img.to_file_map(file_map)
+
+    return bio.getvalue()
+
+def write_gzip(data, out_file, num_threads=None, block_size=2 ** 20, compresslevel=1):
+    # Multi-threaded gzip, like pigz: blocks are deflated in parallel (zlib
+    # releases the GIL), every block primed with the last 32 kB of the
+    # previous one, and joined into a single gzip member that every gzip
+    # reader can decompress
+    import struct
+    import time
+    import zlib
+    from concurrent.futures import ThreadPoolExecutor
+
+    data = memoryview(data)
+    n_bytes = len(data)
+
+    def _deflate(start):
+        stop = min(start + block_size, n_bytes)
+
+        if start > 0:
+            compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS,
+                                          zlib.DEF_MEM_LEVEL, zlib.Z_DEFAULT_STRATEGY,
+                                          bytes(data[max(start - 32768, 0):start]))
+        else:
+            compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS)
+
+        block = compressor.compress(data[start:stop])
+
+        if stop == n_bytes:
+            return block + compressor.flush(zlib.Z_FINISH)
+
+        return block + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    if num_threads is None:
+        num_threads = 1
+
+    with ThreadPoolExecutor(num_threads) as executor, open(out_file, 'wb') as f:
+        crc = executor.submit(zlib.crc32, data)
+
+        f.write(b'\x1f\x8b\x08\x00' + struct.pack('<I', int(time.time())) + b'\x00\xff')
+
+        for block in executor.map(_deflate, range(0, max(n_bytes, 1), block_size)):
+            f.write(block)
+
+        f.write(struct.pack('<II', crc.result() & 0xffffffff, n_bytes & 0xffffffff))
+
+def get_bbox(mask, padding=0):
+    import numpy as np
+
+    bbox = []
+    for axis in range(mask.ndim):
+        other_axes = tuple(ax for ax in range(mask.ndim) if ax != axis)
+        nonzero = np.flatnonzero(mask.any(axis=other_axes))
+
+        if len(nonzero) == 0:
+            return None
+
+        bbox.append(slice(max(nonzero[0] - padding, 0),
+                          min(nonzero[-1] + padding + 1, mask.shape[axis])))
+
+    return tuple(bbox)
+
+def get_head_mask(data):
+    # Large connected components above Otsu's threshold (of the slightly
+    # smoothed image), so that noise and ghosting in the background are not
+    # included. The scalp is usually separated from the brain by dark skull
+    # and CSF (in INV2), so not only the largest component is kept
+    import numpy as np
+    from scipy import ndimage
+
+    data = ndimage.uniform_filter(data.astype(np.float32), size=3)
+    histogram, edges = np.histogram(data, bins=256)
+    centers = (edges[:-1] + edges[1:]) / 2.
+    weight = np.cumsum(histogram).astype(float)
+    mean = np.cumsum(histogram * centers)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        between = (mean[-1] * weight - mean * weight[-1]) ** 2 / (weight * (weight[-1] - weight))
+    mask = data > centers[np.nanargmax(between[:-1])]
+
+    labels, n_labels = ndimage.label(mask)
+    if n_labels > 1:
+        sizes = np.bincount(labels.ravel())
+        sizes[0] = 0
+        mask = (sizes >= .1 * sizes.max())[labels]
+
+    return mask
+
+def get_head_bbox(inv2, padding=10.):
+    # Bounding box (voxel [start, stop) per axis) of the head in an INV2
+    # image, which has the best contrast between head and background,
+    # padded with `padding` mm
+    import numpy as np
+    import nibabel as nb
+    from utils import get_bbox, get_head_mask
+
+    img = nb.load(inv2)
+    data = np.asanyarray(img.dataobj)
+    if data.ndim > 3:
+        data = data[..., 0]
+
+    mask = get_head_mask(data)
+
+    padding = np.ceil(padding / np.array(img.header.get_zooms()[:3])).astype(int)
+    bbox = get_bbox(mask)
+
+    if bbox is None:
+        return [[0, s] for s in data.shape]
+
+    return [[int(max(b.start - p, 0)), int(min(b.stop + p, s))]
+            for b, p, s in zip(bbox, padding, data.shape)]
+
+def crop_image(in_file, bbox, out_file=None):
+    # Cuts bbox out of an image (of any dimensionality beyond the first
+    # three), with the affine moved along so that the voxels stay in place
+    import os
+    import numpy as np
+    import nibabel as nb
+    from nipype.utils.filemanip import split_filename
+    from utils import get_intermediate_ext
+
+    img = nb.load(in_file)
+    slices = tuple(slice(start, stop) for start, stop in bbox)
+
+    if out_file is None:
+        _, fn, _ = split_filename(in_file)
+        out_file = os.path.abspath('{}_crop{}'.format(fn, get_intermediate_ext()))
+
+    translation = np.eye(4)
+    translation[:3, 3] = [start for start, stop in bbox]
+
+    cropped = img.__class__(np.asanyarray(img.dataobj[slices]), img.affine.dot(translation), img.header)
+    cropped.to_filename(out_file)
+
+    return out_file
+
+def crop_images(in_files, head_image, padding=10.):
+    # Crops all in_files (None is passed on) to the head in head_image (INV2)
+    from utils import get_head_bbox, crop_image
+
+    bbox = get_head_bbox(head_image, padding=padding)
+
+    return [None if fn is None else crop_image(fn, bbox) for fn in in_files], bbox
+
+def crop_mp2rage(mp2rage_parameters, padding=10.):
+    # Crops all images of an acquisition (every inversion and echo) to the
+    # head in INV2, so that fitting and everything downstream only process
+    # the head. Images on other grids (e.g., a B1 map) are left as they are
+    import nibabel as nb
+    from utils import get_head_bbox, get_mp2rage_image_keys, crop_image
+
+    inv2 = mp2rage_parameters['inv2']
+    inv2 = inv2[0] if type(inv2) is list else inv2
+    bbox = get_head_bbox(inv2, padding=padding)
+
+    mp2rage_parameters = dict(mp2rage_parameters)
+    for key in get_mp2rage_image_keys(mp2rage_parameters):
+        if type(mp2rage_parameters[key]) is list:
+            mp2rage_parameters[key] = [crop_image(fn, bbox) for fn in mp2rage_parameters[key]]
+        else:
+            mp2rage_parameters[key] = crop_image(mp2rage_parameters[key], bbox)
+
+    print('Cropped to {} (of {} voxels)'.format(bbox, nb.load(inv2).shape[:3]))
+
+    return mp2rage_parameters, bbox
+
+def uncrop_image(img, reference):
+    # Puts a (cropped) image back on the grid and header of reference. The
+    # grid of img has to be a voxel-aligned part of that of reference
+    import numpy as np
+
+    offset = np.linalg.inv(reference.affine).dot(img.affine)
+
+    if not (np.allclose(offset[:3, :3], np.eye(3), atol=1e-4) and
+            np.allclose(offset[:3, 3], np.round(offset[:3, 3]), atol=1e-3)):
+        raise Exception('Cannot uncrop, the grid of the image is not part of that of the reference')
+
+    start = np.round(offset[:3, 3]).astype(int)
+    stop = start + np.array(img.shape[:3])
+
+    if (start < 0).any() or (stop > np.array(reference.shape[:3])).any():
+        raise Exception('Cannot uncrop, the image extends beyond the reference')
+
+    data = np.asanyarray(img.dataobj)
+    full = np.zeros(tuple(reference.shape[:3]) + data.shape[3:], dtype=data.dtype)
+    full[tuple(slice(a, b) for a, b in zip(start, stop))] = data
+
+    header = reference.header.copy()
+    header.set_data_dtype(img.get_data_dtype())
+
+    return reference.__class__(full, reference.affine, header)
+
 def get_inv(mp2rage_parameters, inv=1, echo=1):
     print(mp2rage_parameters)
     inv = mp2rage_parameters['inv{}'.format(inv)]
@@ -12,60 +302,377 @@ def get_inv(mp2rage_parameters, inv=1, echo=1):
     else:
         return inv
 
-def fit_mp2rage(mp2rage_parameters, return_images=['t1w_uni', 't1map']):
-    import pymp2rage
+def fit_mp2rage(mp2rage_parameters, return_images=['t1w_uni', 't1map'],
+                n_procs=None, mem_gb=None, slab_size=None, out_dir=None):
+    # Only the maps in return_images are computed (and written). The input
+    # volumes are cut into z-slabs that are fitted by a pool of processes,
+    # with slabs small enough that all workers together stay within mem_gb.
+    # The fit is voxelwise, so the maps do not depend on the slabs
+    # (`benchmark.py slabs` checks this)
     import os
+    import numpy as np
+    import nibabel as nb
+    from concurrent.futures import ProcessPoolExecutor
+    from nipype.utils.filemanip import split_filename
+    from utils import get_intermediate_ext, get_mp2rage_image_keys, get_mp2rage_slab_size, _fit_mp2rage_slab
+    from resources import limit_threads, limit_process_threads
+
+    if type(return_images) is str:
+        return_images = [return_images]
+
+    image_keys = get_mp2rage_image_keys(mp2rage_parameters)
+    reference = nb.load(mp2rage_parameters['inv1'])
+    shape = reference.shape[:3]
+
+    # (Within a workflow, set_threads passes the n_procs of the node)
+    if n_procs is None:
+        n_procs = 1
+
+    if slab_size is None:
+        n_volumes = sum(len(mp2rage_parameters[key]) if type(mp2rage_parameters[key]) is list else 1
+                        for key in image_keys)
+        slab_size = get_mp2rage_slab_size(shape, n_volumes, len(return_images),
+                                          n_procs=n_procs, mem_gb=mem_gb)
+
+    slabs = [(start, min(start + slab_size, shape[2])) for start in range(0, shape[2], slab_size)]
+    n_procs = min(n_procs, len(slabs))
+    print('Fitting {} in {} slabs of {} slices using {} processes'.format(', '.join(return_images),
+                                                                          len(slabs), slab_size, n_procs))
+
+    if out_dir is None:
+        out_dir = os.getcwd()
+
+    maps = {key: np.zeros(shape, dtype=np.float32) for key in return_images}
+    args = [(mp2rage_parameters, image_keys, slab, return_images) for slab in slabs]
+
+    def _collect(results):
+        for (start, stop), slab_maps in zip(slabs, results):
+            for key in return_images:
+                maps[key][:, :, start:stop] = slab_maps[key]
+
+    # The processes are the threads: one BLAS thread each
+    if n_procs > 1:
+        with ProcessPoolExecutor(n_procs, initializer=limit_process_threads, initargs=(1,)) as executor:
+            _collect(executor.map(_fit_mp2rage_slab, *zip(*args)))
+    else:
+        with limit_threads(1):
+            _collect(_fit_mp2rage_slab(*arg) for arg in args)
+
+    _, prefix, _ = split_filename(mp2rage_parameters['inv1'])
+    result = []
+    for key in return_images:
+        out_file = os.path.join(out_dir, '{}_{}{}'.format(prefix, key, get_intermediate_ext()))
+        img = nb.Nifti1Image(maps[key], reference.affine, reference.header)
+        img.set_data_dtype(np.float32)
+        img.to_filename(out_file)
+        result.append(out_file)
+
+    print(result)
+    return tuple(result)
 
-    if 'echo_times' in mp2rage_parameters:
-        mp2rage = pymp2rage.MEMP2RAGE(**mp2rage_parameters)
-    else: 
-        mp2rage = pymp2rage.MP2RAGE(**mp2rage_parameters)
+# All maps a single fit of an acquisition provides
+mp2rage_maps = {'MP2RAGE': ['t1w_uni', 't1map'],
+                'MEMP2RAGE': ['t1w_uni', 't1map', 'S0map', 't2starw', 't2starmap']}
 
-    files = mp2rage.write_files(path=os.getcwd())
-    print(files)
+def get_mp2rage_fit(mp2rage_parameters, return_images=['t1w_uni', 't1map'],
+                    fits_dir=None, n_procs=None, mem_gb=None):
+    # Fits all maps of an acquisition in one pass and publishes them to
+    # fits_dir (by default in the cache, they are intermediates), together
+    # with a manifest of the source files and parameters. Later calls (from
+    # any workflow) reuse the maps as long as the manifest still matches
+    import os
+    import json
+    import fcntl
+    from nipype.utils.filemanip import split_filename
+    from utils import fit_mp2rage, get_mp2rage_fingerprint, mp2rage_maps, get_cache_dir
 
-    result = [files[key] for key in return_images]
-    return tuple(result)
+    if fits_dir is None:
+        fits_dir = get_cache_dir('mp2rage_fits')
 
+    if type(return_images) is str:
+        return_images = [return_images]
 
-def get_mp2rage_pars(sourcedata, subject, session, acquisition):
-    import pandas as pd
-    from bids import BIDSLayout
-    import re
+    _, prefix, _ = split_filename(mp2rage_parameters['inv1'])
+    out_dir = os.path.join(fits_dir, prefix)
+    manifest_fn = os.path.join(out_dir, 'manifest.json')
+
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir, exist_ok=True)
+
+    fingerprint = get_mp2rage_fingerprint(mp2rage_parameters)
+
+    def _load_manifest():
+        if not os.path.exists(manifest_fn):
+            return None
+
+        with open(manifest_fn) as f:
+            manifest = json.load(f)
+
+        if manifest['fingerprint'] != fingerprint:
+            return None
+
+        if not all(key in manifest['maps'] and os.path.exists(manifest['maps'][key])
+                   for key in return_images):
+            return None
+
+        return manifest
+
+    # Only one process fits, the others wait for its maps
+    with open(os.path.join(out_dir, '.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        manifest = _load_manifest()
+
+        if manifest is None:
+            if 'echo_times' in mp2rage_parameters:
+                maps = mp2rage_maps['MEMP2RAGE']
+            else:
+                maps = mp2rage_maps['MP2RAGE']
+            maps = maps + [key for key in return_images if key not in maps]
+
+            if os.path.exists(manifest_fn):
+                os.remove(manifest_fn)
+
+            out_files = fit_mp2rage(mp2rage_parameters, return_images=maps,
+                                    n_procs=n_procs, mem_gb=mem_gb, out_dir=out_dir)
+
+            manifest = {'fingerprint': fingerprint,
+                        'maps': dict(zip(maps, out_files))}
+
+            with open(manifest_fn + '.tmp', 'w') as f:
+                json.dump(manifest, f, indent=2, sort_keys=True)
+            os.replace(manifest_fn + '.tmp', manifest_fn)
+        else:
+            print('Reusing MP2RAGE fit in {}'.format(out_dir))
+
+    return tuple(manifest['maps'][key] for key in return_images)
+
+def get_mp2rage_fingerprint(mp2rage_parameters):
+    # Parameters plus size and modification time of every source file, and
+    # the code of the fit
     import os
-    import glob
     import json
     import numpy as np
+    from result_cache import get_code_hash
+
+    def _to_json(value):
+        if isinstance(value, np.ndarray):
+            return value.tolist()
+        if isinstance(value, np.generic):
+            return value.item()
+        raise TypeError('Cannot fingerprint {}'.format(type(value)))
+
+    files = {}
+    for key, value in mp2rage_parameters.items():
+        for fn in (value if type(value) is list else [value]):
+            if isinstance(fn, str) and os.path.exists(fn):
+                stat = os.stat(fn)
+                files[fn] = [stat.st_size, stat.st_mtime]
+
+    return json.loads(json.dumps({'parameters': mp2rage_parameters,
+                                  'files': files,
+                                  'code': get_code_hash('from utils import fit_mp2rage')},
+                                 sort_keys=True, default=_to_json))
+
+def get_mp2rage_image_keys(mp2rage_parameters):
+    # The parameters that are images (or lists of images, like the echoes of
+    # a MEMP2RAGE) on the grid of inv1. Images on other grids (e.g., a B1 map)
+    # are passed on as they are and resampled by pymp2rage
+    import numpy as np
+    import nibabel as nb
+
+    reference = nb.load(mp2rage_parameters['inv1'])
+
+    image_keys = []
+    for key, value in mp2rage_parameters.items():
+        fns = value if type(value) is list else [value]
+
+        if not all(isinstance(fn, str) and fn.endswith(('.nii', '.nii.gz')) for fn in fns):
+            continue
+
+        if all((nb.load(fn).shape[:3] == reference.shape[:3]) and
+               np.allclose(nb.load(fn).affine, reference.affine) for fn in fns):
+            image_keys.append(key)
+
+    return image_keys
+
+def get_mp2rage_slab_size(shape, n_volumes, n_outputs, n_procs=1, mem_gb=None,
+                          bytes_per_voxel=32):
+    # pymp2rage works in float64 and keeps a couple of intermediate volumes
+    # per input volume around, hence 32 bytes per input voxel
+    import numpy as np
+
+    if mem_gb is None:
+        try:
+            mem_gb = os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') / 1024. ** 3 / 2.
+        except (ValueError, OSError, AttributeError):
+            mem_gb = 4.
+
+    # The assembled (float32) output maps live in the parent process
+    slice_voxels = int(np.prod(shape[:2]))
+    available = mem_gb * 1024. ** 3 - n_outputs * 4. * slice_voxels * shape[2]
+    slice_bytes = slice_voxels * (n_volumes * bytes_per_voxel + n_outputs * 8.)
+
+    slab_size = int(available / n_procs / slice_bytes)
+
+    # Spread the slices evenly over the workers when memory allows
+    slab_size = min(slab_size, int(np.ceil(shape[2] / float(n_procs))))
+
+    return max(slab_size, 1)
+
+def _fit_mp2rage_slab(mp2rage_parameters, image_keys, slab, return_images):
+    import numpy as np
+    import nibabel as nb
+    import pymp2rage
+    from lut_cache import install_lut_cache
+
+    # The lookup table only depends on the sequence parameters, it is shared
+    # by all slabs, subjects and workflows
+    install_lut_cache()
+
+    # The slabs are passed to pymp2rage as images in memory (it loads its
+    # inputs with nilearn, which takes those as well as filenames), so only
+    # the slab is read and nothing is written
+    start, stop = slab
+    parameters = dict(mp2rage_parameters)
+
+    for key in image_keys:
+        fns = parameters[key] if type(parameters[key]) is list else [parameters[key]]
+        slab_imgs = []
+
+        for fn in fns:
+            img = nb.load(fn)
+            data = np.asanyarray(img.dataobj[:, :, start:stop])
+            affine = img.affine.dot(np.array([[1, 0, 0, 0],
+                                              [0, 1, 0, 0],
+                                              [0, 0, 1, start],
+                                              [0, 0, 0, 1]]))
+            slab_imgs.append(nb.Nifti1Image(data, affine, img.header))
+
+        parameters[key] = slab_imgs if type(parameters[key]) is list else slab_imgs[0]
+
+    if 'echo_times' in parameters:
+        mp2rage = pymp2rage.MEMP2RAGE(**parameters)
+    else:
+        mp2rage = pymp2rage.MP2RAGE(**parameters)
+
+    # Only the requested maps are computed
+    maps = {}
+    for key in return_images:
+        img = getattr(mp2rage, key)
+        if isinstance(img, nb.spatialimages.SpatialImage):
+            maps[key] = img.get_fdata(dtype=np.float32)
+        else:
+            maps[key] = np.asarray(img, dtype=np.float32)
+
+    return maps
+
+def average_images(in_files, weights=None, method='mean', trim=0.1, slab_size=None):
+    import os
+    import numpy as np
+    import nibabel as nb
+    from scipy import stats
+    from nipype.utils.filemanip import split_filename
+    from utils import get_intermediate_ext
+
+    if method not in ['mean', 'trimmed_mean', 'median']:
+        raise Exception('Unknown averaging method {}'.format(method))
+
+    if weights is None:
+        weights = [1.] * len(in_files)
+
+    if len(weights) != len(in_files):
+        raise Exception('Got {} weights for {} images'.format(len(weights), len(in_files)))
+
+    if (method != 'mean') and (len(set(weights)) > 1):
+        raise Exception('Weights are only supported for method="mean"')
+
+    reference = nb.load(in_files[0])
+    shape = reference.shape
+
+    for fn in in_files[1:]:
+        if nb.load(fn).shape != shape:
+            raise Exception('{} does not have the same shape as {}'.format(fn, in_files[0]))
+
+    # Images are read one by one (or one slab of all images at a time for the
+    # robust methods), the 4D-stack is never formed
+    if slab_size is None:
+        slab_size = shape[-1]
+
+    mean = np.zeros(shape, dtype=np.float32)
+
+    for start in range(0, shape[-1], slab_size):
+        slab = slice(start, min(start + slab_size, shape[-1]))
+        mean_slab = mean[..., slab]
+
+        if method == 'mean':
+            for fn, weight in zip(in_files, weights):
+                data = np.array(nb.load(fn).dataobj[..., slab], dtype=np.float32)
+                data *= weight
+                mean_slab += data
+                del data
+
+            mean_slab /= np.sum(weights)
+        else:
+            data = np.stack([np.asarray(nb.load(fn).dataobj[..., slab], dtype=np.float32)
+                             for fn in in_files])
+
+            if method == 'median':
+                mean_slab[:] = np.median(data, 0)
+            else:
+                mean_slab[:] = stats.trim_mean(data, trim, axis=0)
+            del data
 
-    layout = BIDSLayout(sourcedata)
+    _, fn, _ = split_filename(in_files[0])
+    out_file = os.path.abspath('{}_mean{}'.format(fn, get_intermediate_ext()))
 
-    mp2rage_files = layout.get(subject=subject, 
-                               session=session, 
-                               acquisition=acquisition,
-                               suffix='MPRAGE', 
-                               extensions=['.nii', '.nii.gz'])
-    print(mp2rage_files)
+    mean_image = nb.Nifti1Image(mean, reference.affine, reference.header)
+    mean_image.set_data_dtype(np.float32)
+    mean_image.to_filename(out_file)
 
-    reg = re.compile('.*/sub-(?P<subject>.+)_ses-(?P<session>.+)_acq-(?P<acquisition>.+)_inv-(?P<inv>[0-9]+)(_echo-(?P<echo>[0-9]+))?(_part-(?P<part>.+))?_MPRAGE.(?P<extension>nii|nii\.gz|json)')
+    return out_file
+
+def get_mp2rage_pars(sourcedata, subject, session, acquisition):
+    import os
+    import pandas as pd
+    import numpy as np
+    from bids_index import get_bids_index
+
+    # The index is brought up to date once per run (by batch.py, the
+    # pipeline and step scripts and the daemon), so this only queries it;
+    # only a subject it does not know yet is indexed here. The index (and
+    # its connection) is reused by the other calls in this process
+    index = get_bids_index(sourcedata)
+    query = dict(subject=subject,
+                 session=session,
+                 acquisition=acquisition,
+                 suffix='MPRAGE',
+                 extension=['nii', 'nii.gz'])
+
+    mp2rage_files = index.get(**query)
+    if len(mp2rage_files) == 0:
+        index.update(subject=subject)
+        mp2rage_files = index.get(**query)
+    print([file['path'] for file in mp2rage_files])
+
+    entities = ['subject', 'session', 'acquisition', 'inv', 'echo', 'part', 'extension']
 
     data = []
     for file in mp2rage_files:
-        print(file.filename)
-        if not reg.match(file.filename):
-            print('ERROR WITH {}'.format(file))
-        data.append(reg.match(file.filename).groupdict())
-        data[-1]['filename'] = file.filename
+        data.append({key: file[key] for key in entities})
+        data[-1]['filename'] = file['path']
     data = pd.DataFrame(data)
 
+    if len(data) == 0:
+        raise Exception('No MPRAGE-files for subject {} in {}'.format(subject, sourcedata))
+
     folder = os.path.dirname(data.iloc[0].filename)
-    json_files = glob.glob(os.path.join(folder, '*.json'))
+    json_files = index.get(dirname=folder, suffix='MPRAGE', extension='json')
 
     json_data = []
     for file in json_files:
-        if reg.match(file):
-            json_data.append(reg.match(file).groupdict())
-            with open(file) as f:
-                json_data[-1].update(json.load(f))
+        json_data.append({key: file[key] for key in entities})
+        json_data[-1].update(file['metadata'])
 
     json_data = pd.DataFrame(json_data)
     json_data.drop(columns=['part', 'extension'], inplace=True)
@@ -79,10 +686,10 @@ def get_mp2rage_pars(sourcedata, subject, session, acquisition):
 
     print(data)
 
-    B1map = layout.get(subject=subject, session=session, suffix='B1map', extensions=['.nii', '.nii.gz'])
+    B1map = index.get(subject=subject, session=session, suffix='B1map', extension=['nii', 'nii.gz'])
     
     if len(B1map) > 0:
-        B1map = B1map[0].filename
+        B1map = B1map[0]['path']
         data['B1map'] = B1map
 
     multi_echo_bool = len(data.loc[acquisition,2, :, 'mag']) > 2
@@ -129,6 +736,129 @@ def get_mp2rage_pars(sourcedata, subject, session, acquisition):
 
     return pars
 
+def get_derivative_fname(base_directory,
+                         source_file,
+                         in_file,
+                         out_path_base,
+                         suffix=None,
+                         space=None,
+                         desc=None,
+                         keep_dtype=False,
+                         compress=None):
+    # Same naming as fmriprep's DerivativesDataSink
+    import os
+    import re
+
+    bids_name = re.compile('^(.*\/)?(?P<subject_id>sub-[a-zA-Z0-9]+)(_(?P<session_id>ses-[a-zA-Z0-9]+))?'
+                           '(_(?P<task_id>task-[a-zA-Z0-9]+))?(_(?P<acq_id>acq-[a-zA-Z0-9]+))?'
+                           '(_(?P<rec_id>rec-[a-zA-Z0-9]+))?(_(?P<run_id>run-[a-zA-Z0-9]+))?')
+
+    def _splitext(fname):
+        fname, ext = os.path.splitext(os.path.basename(fname))
+        if ext == '.gz':
+            fname, ext2 = os.path.splitext(fname)
+            ext = ext2 + ext
+        return fname, ext
+
+    src_fname, _ = _splitext(source_file)
+    src_fname, dtype = src_fname.rsplit('_', 1)
+    _, ext = _splitext(in_file)
+
+    if compress is True and not ext.endswith('.gz'):
+        ext += '.gz'
+    elif compress is False and ext.endswith('.gz'):
+        ext = ext[:-3]
+
+    m = bids_name.search(src_fname)
+    mod = os.path.basename(os.path.dirname(source_file))
+
+    out_path = '{}/{subject_id}'.format(out_path_base, **m.groupdict())
+    if m.groupdict().get('session_id') is not None:
+        out_path += '/{session_id}'.format(**m.groupdict())
+    out_path += '/{}'.format(mod)
+
+    out_path = os.path.join(os.path.abspath(base_directory), out_path)
+
+    space = '_space-{}'.format(space) if space else ''
+    desc = '_desc-{}'.format(desc) if desc else ''
+    suffix = '_{}'.format(suffix) if suffix else ''
+    dtype = '' if not keep_dtype else ('_%s' % dtype)
+
+    return os.path.join(out_path, '{bname}{space}{desc}{suffix}{dtype}{ext}'.format(bname=src_fname,
+                                                                                   space=space,
+                                                                                   desc=desc,
+                                                                                   suffix=suffix,
+                                                                                   dtype=dtype,
+                                                                                   ext=ext))
+
+def sink_derivatives(in_files, source_files, specs, base_directory, reorient=True,
+                     compress=True, num_threads=None, uncrop=False):
+    # Reorients every image to RAS in memory and writes it once, under the
+    # name DerivativesDataSink would give it. `specs` holds, for every in_file,
+    # the keyword arguments of get_derivative_fname. Derivatives are
+    # compressed (with the multi-threaded write_gzip) unless `compress` or
+    # the spec says otherwise, whatever the format of the intermediates.
+    # With `uncrop`, images that were cropped (to the head) are put back on
+    # the grid and header of their source file
+    import os
+    import shutil
+    import nibabel as nb
+    import numpy as np
+    from utils import get_derivative_fname, image_to_bytes, write_gzip, uncrop_image
+
+    if not (len(in_files) == len(source_files) == len(specs)):
+        raise Exception('Got {} in_files, {} source_files and {} specs'.format(len(in_files),
+                                                                             len(source_files),
+                                                                             len(specs)))
+
+    out_files = []
+    for in_file, source_file, spec in zip(in_files, source_files, specs):
+        spec = dict({'compress': compress}, **spec)
+        out_file = get_derivative_fname(base_directory, source_file, in_file, **spec)
+
+        if not os.path.exists(os.path.dirname(out_file)):
+            os.makedirs(os.path.dirname(out_file), exist_ok=True)
+
+        img = nb.load(in_file)
+        uncropped = False
+
+        if uncrop:
+            source = nb.load(source_file)
+            if img.shape[:3] != source.shape[:3] or not np.allclose(img.affine, source.affine):
+                img = uncrop_image(img, source)
+                uncropped = True
+
+        if reorient:
+            orig_ornt = nb.orientations.io_orientation(img.affine)
+            targ_ornt = nb.orientations.axcodes2ornt('RAS')
+            transform = nb.orientations.ornt_transform(orig_ornt, targ_ornt)
+            is_ras = np.all(transform == [[0, 1], [1, 1], [2, 1]])
+        else:
+            is_ras = True
+
+        same_compression = in_file.endswith('.gz') == out_file.endswith('.gz')
+
+        if is_ras and same_compression and not uncropped:
+            shutil.copyfile(in_file, out_file)
+        else:
+            if not is_ras:
+                data = nb.orientations.apply_orientation(np.asanyarray(img.dataobj), transform)
+                affine = img.affine.dot(nb.orientations.inv_ornt_aff(transform, img.shape))
+                img = img.__class__(data, affine, img.header)
+
+            if not out_file.endswith('.gz'):
+                img.to_filename(out_file)
+            elif is_ras and in_file.endswith('.nii') and not uncropped:
+                with open(in_file, 'rb') as f:
+                    write_gzip(f.read(), out_file, num_threads=num_threads)
+            else:
+                write_gzip(image_to_bytes(img), out_file, num_threads=num_threads)
+
+        print('writing to {}'.format(out_file))
+        out_files.append(out_file)
+
+    return out_files
+
 def get_derivative(derivatives_folder,
                    type,
                    modality,